@@ -0,0 +1,285 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from drive_io import start_download
+from ball_tracker import make_tracker
+from inference_cache import InferenceRecord, make_cache_key, video_fingerprint
+from inference_server import load_shared_models
+from profiler import AnalysisProfiler
+from video_pipeline import FramePipeline, analyze_video_sharded, inference_settings, make_sampler
+
+JOBS_DB = os.path.join(".cache", "jobs.sqlite")
+RESULTS_DIR = os.path.join(".cache", "jobs")
+CHECKPOINT_FRAMES = 900     # このフレーム数ごとに途中結果を保存 (プロセスが落ちても続きから再開できる)
+PROGRESS_INTERVAL = 1.0     # 秒: 進捗を DB に書く間隔
+ACTIVE_STATUSES = ("queued", "downloading", "running")
+STATUS_LABELS = {"queued": "⏳ 待機中", "downloading": "📥 ダウンロード中", "running": "🧠 解析中",
+                 "done": "✅ 完了", "failed": "❌ エラー", "cancelled": "⏹ 中止"}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _settings_json(settings):
+    return json.dumps(settings, sort_keys=True, default=str)
+
+
+# --- 解析ジョブの永続化 (SQLite)。Streamlit の再実行・切断・プロセス再起動をまたいで残る ---
+class JobStore:
+    def __init__(self, path=JOBS_DB, results_dir=RESULTS_DIR):
+        self.path = path
+        self.results_dir = results_dir
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        os.makedirs(results_dir, exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, file_id TEXT, name TEXT, version TEXT, file_meta TEXT, settings TEXT,
+                status TEXT, progress REAL DEFAULT 0, message TEXT DEFAULT '', error TEXT,
+                cancel_requested INTEGER DEFAULT 0, cache_key TEXT, frames INTEGER DEFAULT 0,
+                created_at REAL, started_at REAL, finished_at REAL)""")
+
+    def _connect(self):
+        con = sqlite3.connect(self.path, timeout=30)
+        con.row_factory = sqlite3.Row
+        return con
+
+    @staticmethod
+    def _row(row):
+        if row is None: return None
+        job = dict(row)
+        job["file_meta"] = json.loads(job["file_meta"])
+        job["settings"] = json.loads(job["settings"])
+        return job
+
+    def add(self, file_meta, settings):
+        # 同じ版・同じ設定のジョブが待機中/実行中/完了済みなら追加しない。戻り値: (ジョブID, 新規か)
+        # 完了済みでも結果ファイルが消えていれば、そのジョブを待機中に戻して解析し直す
+        from video_store import VideoStore
+        version = VideoStore.version_of(file_meta)
+        settings_json = _settings_json(settings)
+        with self._lock, self._connect() as con:
+            row = con.execute("SELECT id, status FROM jobs WHERE file_id = ? AND version = ? AND settings = ? AND status IN (?, ?, ?, ?)",
+                              (file_meta["id"], version, settings_json, *ACTIVE_STATUSES, "done")).fetchone()
+            if row and row["status"] == "done" and not os.path.exists(self.result_path(row["id"])):
+                self._requeue(con, row["id"])
+                return row["id"], True
+            if row: return row["id"], False
+            job_id = uuid.uuid4().hex[:12]
+            con.execute("INSERT INTO jobs (id, file_id, name, version, file_meta, settings, status, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                        (job_id, file_meta["id"], file_meta.get("name", ""), version, json.dumps(file_meta),
+                         settings_json, time.time()))
+            return job_id, True
+
+    def add_many(self, files, settings):
+        return [job_id for job_id, created in (self.add(f, settings) for f in files) if created]
+
+    def get(self, job_id):
+        with self._connect() as con:
+            return self._row(con.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def list(self, limit=100):
+        with self._connect() as con:
+            rows = con.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row(r) for r in rows]
+
+    def update(self, job_id, **fields):
+        if not fields: return
+        cols = ", ".join(f"{k} = ?" for k in fields)
+        with self._connect() as con:
+            con.execute(f"UPDATE jobs SET {cols} WHERE id = ?", (*fields.values(), job_id))
+
+    def claim(self):
+        # 一番古い待機中ジョブを取り出して実行中にする (複数ワーカーが同じジョブを取らないようロック内で)
+        with self._lock, self._connect() as con:
+            row = con.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1").fetchone()
+            if row is None: return None
+            con.execute("UPDATE jobs SET status = 'downloading', started_at = ?, error = NULL WHERE id = ?",
+                        (time.time(), row["id"]))
+        return self._row(row)
+
+    def requeue_interrupted(self):
+        # 前回のプロセスが実行途中で終了したジョブを待機中に戻す (途中結果があればそこから再開)
+        with self._lock, self._connect() as con:
+            return con.execute("UPDATE jobs SET status = 'queued', message = '再開待ち' "
+                               "WHERE status IN ('downloading', 'running')").rowcount
+
+    def cancel(self, job_id):
+        with self._lock, self._connect() as con:
+            con.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                        (time.time(), job_id))
+            con.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN ('downloading', 'running')",
+                        (job_id,))
+
+    def _requeue(self, con, job_id):
+        con.execute("UPDATE jobs SET status = 'queued', cancel_requested = 0, error = NULL, progress = 0, message = '' "
+                    "WHERE id = ?", (job_id,))
+
+    def retry(self, job_id):
+        # 失敗・中止したジョブと、結果ファイルが消えた完了済みジョブをやり直す
+        with self._lock, self._connect() as con:
+            row = con.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None: return
+            if row["status"] in ("failed", "cancelled") or \
+                    (row["status"] == "done" and not os.path.exists(self.result_path(job_id))):
+                self._requeue(con, job_id)
+
+    def cancel_requested(self, job_id):
+        with self._connect() as con:
+            row = con.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def result_path(self, job_id):
+        return os.path.join(self.results_dir, f"{job_id}.npz")
+
+    def checkpoint_path(self, job_id):
+        return os.path.join(self.results_dir, f"{job_id}.partial.npz")
+
+    def load_result(self, job_id):
+        path = self.result_path(job_id)
+        return InferenceRecord.load(path) if os.path.exists(path) else None
+
+
+# --- ワーカープール: 待機中のジョブを取り出して ダウンロード → 推論 → 保存 まで行う ---
+class JobRunner:
+    def __init__(self, store, video_store, drive_factory, cache, num_workers=1, poll_interval=2.0):
+        # drive_factory: ワーカースレッド内で Drive サービスを作る関数 (DriveDownload と同じ)
+        self.store = store
+        self.video_store = video_store
+        self.drive_factory = drive_factory
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.num_workers = 0
+        self._wake = threading.Event()
+        self._workers = {}   # ワーカー番号 → スレッド (番号は 0〜num_workers-1 を欠けなく使う)
+        self._workers_lock = threading.Lock()
+        store.requeue_interrupted()
+        self.set_workers(num_workers)
+
+    def set_workers(self, n):
+        # 増やすときはスレッドを足し、減らすときは番号の大きいワーカーが手持ちのジョブを終えてから抜ける
+        with self._workers_lock:
+            self.num_workers = max(1, int(n))
+            for i in range(self.num_workers):
+                if i in self._workers: continue   # 減らした後にまだ抜けていないワーカーはそのまま続ける
+                t = threading.Thread(target=self._worker, args=(i,), name=f"analysis-worker-{i}", daemon=True)
+                self._workers[i] = t
+                t.start()
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def _worker(self, index):
+        while True:
+            with self._workers_lock:
+                if index >= self.num_workers:
+                    del self._workers[index]
+                    return
+            job = self.store.claim()
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            try:
+                # 解析が終わるまで、他のセッションの commit で動画が消されないようにする
+                with self.video_store.using(self.video_store.path_for(job["file_meta"])):
+                    self._run_job(job)
+            except JobCancelled:
+                self.store.update(job["id"], status="cancelled", finished_at=time.time(), message="中止しました")
+            except Exception as e:
+                self.store.update(job["id"], status="failed", finished_at=time.time(), error=str(e))
+
+    def _check_cancel(self, job_id):
+        if self.store.cancel_requested(job_id): raise JobCancelled()
+
+    def _fetch(self, job):
+        meta = job["file_meta"]
+        path = self.video_store.lookup(meta)
+        if path: return path
+        dl = start_download(self.drive_factory, meta["id"], self.video_store.path_for(meta))
+        while not dl.wait(PROGRESS_INTERVAL):
+            self.store.update(job["id"], progress=dl.progress, message=f"{dl.bytes_done / 1e6:.0f} MB")
+            if self.store.cancel_requested(job["id"]):
+                dl.cancel()
+                dl.wait()
+                raise JobCancelled()
+        if dl.error: raise dl.error
+        return self.video_store.commit(dl.dest_path)
+
+    def _run_job(self, job):
+        job_id, settings = job["id"], job["settings"]
+        self.store.update(job_id, status="downloading", progress=0.0, message="")
+        path = self._fetch(job)
+        self._check_cancel(job_id)
+
+        key = make_cache_key(path, inference_settings(settings.get("sample_every", 3), settings.get("motion"),
+                                                      settings.get("backend", "pytorch"), settings.get("tracker"),
+                                                      settings.get("crop"), settings.get("imgsz"), settings.get("batch_size", 4),
+                                                      settings.get("num_workers") if settings.get("use_shards") else None))
+        record = self.cache.get(key)
+        if record is None:
+            self.store.update(job_id, status="running", progress=0.0, message="")
+            record = self._analyze(job, path)
+            self.cache.put(key, record)
+        record.meta["video"] = video_fingerprint(path)   # 結果を開いたとき、ロード中の動画と同じか確かめる
+        record.save(self.store.result_path(job_id))
+        checkpoint = self.store.checkpoint_path(job_id)
+        if os.path.exists(checkpoint): os.remove(checkpoint)
+        self.store.update(job_id, status="done", progress=1.0, cache_key=key, frames=len(record),
+                          finished_at=time.time(), message="")
+
+    def _analyze(self, job, path):
+        job_id, settings = job["id"], job["settings"]
+        profiler = AnalysisProfiler({"mode": "job", **settings})
+        if settings.get("use_shards"):
+            record, stats = analyze_video_sharded(
+                path, num_workers=settings.get("num_workers"), batch_size=settings.get("batch_size", 4),
+                motion=settings.get("motion"), profiler=profiler, backend=settings.get("backend", "pytorch"),
+                tracker=settings.get("tracker"), crop=settings.get("crop"), imgsz=settings.get("imgsz"),
+                on_progress=lambda p: self.store.update(job_id, progress=p))
+        else:
+            record, stats = self._analyze_pipeline(job_id, path, settings, profiler)
+        profiler.finish()
+        record.meta["sampling"] = stats
+        record.meta["profile"] = profiler.snapshot()
+        return record
+
+    def _analyze_pipeline(self, job_id, path, settings, profiler):
+        pose_model, det_model, cv2 = load_shared_models(settings.get("backend", "pytorch"))
+        checkpoint = self.store.checkpoint_path(job_id)
+        record = InferenceRecord.load(checkpoint) if os.path.exists(checkpoint) else None
+        start_frame = record.meta.get("last_frame", 0) if record is not None else 0
+        sampler = make_sampler(cv2, motion=settings.get("motion"))
+        tracker = make_tracker(settings.get("tracker"))
+        pipeline = FramePipeline(path, det_model, pose_model, cv2, batch_size=settings.get("batch_size", 4),
+                                 start_frame=start_frame, sampler=sampler, profiler=profiler, tracker=tracker,
+                                 crop=settings.get("crop"), imgsz=settings.get("imgsz"))
+        if record is None:
+            record = InferenceRecord({"width": pipeline.width, "height": pipeline.height,
+                                      "total_frames": pipeline.total_frames, "fps": pipeline.fps})
+        total = pipeline.total_frames
+        last_update = 0.0
+        last_checkpoint = start_frame
+        with pipeline:
+            for res in pipeline:
+                record.add(res.frame_idx, res.ball, res.keypoints, res.ball_track, res.time_s)
+                if time.monotonic() - last_update >= PROGRESS_INTERVAL:
+                    last_update = time.monotonic()
+                    self.store.update(job_id, progress=res.frame_idx / total if total > 0 else 0.0, frames=len(record),
+                                      message=f"{res.frame_idx} / {total} フレーム")
+                    self._check_cancel(job_id)
+                if res.frame_idx - last_checkpoint >= CHECKPOINT_FRAMES:
+                    record.meta["last_frame"] = last_checkpoint = res.frame_idx
+                    record.save(checkpoint)
+        record.meta.pop("last_frame", None)
+        if tracker is not None: tracker.report(profiler)
+        record.meta["height"] = pipeline.height
+        return record, sampler.stats
@@ -3,22 +3,41 @@ import pandas as pd
 from streamlit_image_coordinates import streamlit_image_coordinates
 from PIL import Image, ImageDraw
 import datetime
+import json
 import re
 import os
-import io
-import tempfile
+import shutil
+import time
 import numpy as np
-import math
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
+from video_pipeline import (FramePipeline, EventDetector, PreviewPolicy, EVENT_COLUMNS, analyze_video_sharded,
+                            render_preview, make_sampler, classify_record, inference_settings)
+from inference_cache import InferenceCache, InferenceRecord, make_cache_key, video_fingerprint
+from drive_io import start_download, DEFAULT_CHUNK_SIZE
+from video_store import VideoStore
+from google_clients import GoogleClients
+from sheet_history import HistorySheet, HISTORY_SHEET, ROW_ID_COL
+from history_store import HistoryStore, HistorySyncer
+from setter_stats import ZONE_ORDER, ALL_SETTERS, distribution_tables, data_fingerprint
+from court_render import render_setup_locations, HEATMAP_AUTO_POINTS
+from profiler import AnalysisProfiler
+from analysis_jobs import JobStore, JobRunner, STATUS_LABELS
+from inference_server import load_shared_models, running_servers
+from model_backends import BACKENDS, BACKEND_LABELS, DEFAULT_BACKEND, compare_backends
+from ball_tracker import DEFAULT_TRACKER, make_tracker, trajectory_frame
+from court_calibration import CalibrationStore, CourtRegion, DEFAULT_SETUP
+from clip_export import CLIP_DIR, export_clips, ffmpeg_available, highlight_reel, zip_clips
+from roster_cache import RosterCache, parse_roster
+from match_journal import MatchJournal, unfinished_journals
 
 # --- 設定 ---
 st.set_page_config(layout="wide", page_title="Volleyball Analyst Pro v41")
 
 # ★★★ Googleドライブ共有フォルダID ★★★
 TARGET_FOLDER_ID = "1F1hTSQcYV3QRpz0PBrx5m4U-9TxE_bgE"
+SPREADSHEET_ID = "14o1wNqQIrJPy9IAuQ7PSCwP6NyA4O5dZrn_FmFoSqLQ"
+
+# st.video はファイル全体をメモリに載せるので、大きな動画はプレビューしない
+VIDEO_PREVIEW_MAX_BYTES = 200 * 1024 * 1024
 
 # ゾーンと色の定義
 ZONE_COLORS = {
@@ -31,29 +50,21 @@ ZONE_COLORS = {
     "なし": ("gray", "None")
 }
 
-PASS_ORDER = ["Aパス", "Bパス", "Cパス", "その他", "相手サーブミス", "失敗 (エース)"]
-ZONE_ORDER = ["レフト(L)", "センター(C)", "ライト(R)", "レフトバック(LB)", "センターバック(CB)", "ライトバック(RB)", "なし"]
-
-# キーポイントID (YOLOv8 Pose)
-KP_NOSE = 0
-KP_R_WRIST = 10
-KP_L_WRIST = 9
-KP_R_ANKLE = 16
-KP_L_ANKLE = 15
-
 # --- AIモデルのロード (遅延読み込みでクラッシュ回避) ---
 @st.cache_resource
-def load_models():
-    # ★重要: ここで初めて重いライブラリをimportする
-    import cv2
-    from ultralytics import YOLO
-    
-    pose_model = YOLO('yolov8n-pose.pt')
-    det_model = YOLO('yolov8n.pt') 
-    return pose_model, det_model, cv2
+def load_models(backend=DEFAULT_BACKEND):
+    # ★重要: 重いライブラリ (cv2 / ultralytics) は load_yolo_models の中で初めてimportする
+    # 推論は全セッション共有の推論サーバー経由 (同時に解析してもモデルの同時呼び出しで CPU を奪い合わない)
+    return load_shared_models(backend)
+
+@st.cache_resource
+def get_inference_cache():
+    return InferenceCache()
 
 # --- Google API 接続設定 ---
+# gspread / oauth2client / googleapiclient は重いので、実際に使うときに初めて import する (起動を速くするため)
 def get_gcp_creds():
+    from oauth2client.service_account import ServiceAccountCredentials
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     try:
         creds_dict = dict(st.secrets["gcp_service_account"])
@@ -64,114 +75,148 @@ def get_gcp_creds():
         st.error(f"認証エラー: {e}")
         st.stop()
 
+# 認証済みクライアントはプロセス全体で1つだけ作り、全セッションで共有する
+@st.cache_resource
+def get_google_clients():
+    return GoogleClients(get_gcp_creds(), SPREADSHEET_ID)
+
 def connect_to_gsheet():
-    creds = get_gcp_creds()
-    client = gspread.authorize(creds)
-    SPREADSHEET_ID = "14o1wNqQIrJPy9IAuQ7PSCwP6NyA4O5dZrn_FmFoSqLQ"
+    import gspread
     try:
-        sheet = client.open_by_key(SPREADSHEET_ID)
-        return sheet
+        return get_google_clients().spreadsheet()
     except gspread.exceptions.APIError:
         st.error("エラー：スプレッドシートが見つかりません。")
         st.stop()
 
 def connect_to_drive():
-    creds = get_gcp_creds()
-    service = build('drive', 'v3', credentials=creds)
-    return service
+    return get_google_clients().drive()
+
+def get_worksheet(title, create=None):
+    connect_to_gsheet()
+    return get_google_clients().worksheet(title, create=create)
 
 # --- Drive 操作関数 ---
 def list_drive_files(folder_id):
     try:
         service = connect_to_drive()
         query = f"'{folder_id}' in parents and mimeType contains 'video' and trashed=false"
-        results = service.files().list(
-            q=query, pageSize=20, fields="nextPageToken, files(id, name, createdTime)").execute()
-        return results.get('files', [])
+        files, page_token = [], None
+        while True:
+            results = service.files().list(
+                q=query, pageSize=100, pageToken=page_token, orderBy="createdTime desc",
+                fields="nextPageToken, files(id, name, createdTime, modifiedTime, md5Checksum, size)").execute()
+            files.extend(results.get('files', []))
+            page_token = results.get('nextPageToken')
+            if not page_token: break
+        return files
     except Exception as e:
         return []
 
-def download_file_from_drive(file_id):
-    service = connect_to_drive()
-    request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-    fh.seek(0)
-    return fh
+@st.cache_resource
+def get_video_store():
+    store = VideoStore()
+    store.cleanup_orphans()
+    return store
+
+# 解析ジョブのワーカープール (プロセスに1つ。どのセッションから追加したジョブもここで実行する)
+@st.cache_resource
+def get_job_runner():
+    return JobRunner(JobStore(), get_video_store(), get_google_clients().drive, get_inference_cache())
+
+def start_drive_download(file_meta, chunk_size=DEFAULT_CHUNK_SIZE):
+    # メモリに溜めずにチャンク単位で直接ディスクへ書く。保存先はファイルID+版で固定なので中断しても続きから再開できる
+    dest_path = get_video_store().path_for(file_meta)
+    # 他のセッション・ジョブが同じ動画を受信中ならそれを共有する
+    return start_download(get_google_clients().drive, file_meta['id'], dest_path, chunk_size)
 
 # --- データ読み書き関数 ---
-def load_players_from_sheet():
-    sheet = connect_to_gsheet()
-    try:
-        worksheet = sheet.worksheet("players")
-        data = worksheet.get_all_records()
-        if not data:
-             return {
-                "My Team": {"#1 田中": "OH", "#2 佐藤": "MB", "#3 鈴木": "OP", "#4 高橋": "OH", "#5 渡辺": "MB", "#6 山本": "L"},
-                "Opponent A": {"#1 敵A": "OH", "#2 敵B": "MB", "#3 敵C": "OP", "#4 敵D": "OH", "#5 敵E": "MB", "#6 敵L": "L"}
-            }
-        db = {}
-        for row in data:
-            team = str(row["Team"])
-            p_key = str(row["PlayerKey"])
-            pos = str(row["Position"])
-            if team not in db: db[team] = {}
-            db[team][p_key] = pos
-        return db
-    except gspread.exceptions.WorksheetNotFound:
-        st.error("エラー：シート 'players' が見つかりません。")
-        st.stop()
+# 名簿はプロセス全体で共有し、TTL ごとに裏で読み直す (新しいセッションが毎回シートを読むのを待たない)
+@st.cache_resource
+def get_roster_cache():
+    clients = get_google_clients()
+    return RosterCache(lambda: parse_roster(clients.worksheet_call("players", lambda ws: ws.get_all_records())))
+
+def load_players_from_sheet(wait=True):
+    # セッションの名簿を共有キャッシュの最新版にそろえる。wait=False なら読み込み中でも待たずに戻る
+    cache = get_roster_cache()
+    if wait and cache.version == 0:
+        with st.spinner("名簿を読み込み中..."):
+            version, roster = cache.get(wait=True)
+    else:
+        version, roster = cache.get(wait=wait)
+    if roster is None:
+        if wait and cache.error is not None:
+            import gspread
+            if isinstance(cache.error, gspread.exceptions.WorksheetNotFound):
+                st.error("エラー：シート 'players' が見つかりません。")
+            else:
+                st.error(f"名簿の読み込みエラー: {cache.error}")
+            st.stop()
+        return
+    if version != st.session_state.players_version:
+        st.session_state.players_db = roster
+        st.session_state.players_version = version
 
 def save_players_to_sheet(players_dict):
-    sheet = connect_to_gsheet()
-    worksheet = sheet.worksheet("players")
+    get_worksheet("players")
     rows = [["Team", "PlayerKey", "Position"]]
     for team, members in players_dict.items():
         for p_key, pos in members.items():
             rows.append([team, p_key, pos])
-    worksheet.clear()
-    worksheet.update(rows)
+    def write(worksheet):
+        worksheet.clear()
+        worksheet.update(rows)
+    get_google_clients().worksheet_call("players", write)
+    # 書いた内容をそのまま共有の名簿にする (他のセッションも次の再描画で新しい名簿になる)
+    cache = get_roster_cache()
+    cache.invalidate(players_dict)
+    st.session_state.players_version = cache.version
+
+@st.cache_resource
+def get_history_sheet():
+    # シートは必要に応じて追記時に自動で伸びるので、最初は小さく作る
+    # 試合入力の送信スレッドからも呼ばれるので st.error / st.stop を使う get_worksheet は通さない
+    clients = get_google_clients()
+    create = {"rows": "1", "cols": "20"}
+    return HistorySheet(clients.worksheet(HISTORY_SHEET, create=create),
+                        reopen=lambda: clients.reopen_worksheet(HISTORY_SHEET, create=create))
+
+# 履歴はローカルの SQLite 複製から読み、シートとは裏で差分同期する (シートが正本)
+@st.cache_resource
+def get_history_syncer():
+    clients = get_google_clients()
+    def spreadsheet_modified_time():
+        return clients.drive().files().get(fileId=SPREADSHEET_ID, fields="modifiedTime").execute()["modifiedTime"]
+    store = HistoryStore()
+    syncer = HistorySyncer(store, get_history_sheet(), modified_time_fn=spreadsheet_modified_time)
+    if store.is_empty:
+        syncer.sync_now(full=True)
+    return syncer.start()
 
 def save_match_data_to_sheet(df):
-    sheet = connect_to_gsheet()
-    try:
-        worksheet = sheet.worksheet("history")
-    except gspread.exceptions.WorksheetNotFound:
-        worksheet = sheet.add_worksheet(title="history", rows="1000", cols="20")
-    existing_data = worksheet.get_all_values()
-    data_to_write = df.astype(str).values.tolist()
-    if not existing_data:
-        header = df.columns.tolist()
-        worksheet.append_row(header)
-        worksheet.append_rows(data_to_write)
-    else:
-        worksheet.append_rows(data_to_write)
+    get_history_sheet().append(df)
+    get_history_syncer().request_sync()
 
-def overwrite_history_sheet(df):
-    sheet = connect_to_gsheet()
-    try:
-        worksheet = sheet.worksheet("history")
-    except gspread.exceptions.WorksheetNotFound:
-        worksheet = sheet.add_worksheet(title="history", rows="1000", cols="20")
-    worksheet.clear()
-    if not df.empty:
-        data = [df.columns.tolist()] + df.astype(str).values.tolist()
-        worksheet.update(data)
-
-def load_match_history():
-    sheet = connect_to_gsheet()
+# 試合入力の記録はローカルのログに即書きし、シートへは裏でまとめて送る (最初の記録時に作る)
+# シートへの接続は送信スレッドで初めて行う (Sheets に届かなくても記録はローカルに残る)
+def request_history_sync():
+    get_history_syncer().request_sync()
+
+def get_match_journal(create=True):
+    journal = st.session_state.match_journal
+    if journal is None and create:
+        journal = MatchJournal.create(get_history_sheet, on_flush=request_history_sync)
+        st.session_state.match_journal = journal
+    return journal
+
+def save_history_changes(df_before, df_after):
+    result = get_history_sheet().save_diff(df_before, df_after)
+    get_history_syncer().sync_now(full=True)
+    return result
+
+def load_match_history(typed=True):
     try:
-        worksheet = sheet.worksheet("history")
-        data = worksheet.get_all_values()
-        if not data: return pd.DataFrame()
-        headers = data[0]
-        if "Match" not in headers: return pd.DataFrame()
-        rows = data[1:]
-        if not rows: return pd.DataFrame(columns=headers)
-        return pd.DataFrame(rows, columns=headers)
+        return get_history_syncer().store.read(typed=typed)
     except Exception as e:
         return pd.DataFrame()
 
@@ -181,11 +226,13 @@ def sort_players_by_number(player_names):
         return int(match.group(1)) if match else 999
     return sorted(player_names, key=get_num)
 
-# --- コート画像を準備する関数 ---
+# --- コート画像を準備する関数 (デコード済みの画像をプロセス内で使い回す) ---
+@st.cache_resource
 def get_court_image():
     if os.path.exists("court.png"):
         try:
             img = Image.open("court.png")
+            img.load()
             return img
         except: pass
     img = Image.new('RGB', (500, 500), color='#FFCC99')
@@ -196,9 +243,68 @@ def get_court_image():
     img.save("court.png")
     return img
 
+@st.cache_resource
+def get_court_background():
+    return np.asarray(get_court_image().convert("RGB"))
+
+# フィルタ条件ごとに描画済みのPNGを保持する (_df はハッシュ対象外。中身の同一性は fingerprint で判定)
+@st.cache_data(max_entries=64, show_spinner=False)
+def render_setup_image(fingerprint, team, setter, mode, _df):
+    return render_setup_locations(_df, get_court_background(), ZONE_COLORS, mode=mode)
+
+# --- コート領域の設定 (カメラ設定ごと) と確認用の先頭フレーム ---
+@st.cache_resource
+def get_calibration_store():
+    return CalibrationStore()
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def first_frame(video_path, mtime):
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    ok, frame = cap.read()
+    cap.release()
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) if ok else None
+
+def draw_calibration(frame, region, end_line_percent_y, max_width=640):
+    img = Image.fromarray(frame)
+    draw = ImageDraw.Draw(img)
+    x0, y0, x1, y1 = region.to_pixels(img.width, img.height)
+    line_y = int(img.height * (end_line_percent_y / 100))
+    draw.rectangle([x0, y0, x1 - 1, y1 - 1], outline=(0, 255, 0), width=max(2, img.width // 300))
+    draw.line([0, line_y, img.width, line_y], fill=(255, 0, 0), width=max(2, img.width // 300))
+    if img.width > max_width:
+        img = img.resize((max_width, int(img.height * max_width / img.width)))
+    return img
+
+# --- 解析プロファイルの保存と表示 ---
+def save_analysis_profile(profiler, record, video_name):
+    # 推論結果と一緒にキャッシュされるよう record.meta に入れ、.cache/profiles にも JSON で残す
+    profiler.finish()
+    safe_name = re.sub(r"[^\w.-]", "_", os.path.splitext(video_name or "video")[0])[:40]
+    path, data = profiler.save(safe_name, {"video": video_name})
+    data["path"] = path
+    record.meta["profile"] = data
+
+def show_profile(placeholder, snap):
+    c = snap.get("counters", {})
+    tp = snap.get("throughput", {})
+    mem = snap.get("peak_memory_mb")
+    mem_shards = snap.get("peak_memory_shards_mb")
+    rows = sorted(({"Stage": k, "Total(s)": v["total_s"], "Calls": v["calls"], "Mean(ms)": v["mean_ms"]}
+                   for k, v in snap.get("stages", {}).items()), key=lambda r: -r["Total(s)"])
+    with placeholder.container():
+        st.caption(f"⏱ {snap.get('elapsed_s', 0):.1f}s / デコード {c.get('frames_decoded', 0)} "
+                   f"・推論 {c.get('frames_inferred', 0)} ・スキップ {c.get('frames_skipped', 0)} フレーム / "
+                   f"実効 {tp.get('inferred_fps', 0):.1f} FPS" + (f" / ピークメモリ {mem:.0f} MB" if mem else "")
+                   + (f" (シャード {mem_shards:.0f} MB)" if mem_shards else ""))
+        if rows: st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+
 # --- ステート管理 ---
-if 'players_db' not in st.session_state: st.session_state.players_db = load_players_from_sheet()
-if 'match_data' not in st.session_state: st.session_state.match_data = []
+# 名簿は裏で読み始めるだけにして、最初の描画を待たせない (必要な画面でだけ読み込みを待つ)
+if 'players_db' not in st.session_state: st.session_state.players_db = {}
+if 'players_version' not in st.session_state: st.session_state.players_version = 0
+get_roster_cache().prefetch()
+if 'match_journal' not in st.session_state: st.session_state.match_journal = None
 if 'my_service_order' not in st.session_state: st.session_state.my_service_order = []
 if 'op_service_order' not in st.session_state: st.session_state.op_service_order = []
 if 'my_libero' not in st.session_state: st.session_state.my_libero = "なし"
@@ -206,7 +312,11 @@ if 'op_libero' not in st.session_state: st.session_state.op_libero = "なし"
 if 'game_state' not in st.session_state: st.session_state.game_state = {"my_score": 0, "op_score": 0, "serve_rights": "My Team", "my_rot": 1, "op_rot": 1}
 if 'temp_coords' not in st.session_state: st.session_state.temp_coords = None
 if 'analysis_video_path' not in st.session_state: st.session_state.analysis_video_path = None
+if 'analysis_video_name' not in st.session_state: st.session_state.analysis_video_name = None
 if 'analysis_results' not in st.session_state: st.session_state.analysis_results = None
+if 'analysis_record' not in st.session_state: st.session_state.analysis_record = None
+if 'analysis_download' not in st.session_state: st.session_state.analysis_download = None
+if 'clip_export' not in st.session_state: st.session_state.clip_export = None
 
 def rotate_team(team_side):
     current = st.session_state.game_state[f"{team_side}_rot"]
@@ -255,7 +365,8 @@ with st.sidebar:
     app_mode = st.radio("メニュー", ["🎥 AI動作分析 (Drive)", "📊 試合入力", "📈 トス配給分析", "📝 履歴編集", "👤 チーム管理"])
     st.markdown("---")
     
-    # チーム選択
+    # チーム選択 (AI動作分析は名簿を使わないので読み込みを待たない)
+    load_players_from_sheet(wait=app_mode != "🎥 AI動作分析 (Drive)")
     team_list = list(st.session_state.players_db.keys())
     if team_list:
         my_team_name = st.selectbox("自チーム", team_list, index=0)
@@ -278,12 +389,16 @@ with st.sidebar:
 
     if app_mode == "📊 試合入力":
         if st.button("🏁 試合終了 (保存してリセット)"):
-            if st.session_state.match_data:
-                df = pd.DataFrame(st.session_state.match_data)
-                save_match_data_to_sheet(df)
-                st.toast("自動保存しました")
+            journal = get_match_journal(create=False)
+            if journal is not None:
+                try:
+                    sent = journal.finish()  # ほとんどは送信済みなので、残りの数行を送るだけ
+                except Exception as e:
+                    st.error(f"保存エラー: {e} (記録はローカルに残っています。もう一度押すと再送します)")
+                    st.stop()
+                st.toast(f"保存しました (全 {len(journal)} 件・最後に送信 {sent} 件)")
             st.session_state.game_state = {"my_score": 0, "op_score": 0, "serve_rights": "My Team", "my_rot": 1, "op_rot": 1}
-            st.session_state.match_data = []
+            st.session_state.match_journal = None
             st.session_state.my_service_order = []
             st.session_state.temp_coords = None
             st.success("リセット完了")
@@ -338,8 +453,17 @@ if app_mode == "👤 チーム管理":
 # --- モード2：データ分析 (復旧) ---
 elif app_mode == "📈 トス配給分析":
     st.header("📈 セッター配給分析 (Setter Distribution)")
-    df_session = pd.DataFrame(st.session_state.match_data)
+    journal = get_match_journal(create=False)
+    df_session = journal.table() if journal is not None else pd.DataFrame()
+    try:
+        # 読み込みより先に版を取る (読み込み中に同期が走っても古い版のキーに新しいデータが入るだけで済む)
+        history_version = get_history_syncer().store.version
+    except Exception:
+        history_version = None
     df_history = load_match_history()
+    # 試合中の行も裏でシートへ送られているので、履歴に取り込まれた分は二重に数えない
+    if not df_session.empty and ROW_ID_COL in df_history.columns:
+        df_session = df_session[~df_session[ROW_ID_COL].isin(df_history[ROW_ID_COL])]
     df_all = pd.concat([df_history, df_session], ignore_index=True)
     if df_all.empty:
         st.info("データがありません。")
@@ -359,57 +483,32 @@ elif app_mode == "📈 トス配給分析":
                     default_idx = temp_list.index(my_team_name)
                 sel_team = c_f1.selectbox("チーム", teams, index=default_idx)
                 df_filtered = df_all[df_all["Team"] == sel_team]
+                sel_setter = ALL_SETTERS
                 if "Setter" in df_filtered.columns:
                     setters_raw = [s for s in list(df_filtered["Setter"].unique()) if s != "なし"]
-                    setters = ["全員"] + setters_raw
+                    setters = [ALL_SETTERS] + setters_raw
                     sel_setter = c_f2.selectbox("分析対象セッター", setters)
-                    if sel_setter != "全員":
+                    if sel_setter != ALL_SETTERS:
                         df_filtered = df_filtered[df_filtered["Setter"] == sel_setter]
             if not df_filtered.empty and "Pass" in df_filtered.columns and "Zone" in df_filtered.columns:
                 st.markdown(f"### 📊 レセプション別 配給・決定率一覧 - {sel_setter}")
                 st.caption("配: 配給率 (本数シェア%) / 決: 決定率 (得点確率%)")
-                pass_counts = df_filtered["Pass"].value_counts()
-                stats = df_filtered.groupby(['Pass', 'Zone']).agg(
-                    attempts=('Result', 'count'),
-                    kills=('Result', lambda x: (x == '得点 (Kill)').sum())
-                ).reset_index()
-                table_data = []
-                valid_passes = [p for p in PASS_ORDER if p in df_filtered["Pass"].unique()]
-                for p_label in valid_passes:
-                    row = {"Pass": p_label}
-                    total_sets_in_pass = pass_counts.get(p_label, 0)
-                    for z_label in ZONE_ORDER:
-                        target = stats[(stats['Pass'] == p_label) & (stats['Zone'] == z_label)]
-                        if not target.empty:
-                            att = target.iloc[0]['attempts']
-                            kill = target.iloc[0]['kills']
-                            dist_rate = (att / total_sets_in_pass * 100) if total_sets_in_pass > 0 else 0
-                            kill_rate = (kill / att * 100) if att > 0 else 0
-                            row[f"{z_label} (配)"] = dist_rate
-                            row[f"{z_label} (決)"] = kill_rate
-                        else:
-                            row[f"{z_label} (配)"] = 0.0
-                            row[f"{z_label} (決)"] = 0.0
-                    table_data.append(row)
-                if table_data:
-                    df_matrix = pd.DataFrame(table_data).set_index("Pass")
+                # 全チーム・全セッター分を一度に集計してメモ化しておき、ここでは辞書から引くだけにする
+                fingerprint = ("history", history_version, data_fingerprint(df_session))
+                tables = distribution_tables(df_all, fingerprint if history_version is not None else None)
+                df_matrix = tables.get((str(sel_team), str(sel_setter)))
+                if df_matrix is not None and not df_matrix.empty:
                     st.dataframe(df_matrix.style.format("{:.1f}%"), use_container_width=True)
             
             st.markdown("---")
             st.markdown(f"### 🎯 セットアップ位置の散布図")
+            plot_mode = st.radio("表示", ["auto", "scatter", "heatmap"], horizontal=True,
+                                 format_func={"auto": "自動", "scatter": "散布図", "heatmap": "ヒートマップ"}.get)
+            st.caption(f"自動: {HEATMAP_AUTO_POINTS} 本を超えるとヒートマップで表示します。")
             try:
-                pil_img = get_court_image()
-                fig, ax = plt.subplots(figsize=(10, 6))
-                ax.imshow(pil_img, extent=[0, 500, 500, 0])
-                zones_in_data = df_filtered["Zone"].unique()
-                for zone in zones_in_data:
-                    if zone == "なし": continue
-                    subset = df_filtered[df_filtered["Zone"] == zone]
-                    color_info = ZONE_COLORS.get(zone, ("gray", zone))
-                    ax.scatter(subset["X"], subset["Y"], label=color_info[1], color=color_info[0], s=120, alpha=0.8, edgecolors='white')
-                ax.legend(loc='upper right')
-                ax.axis('off')
-                st.pyplot(fig)
+                fingerprint = ("history", history_version, data_fingerprint(df_session)) if history_version is not None else data_fingerprint(df_filtered)
+                png = render_setup_image(fingerprint, str(sel_team), str(sel_setter), plot_mode, df_filtered)
+                st.image(png, use_container_width=True)
             except Exception as e:
                 st.error(f"画像描画エラー: {e}")
 
@@ -420,6 +519,97 @@ elif app_mode == "🎥 AI動作分析 (Drive)":
     with st.expander("🛠 エンドラインの設定", expanded=True):
         end_line_percent_y = st.slider("エンドライン位置 (上端=0, 下端=100)", 0, 100, 80)
         st.caption(f"画面の上から {end_line_percent_y}% のラインを基準に、手前をサーブ、奥をスパイクと判定します。")
+        hit_distance = st.slider("打点判定距離 (ボールと手首の距離 px)", 20, 300, 100)
+        st.caption("解析後にこれらを変更しても再推論は行わず、保存済みの推論結果から即座に再判定します。")
+        # コート領域: カメラの設置ごとに一度決めて保存しておき、推論はこの範囲だけで行う
+        calib = get_calibration_store()
+        setup_name = st.selectbox("カメラ設定 (コート領域)", calib.names())
+        saved_region = calib.get(setup_name)
+        c_c1, c_c2 = st.columns(2)
+        court_x = c_c1.slider("コート領域 左右 (%)", 0, 100, (round(saved_region.left * 100), round(saved_region.right * 100)),
+                              key=f"court_x_{setup_name}")
+        court_y = c_c2.slider("コート領域 上下 (%)", 0, 100, (round(saved_region.top * 100), round(saved_region.bottom * 100)),
+                              key=f"court_y_{setup_name}")
+        court_region = CourtRegion(court_x[0] / 100, court_y[0] / 100, court_x[1] / 100, court_y[1] / 100)
+        if court_x[0] >= court_x[1] or court_y[0] >= court_y[1]:
+            st.warning("コート領域が空です。全画面で解析します。")
+            court_region = CourtRegion()
+        elif not (court_y[0] <= end_line_percent_y <= court_y[1]):
+            st.warning("エンドラインがコート領域の外にあります。")
+        crop = court_region.as_tuple()
+        st.caption("領域の外 (観客席・ベンチなど) は推論しません。座標は元の画面に戻して判定するので、エンドラインはそのまま使えます。")
+        c_c3, c_c4, c_c5 = st.columns([2, 1, 1])
+        new_setup = c_c3.text_input("設定名", value="" if setup_name == DEFAULT_SETUP else setup_name,
+                                    placeholder="例: 体育館A 2階ギャラリー")
+        if c_c4.button("💾 保存", disabled=not new_setup.strip() or new_setup.strip() == DEFAULT_SETUP):
+            calib.save(new_setup.strip(), court_region)
+            st.success(f"保存しました: {new_setup.strip()}")
+        if c_c5.button("🗑 削除", disabled=setup_name == DEFAULT_SETUP):
+            calib.delete(setup_name)
+            st.rerun()
+        calib_path = st.session_state.analysis_video_path
+        if calib_path and st.session_state.analysis_download is None and os.path.exists(calib_path):
+            frame0 = first_frame(calib_path, os.path.getmtime(calib_path))
+            if frame0 is not None:
+                st.image(draw_calibration(frame0, court_region, end_line_percent_y),
+                         caption="緑: コート領域 / 赤: エンドライン (ロード中の動画の先頭フレーム)")
+
+    with st.expander("⚙️ 解析エンジン設定"):
+        batch_size = st.number_input("バッチサイズ (1回の推論で処理するフレーム数)", 1, 32, 4)
+        st.caption("デコードと推論を並行して行い、Nフレームずつまとめて推論します。CPUコア数が多いほど大きめの値が有効です。")
+        use_shards = st.checkbox("並列シャード解析 (長時間動画向け・プレビューなし)")
+        num_workers = st.number_input("ワーカープロセス数", 1, os.cpu_count() or 1, max(1, (os.cpu_count() or 1) // 2), disabled=not use_shards)
+        st.caption("動画を時間区間に分割して複数プロセスで同時に解析します。結果は通常モードと同じになります "
+                   "(ボール追跡を使う場合は区間ごとに追跡をやり直すため、区間の境目付近の結果が少し変わります)。")
+        use_motion = st.checkbox("モーション適応サンプリング (静止区間をスキップ)")
+        c_m1, c_m2, c_m3 = st.columns(3)
+        motion_low = c_m1.number_input("静止しきい値 (変化した画素 %)", 0.0, 10.0, 0.01, step=0.005, format="%.3f", disabled=not use_motion)
+        motion_high = c_m2.number_input("高速プレーしきい値 (変化した画素 %)", 0.0, 100.0, 1.0, step=0.1, disabled=not use_motion)
+        idle_every = c_m3.number_input("静止時の間隔 (フレーム)", 1, 120, 15, disabled=not use_motion)
+        st.caption("縮小したフレームで明るさが変わった画素の割合で動きを測り、静止中は間引き、速いプレー中は毎フレーム解析します。"
+                   "引きのカメラでは選手やボールが小さく写るので、静止しきい値は小さめにしてください。")
+        motion_opts = {"low_threshold": motion_low, "high_threshold": motion_high, "idle_every": idle_every} if use_motion else None
+        use_tracker = st.checkbox("ボール追跡 (全画面のボール検出を間引く)")
+        c_t1, c_t2 = st.columns(2)
+        detect_every = c_t1.number_input("全画面検出の間隔 (処理フレーム)", 1, 30, DEFAULT_TRACKER["detect_every"], disabled=not use_tracker)
+        roi_size = c_t2.selectbox("追跡時の切り出しサイズ (px)", [0, 160, 256, 320], index=2, disabled=not use_tracker,
+                                  format_func=lambda v: "切り出さない (予測のみ)" if v == 0 else f"{v}")
+        st.caption("カルマンフィルタでボール位置を予測し、間のフレームは予測位置のまわりだけを検出します。見失ったときは全画面で探し直します。")
+        tracker_opts = {**DEFAULT_TRACKER, "detect_every": detect_every, "roi_size": roi_size} if use_tracker else None
+        imgsz = st.selectbox("推論サイズ (px)", [320, 480, 640, 960, 1280], index=2)
+        st.caption("モデルに入力する画像の長辺です。小さいほど速く、遠くの小さなボールは見落としやすくなります。コート領域で切り出すと同じサイズでも細かく見えます。")
+        imgsz = None if imgsz == 640 else imgsz   # 640 はモデルの既定値 (キャッシュキーを変えない)
+        backend = st.selectbox("推論バックエンド", list(BACKENDS), format_func=BACKEND_LABELS.get)
+        engine_settings = inference_settings(motion=motion_opts, backend=backend, tracker=tracker_opts, crop=crop, imgsz=imgsz,
+                                             batch_size=batch_size,
+                                             shards=num_workers if use_shards and st.session_state.analysis_download is None else None)
+        st.caption("ONNX / OpenVINO は初回に変換してサーバーに保存します (数分かかります)。INT8 は最速ですが精度が下がる場合があるので、下の精度チェックで確認してください。"
+                   "INT8 の変換ではキャリブレーション用のデータセット (coco8) をダウンロードするため、初回はネットワーク接続が必要です。")
+        if backend != DEFAULT_BACKEND and st.session_state.analysis_video_path and st.session_state.analysis_download is None:
+            if st.button("🔬 精度チェック (ロード中の動画の先頭30秒で PyTorch と比較)"):
+                with st.spinner("両方のバックエンドで解析中..."):
+                    try:
+                        st.session_state.backend_check = compare_backends(st.session_state.analysis_video_path, backend,
+                                                                          end_line_percent_y=end_line_percent_y, hit_distance=hit_distance,
+                                                                          batch_size=batch_size)
+                    except Exception as e:
+                        st.error(f"精度チェックエラー: {e}")
+        chk = st.session_state.get("backend_check")
+        if chk and chk["backend"] == backend:
+            st.caption(f"精度チェック ({BACKEND_LABELS[chk['backend']]}): イベント一致 {chk['matched_events']}/{chk['baseline_events']} "
+                       f"(再現率 {chk['recall']:.0%}・適合率 {chk['precision']:.0%}) / ボール検出一致 {chk['ball_agreement']:.0%} "
+                       f"/ 速度 {chk['speedup']}倍")
+        for srv_backend, server in running_servers().items():
+            st.caption(f"推論サーバー [{BACKEND_LABELS[srv_backend]}] (全セッション共有): " + " / ".join(
+                f"{name} 待ち {s['pending']}・平均バッチ {s['mean_batch']}・平均待ち {s['mean_wait_ms']} ms"
+                for name, s in server.stats().items()))
+
+    with st.expander("🖥 プレビュー設定"):
+        headless = st.checkbox("プレビューなし (ヘッドレス・最速)", value=False)
+        c_pv1, c_pv2 = st.columns(2)
+        preview_fps = c_pv1.number_input("プレビュー更新 (FPS上限, 0=無制限)", 0.0, 30.0, 5.0, step=1.0, disabled=headless)
+        preview_width = c_pv2.selectbox("プレビュー幅 (px)", [320, 480, 640, 960, 0], index=2, format_func=lambda w: "元解像度" if w == 0 else f"{w}", disabled=headless)
+        st.caption("描画と画像転送は解析時間の大きな割合を占めます。イベント表だけが必要ならヘッドレスを推奨します。")
 
     st.subheader("1. 動画選択")
     if st.button("🔄 リスト更新"): pass
@@ -427,127 +617,321 @@ elif app_mode == "🎥 AI動作分析 (Drive)":
     files = list_drive_files(TARGET_FOLDER_ID)
     
     if files:
-        file_options = {f['name']: f['id'] for f in files}
-        selected_filename = st.selectbox("解析する動画を選択", list(file_options.keys()))
+        store = get_video_store()
+        file_options = {f['id']: f for f in files}
+        selected_id = st.selectbox("解析する動画を選択", list(file_options.keys()),
+                                   format_func=lambda fid: ("💾 " if store.is_cached(file_options[fid]) else "☁️ ") + file_options[fid]['name'])
+        selected_file = file_options[selected_id]
+        selected_filename = selected_file['name']
+        st.caption(f"💾 = ローカル保存済み (即時ロード) / 使用容量 {store.usage_bytes() / 1e9:.1f} GB (上限 {store.max_bytes / 1e9:.0f} GB)")
+        
+        c_dl1, c_dl2 = st.columns(2)
+        chunk_mb = c_dl1.number_input("ダウンロードのチャンクサイズ (MB)", 1, 256, DEFAULT_CHUNK_SIZE // (1024 * 1024))
+        start_early = c_dl2.checkbox("ダウンロード完了を待たずに解析できるようにする", help="先頭にインデックス (moov) がある動画のみ。受信済みの部分から解析を始めます。")
         
         if st.button("📥 動画をロード (解析準備)", type="primary"):
-            with st.spinner("クラウドからダウンロード中..."):
-                file_id = file_options[selected_filename]
-                fh = download_file_from_drive(file_id)
-                tfile = tempfile.NamedTemporaryFile(delete=False, suffix=".mp4")
-                tfile.write(fh.read())
-                st.session_state.analysis_video_path = tfile.name
-                st.session_state.analysis_results = None
-                st.success(f"ロード完了: {selected_filename}")
+            st.session_state.analysis_results = None
+            st.session_state.analysis_record = None
+            st.session_state.analysis_video_name = selected_filename   # 解析・プロファイルはロードした動画の名前で残す
+            local_path = store.lookup(selected_file)
+            if local_path:
+                # 同じ版がローカルにあればダウンロードしない
+                st.session_state.analysis_download = None
+                st.session_state.analysis_video_path = local_path
+                st.success(f"ロード完了 (ローカル保存済み): {selected_filename}")
+            else:
+                dl = start_drive_download(selected_file, chunk_mb * 1024 * 1024)
+                st.session_state.analysis_download = dl
+                st.session_state.analysis_video_path = dl.dest_path
+            if not local_path and not start_early:
+                dl_bar = st.progress(0.0, text="クラウドからダウンロード中...")
+                while not dl.wait(0.5):
+                    dl_bar.progress(dl.progress, text=f"クラウドからダウンロード中... {dl.bytes_done / 1e6:.0f} MB")
+                if dl.error:
+                    st.error(f"ダウンロードエラー: {dl.error} (もう一度ロードすると続きから再開します)")
+                    st.session_state.analysis_video_path = None
+                else:
+                    store.commit(dl.dest_path)
+                    st.session_state.analysis_download = None
+                    dl_bar.progress(1.0, text="ダウンロード完了")
+                    st.success(f"ロード完了: {selected_filename}")
     else:
         st.warning("動画が見つかりません。Googleドライブにアップロードしてください。")
 
+    if files:
+        with st.expander("📋 バックグラウンド解析キュー (画面を閉じても続行)"):
+            runner = get_job_runner()
+            jobs = runner.store
+            job_settings = {"batch_size": batch_size, "motion": motion_opts, "use_shards": use_shards, "backend": backend,
+                            "tracker": tracker_opts, "crop": crop, "imgsz": imgsz,
+                            "num_workers": num_workers if use_shards else None}
+            st.caption("解析エンジン設定の内容でジョブを追加します。結果はサーバーに保存され、後から再推論なしで開けます。")
+            workers = st.number_input("同時に解析する動画数", 1, max(1, (os.cpu_count() or 1) // 2), runner.num_workers)
+            if workers != runner.num_workers: runner.set_workers(workers)
+            queue_ids = st.multiselect("キューに追加する動画", list(file_options.keys()), format_func=lambda fid: file_options[fid]['name'])
+            c_q1, c_q2 = st.columns(2)
+            if c_q1.button("➕ キューに追加", disabled=not queue_ids):
+                added = jobs.add_many([file_options[fid] for fid in queue_ids], job_settings)
+                runner.wake()
+                st.success(f"{len(added)} 件追加しました (解析済み・待機中のものは除く)")
+            if c_q2.button("🆕 フォルダ内の未解析動画をすべて追加"):
+                added = jobs.add_many(files, job_settings)
+                runner.wake()
+                st.success(f"{len(added)} 件追加しました")
+
+            @st.fragment(run_every=3)
+            def job_monitor():
+                # 進捗は DB から読むので、どのセッション・どのブラウザからでも同じ状態が見える
+                job_list = jobs.list()
+                if not job_list:
+                    st.caption("ジョブはありません。")
+                    return
+                st.dataframe(pd.DataFrame([{"動画": j["name"], "状態": STATUS_LABELS.get(j["status"], j["status"]),
+                                            "進捗": j["progress"] or 0.0, "詳細": j["error"] or j["message"],
+                                            "追加": datetime.datetime.fromtimestamp(j["created_at"]).strftime("%m/%d %H:%M")}
+                                           for j in job_list]),
+                             column_config={"進捗": st.column_config.ProgressColumn(min_value=0.0, max_value=1.0)},
+                             use_container_width=True, hide_index=True)
+            job_monitor()
+
+            job_list = jobs.list()
+            job_names = {j["id"]: f'{STATUS_LABELS.get(j["status"], j["status"])} {j["name"]}' for j in job_list}
+            sel_job = st.selectbox("ジョブ", list(job_names), format_func=job_names.get) if job_names else None
+            if sel_job:
+                c_j1, c_j2, c_j3 = st.columns(3)
+                if c_j1.button("📂 結果を開く", disabled=jobs.get(sel_job)["status"] != "done"):
+                    record = jobs.load_result(sel_job)
+                    if record is None:
+                        st.error("結果ファイルが見つかりません。もう一度キューに追加してください。")
+                    else:
+                        st.session_state.analysis_record = record
+                        st.session_state.analysis_results = None
+                        # ジョブの動画がローカルにあればそれをロードする (クリップはこの動画から切り出す)
+                        job = jobs.get(sel_job)
+                        job_video = get_video_store().lookup(job["file_meta"])
+                        if job_video:
+                            st.session_state.analysis_download = None
+                            st.session_state.analysis_video_path = job_video
+                            st.session_state.analysis_video_name = job["name"]
+                if c_j2.button("⏹ 中止"): jobs.cancel(sel_job)
+                if c_j3.button("🔁 再実行"):
+                    jobs.retry(sel_job)
+                    runner.wake()
+
+    loaded_path = st.session_state.analysis_video_path
+    if loaded_path and st.session_state.analysis_download is None:
+        if os.path.exists(loaded_path):
+            get_video_store().hold(loaded_path)   # 他のセッションの容量整理で消されないように
+        else:
+            st.session_state.analysis_video_path = None
+            st.warning("ロードした動画がサーバーから削除されていました。もう一度ロードしてください。")
+
     if st.session_state.analysis_video_path:
         st.markdown("---")
         st.subheader("2. 解析実行")
-        st.video(st.session_state.analysis_video_path)
+        dl = st.session_state.analysis_download
+        if dl is not None and dl.completed:
+            # 解析を先に始めていた場合もここで保存庫に登録する
+            get_video_store().commit(dl.dest_path)
+            st.session_state.analysis_download = dl = None
+        downloading = dl is not None
+        if downloading:
+            if dl.done:
+                st.error(f"ダウンロードエラー: {dl.error} (もう一度ロードすると続きから再開します)")
+            else:
+                st.progress(dl.progress, text=f"ダウンロード中... {dl.bytes_done / 1e6:.0f} MB (受信済みの部分から解析できます)")
+                if st.button("🔄 進捗を更新"): pass
+        elif os.path.getsize(st.session_state.analysis_video_path) <= VIDEO_PREVIEW_MAX_BYTES:
+            st.video(st.session_state.analysis_video_path)
+        else:
+            st.caption("動画が大きいためプレビューは省略しています。")
         
-        if st.button("🚀 AI解析スタート", type="primary"):
-            st.text("AIモデル起動中... (初回は時間がかかります)")
-            try:
-                pose_model, det_model, cv2 = load_models() # ここでImport
-                cap = cv2.VideoCapture(st.session_state.analysis_video_path)
-                st_frame = st.empty()
-                progress_bar = st.progress(0)
-                
-                width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                
-                detected_events = []
-                frame_count = 0
-                cooldown = 0
-                
-                while cap.isOpened():
-                    ret, frame = cap.read()
-                    if not ret: break
-                    frame_count += 1
-                    if cooldown > 0: cooldown -= 1
-                    
-                    if frame_count % 3 != 0: continue # 3フレームに1回処理
-                    
-                    # 1. ボール検出
-                    ball_results = det_model(frame, classes=[32], conf=0.3, verbose=False)
-                    ball_box = None
-                    if len(ball_results[0].boxes) > 0:
-                        box = ball_results[0].boxes[0]
-                        bx1, by1, bx2, by2 = box.xyxy[0].cpu().numpy()
-                        ball_cx, ball_cy = (bx1+bx2)/2, (by1+by2)/2
-                        ball_box = (ball_cx, ball_cy)
-                        cv2.circle(frame, (int(ball_cx), int(ball_cy)), 10, (0, 255, 255), -1)
-
-                    # 2. 骨格検知
-                    pose_results = pose_model(frame, conf=0.5, verbose=False)
-                    annotated_frame = pose_results[0].plot()
-                    action_text = ""
-                    
-                    if pose_results[0].keypoints is not None:
-                        keypoints = pose_results[0].keypoints.xy.cpu().numpy()
-                        for kpts in keypoints:
-                            if ball_box is None: continue
-                            nose = kpts[KP_NOSE]; r_wrist = kpts[KP_R_WRIST]; r_ankle = kpts[KP_R_ANKLE]
-                            if nose[0]==0 or r_wrist[0]==0: continue
-                            
-                            dist = math.hypot(ball_box[0] - r_wrist[0], ball_box[1] - r_wrist[1])
-                            
-                            if dist < 100 and r_wrist[1] < nose[1] and cooldown == 0:
-                                line_y = height * (end_line_percent_y / 100)
-                                timestamp = frame_count / 30.0
-                                if r_ankle[1] > line_y:
-                                    action = "SERVE"
-                                else:
-                                    action = "SPIKE"
-                                detected_events.append({"Time(s)": round(timestamp, 2), "Action": action, "Frame": frame_count})
-                                action_text = f"{action}!"
-                                cooldown = 20
-                                break
-                    
-                    if action_text:
-                        cv2.putText(annotated_frame, action_text, (50, 150), cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 255), 5)
+        start_clicked = st.button("🚀 AI解析スタート", type="primary", disabled=downloading and dl.done)
+        video_path = st.session_state.analysis_video_path
+        if start_clicked:
+            cache = get_inference_cache()
+            # 受信途中のファイルはハッシュが確定しないので、キャッシュは解析後に確定したファイルで引く
+            cache_key = None if downloading else make_cache_key(video_path, engine_settings)
+            cached = cache.get(cache_key) if cache_key else None
+            if cached is not None:
+                # 推論結果が残っていれば再推論せず、判定だけやり直す
+                cached.meta["video"] = video_fingerprint(video_path)
+                st.session_state.analysis_record = cached
+                st.success("キャッシュ済みの推論結果を使用しました (再推論なし)")
+            elif use_shards and not downloading:
+                st.text(f"{num_workers} プロセスで並列解析中... (各ワーカーがモデルを読み込みます)")
+                try:
+                    progress_bar = st.progress(0)
+                    profiler = AnalysisProfiler({"mode": "sharded", "num_workers": num_workers, "batch_size": batch_size,
+                                                 **engine_settings})
+                    record, sampling_stats = analyze_video_sharded(video_path, num_workers=num_workers, batch_size=batch_size,
+                                                                   motion=motion_opts, on_progress=progress_bar.progress,
+                                                                   profiler=profiler, backend=backend, tracker=tracker_opts,
+                                                                   crop=crop, imgsz=imgsz)
+                    record.meta["sampling"] = sampling_stats
+                    save_analysis_profile(profiler, record, st.session_state.analysis_video_name)
+                    record.meta["video"] = video_fingerprint(video_path)
+                    cache.put(cache_key, record)
+                    st.session_state.analysis_record = record
+                    st.success("解析完了！")
+                except Exception as e:
+                    st.error(f"解析エラー: {e}")
+            else:
+                st.text("AIモデル起動中... (初回は時間がかかります)")
+                try:
+                    pose_model, det_model, cv2 = load_models(backend) # ここでImport
+                    sampler = make_sampler(cv2, motion=motion_opts)
+                    tracker = make_tracker(tracker_opts)
+                    profiler = AnalysisProfiler({"mode": "pipeline", "batch_size": batch_size, "headless": headless,
+                                                 "preview_fps": preview_fps, "preview_width": preview_width,
+                                                 **engine_settings})
+                    pipeline = FramePipeline(dl.current_path() if downloading else video_path, det_model, pose_model, cv2,
+                                             batch_size=batch_size, sampler=sampler, follow=dl if downloading else None,
+                                             profiler=profiler, tracker=tracker, crop=crop, imgsz=imgsz)
+                    preview = PreviewPolicy(max_fps=preview_fps, max_width=preview_width, headless=headless)
+                    st_frame = st.empty()
+                    progress_bar = st.progress(0)
+                    st_counts = st.empty()
+                    st_profile = st.empty()
+                    last_profile_update = 0.0
                     
+                    height, total_frames = pipeline.height, pipeline.total_frames
+                    record = InferenceRecord({"width": pipeline.width, "height": height, "total_frames": total_frames,
+                                              "fps": pipeline.fps})
+                    detector = EventDetector(height, end_line_percent_y, fps=pipeline.fps, hit_distance=hit_distance)
                     line_y_int = int(height * (end_line_percent_y / 100))
-                    cv2.line(annotated_frame, (0, line_y_int), (width, line_y_int), (255, 0, 0), 3)
+                    last_pct = -1
                     
-                    st_frame.image(cv2.cvtColor(annotated_frame, cv2.COLOR_BGR2RGB), use_container_width=True)
-                    if total_frames > 0:
-                        progress_bar.progress(min(frame_count / total_frames, 1.0))
-                
-                cap.release()
-                if detected_events:
-                    st.session_state.analysis_results = pd.DataFrame(detected_events)
-                else:
-                    st.session_state.analysis_results = pd.DataFrame(columns=["Time(s)", "Action", "Frame"])
-                st.success("解析完了！")
-            except Exception as e:
-                st.error(f"解析エラー: {e}")
+                    # デコード・推論は別スレッドで先行し、ここでは判定と描画だけを行う
+                    for res in pipeline:
+                        record.add(res.frame_idx, res.ball, res.keypoints, res.ball_track, res.time_s)
+                        with profiler.stage("events"):
+                            action = detector.update(res.frame_idx, res.ball, res.keypoints, res.time_s)
+                        if action:
+                            st_counts.caption(f"検出イベント: {len(detector.events)} 件")
+                        if preview.should_render():
+                            with profiler.stage("plot"):
+                                preview_img = render_preview(cv2, res, action, line_y_int, preview.max_width)
+                            with profiler.stage("st_image"):
+                                st_frame.image(preview_img, use_container_width=True)
+                        if total_frames > 0:
+                            pct = min(int(res.frame_idx * 100 / total_frames), 100)
+                            if pct != last_pct:
+                                progress_bar.progress(pct / 100)
+                                last_pct = pct
+                        if time.monotonic() - last_profile_update >= 1.0:
+                            show_profile(st_profile, profiler.snapshot())
+                            last_profile_update = time.monotonic()
+                    
+                    record.meta["sampling"] = sampler.stats
+                    record.meta["height"] = pipeline.height
+                    if tracker is not None: tracker.report(profiler)
+                    save_analysis_profile(profiler, record, st.session_state.analysis_video_name)
+                    show_profile(st_profile, record.meta["profile"])
+                    if cache_key is None and dl.completed:
+                        cache_key = make_cache_key(video_path, engine_settings)
+                    if cache_key:
+                        record.meta["video"] = video_fingerprint(video_path)
+                        cache.put(cache_key, record)
+                    st.session_state.analysis_record = record
+                    st.success("解析完了！")
+                except Exception as e:
+                    st.error(f"解析エラー: {e}")
 
-        if st.session_state.analysis_results is not None:
-            st.markdown("---")
-            st.subheader("📊 解析結果")
-            df = st.session_state.analysis_results
-            if not df.empty:
-                counts = df["Action"].value_counts()
-                c1, c2, c3 = st.columns(3)
-                c1.metric("総アクション数", len(df))
-                c2.metric("🏐 サーブ", counts.get("SERVE", 0))
-                c3.metric("💥 スパイク", counts.get("SPIKE", 0))
-                st.dataframe(df, use_container_width=True)
-                csv = df.to_csv(index=False).encode('utf-8')
-                st.download_button("📥 CSVで保存", csv, "stats.csv", "text/csv")
-                if st.button("☁️ Google Sheetsに保存"):
-                    save_match_data_to_sheet(df)
-            else:
-                st.info("アクションは検出されませんでした。")
+    # イベント判定は毎回キャッシュ済みの推論結果からやり直す (スライダー変更で再推論しない)
+    record = st.session_state.analysis_record
+    if record is not None:
+        line_y = record.meta.get("height", 0) * (end_line_percent_y / 100)
+        events = classify_record(record, line_y, hit_distance=hit_distance)
+        st.session_state.analysis_results = pd.DataFrame(events, columns=EVENT_COLUMNS)
+
+    if st.session_state.analysis_results is not None:
+        st.markdown("---")
+        st.subheader("📊 解析結果")
+        df = st.session_state.analysis_results
+        ss = record.meta.get("sampling") if record is not None else None
+        if ss and ss.get("frames_decoded"):
+            st.caption(f"フレーム: 全 {ss['frames_decoded']} / 推論 {ss['frames_sampled']} / スキップ {ss['frames_skipped']} "
+                       f"({ss['frames_skipped'] / ss['frames_decoded']:.0%})")
+        prof = record.meta.get("profile") if record is not None else None
+        if prof:
+            with st.expander("⏱ 処理時間の内訳 (プロファイル)"):
+                show_profile(st.container(), prof)
+                st.download_button("📥 プロファイル (JSON)", json.dumps(prof, ensure_ascii=False, indent=2),
+                                   "profile.json", "application/json")
+        if not df.empty:
+            counts = df["Action"].value_counts()
+            c1, c2, c3 = st.columns(3)
+            c1.metric("総アクション数", len(df))
+            c2.metric("🏐 サーブ", counts.get("SERVE", 0))
+            c3.metric("💥 スパイク", counts.get("SPIKE", 0))
+            st.dataframe(df, use_container_width=True)
+            csv = df.to_csv(index=False).encode('utf-8')
+            st.download_button("📥 CSVで保存", csv, "stats.csv", "text/csv")
+            if record is not None:
+                st.download_button("📥 ボール軌跡 (CSV)", trajectory_frame(record).to_csv(index=False).encode('utf-8'),
+                                   "ball_trajectory.csv", "text/csv")
+            clip_video = st.session_state.analysis_video_path
+            clip_ready = clip_video and st.session_state.analysis_download is None and os.path.exists(clip_video)
+            if clip_ready and record is not None and record.meta.get("video") != video_fingerprint(clip_video):
+                # 「結果を開く」で別の動画の結果を表示しているときは、ロード中の動画から切り出さない
+                clip_ready = False
+                st.caption("表示中の結果はロード中の動画のものではないため、クリップは書き出せません (元の動画をロードしてください)。")
+            if clip_ready:
+                with st.expander("🎬 イベントクリップの書き出し"):
+                    c_e1, c_e2, c_e3 = st.columns(3)
+                    clip_before = c_e1.number_input("イベント前 (秒)", 0.0, 10.0, 2.0, step=0.5)
+                    clip_after = c_e2.number_input("イベント後 (秒)", 0.5, 15.0, 3.0, step=0.5)
+                    clip_actions = c_e3.multiselect("種類", sorted(df["Action"].unique()), default=sorted(df["Action"].unique()))
+                    st.caption("ロード中の動画から切り出します。直前のキーフレームから再エンコードせずにコピーするので、"
+                               "開始が指定より少し早くなることがあります。" if ffmpeg_available() else
+                               "ffmpeg が無いため、クリップ区間だけを読み直して書き出します (音声なし・低速)。")
+                    if st.button("✂️ クリップを書き出し"):
+                        out_dir = os.path.join(CLIP_DIR, video_fingerprint(clip_video)[:16])
+                        shutil.rmtree(out_dir, ignore_errors=True)
+                        selected = df[df["Action"].isin(clip_actions)].to_dict("records")
+                        try:
+                            clip_bar = st.progress(0.0)
+                            t0 = time.perf_counter()
+                            clips = export_clips(clip_video, selected, out_dir, clip_before, clip_after,
+                                                 on_progress=clip_bar.progress)
+                            reel = highlight_reel(clips, os.path.join(out_dir, "highlights.mp4"))
+                            st.session_state.clip_export = {"video": clip_video, "clips": clips, "reel": reel,
+                                                            "zip": zip_clips(clips, os.path.join(out_dir, "clips.zip")),
+                                                            "elapsed_s": time.perf_counter() - t0}
+                        except Exception as e:
+                            st.error(f"クリップ書き出しエラー: {e}")
+                    exported = st.session_state.clip_export
+                    if exported and exported["video"] == clip_video and exported["clips"]:
+                        copied = sum(c["mode"] == "copy" for c in exported["clips"])
+                        st.caption(f"{len(exported['clips'])} 本を {exported['elapsed_s']:.1f} 秒で書き出しました "
+                                   f"(再エンコードなし {copied} 本)")
+                        c_d1, c_d2 = st.columns(2)
+                        with open(exported["zip"], "rb") as f:
+                            c_d1.download_button("📦 クリップ一式 (ZIP)", f, "clips.zip", "application/zip")
+                        if exported["reel"]:
+                            with open(exported["reel"], "rb") as f:
+                                c_d2.download_button("🎞 ハイライト (1本につなげた動画)", f, "highlights.mp4", "video/mp4")
+                        clip_names = {c["path"]: f'{c["time"]:.1f}s {c["action"]}' for c in exported["clips"]}
+                        clip_path = st.selectbox("クリップを再生", list(clip_names), format_func=clip_names.get)
+                        st.video(clip_path)
+            if st.button("☁️ Google Sheetsに保存"):
+                save_match_data_to_sheet(df)
+        else:
+            st.info("アクションは検出されませんでした。")
 
 # --- モード4：履歴編集 (復旧) ---
 elif app_mode == "📝 履歴編集":
     st.header("📝 履歴データの閲覧・編集")
-    df_all = load_match_history()
+    syncer = get_history_syncer()
+    c_sync1, c_sync2 = st.columns([3, 1])
+    if syncer.last_sync:
+        c_sync1.caption(f"最終同期: {datetime.datetime.fromtimestamp(syncer.last_sync):%H:%M:%S} (シートの直接編集は自動で取り込まれます)")
+    if syncer.last_error:
+        c_sync1.warning(f"同期エラー: {syncer.last_error}")
+    if c_sync2.button("🔄 シートから再読込"):
+        syncer.sync_now(full=True)
+    df_all = load_match_history(typed=False)
     if df_all.empty:
         st.info("保存されたデータがまだありません。")
     else:
@@ -556,18 +940,33 @@ elif app_mode == "📝 履歴編集":
             selected_match = st.selectbox("編集する試合を選択", match_list)
             df_match = df_all[df_all["Match"] == selected_match].copy()
             st.write(f"▼ {selected_match} のデータ")
-            edited_df = st.data_editor(df_match, num_rows="dynamic", use_container_width=True, key="editor")
+            edited_df = st.data_editor(df_match, num_rows="dynamic", use_container_width=True, key="editor",
+                                       column_config={ROW_ID_COL: None})
             if st.button("💾 変更を保存"):
-                df_others = df_all[df_all["Match"] != selected_match]
-                df_new_all = pd.concat([df_others, edited_df], ignore_index=True)
-                overwrite_history_sheet(df_new_all)
-                st.success("保存しました！")
+                # 変更のあった行だけを送る (シート全体の消去・再アップロードはしない)
+                result = save_history_changes(df_match, edited_df)
+                st.success(f"保存しました！ (更新 {result['updated']} / 追加 {result['inserted']} / 削除 {result['deleted']} 行)")
+                if result["missing"]:
+                    st.warning(f"{result['missing']} 行は他の人の編集でシート上から見つからなかったため反映していません。")
                 st.rerun()
         else: st.error("Match列なし")
 
 # --- モード5：試合入力 (復旧) ---
 elif app_mode == "📊 試合入力":
     image = get_court_image()
+    others = unfinished_journals()
+    if others:
+        with st.expander(f"⚠ 試合終了していない記録があります ({len(others)} 件)"):
+            st.caption("サーバーの再起動などで中断された試合の記録です。再開すると未送信の行をシートへ送り、続きから入力できます。")
+            for path, mtime, rows in others:
+                c_r1, c_r2 = st.columns([3, 1])
+                c_r1.write(f"{datetime.datetime.fromtimestamp(mtime):%m/%d %H:%M} 最終記録 / {rows} 件")
+                if c_r2.button("▶ 再開", key=f"resume_{os.path.basename(path)}"):
+                    try:
+                        st.session_state.match_journal = MatchJournal.load(path, get_history_sheet, request_history_sync)
+                        st.rerun()
+                    except RuntimeError as e:
+                        st.error(str(e))
     col_sc, col_mn, col_lg = st.columns([0.8, 1.2, 0.8])
     with col_sc:
         gs = st.session_state.game_state
@@ -612,13 +1011,20 @@ elif app_mode == "📊 試合入力":
                     "X": st.session_state.temp_coords["x"],
                     "Y": st.session_state.temp_coords["y"]
                 }
-                st.session_state.match_data.append(rec)
-                st.toast("記録しました！")
+                try:
+                    get_match_journal().record(rec)
+                    st.toast("記録しました！")
+                except RuntimeError as e:
+                    # 別の画面で試合終了された記録など: 新しい記録を作って入力し直してもらう
+                    st.session_state.match_journal = None
+                    st.error(f"{e} (新しい試合として記録し直してください)")
             else:
                 st.error("コートをタップしてください")
 
     with col_lg:
         st.header("3. Log")
-        if st.session_state.match_data:
-            df = pd.DataFrame(st.session_state.match_data)
-            st.dataframe(df.iloc[::-1], height=300, hide_index=True)
+        journal = get_match_journal(create=False)
+        if journal is not None and len(journal):
+            st.dataframe(journal.table().iloc[::-1], height=300, hide_index=True, column_config={ROW_ID_COL: None})
+            st.caption(f"シート未送信: {len(journal.pending)} 件" + (f" / 送信エラー: {journal.last_error} (自動で再送します)"
+                                                                  if journal.last_error else ""))
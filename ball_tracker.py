@@ -0,0 +1,180 @@
+import numpy as np
+
+SOURCE_DETECT = 0    # 全画面での検出
+SOURCE_ROI = 1       # 予測位置まわりの切り出し画像での検出
+SOURCE_PREDICT = 2   # 検出なし (カルマンフィルタの予測位置)
+SOURCE_NAMES = {SOURCE_DETECT: "detect", SOURCE_ROI: "roi", SOURCE_PREDICT: "predict"}
+
+DEFAULT_TRACKER = {"detect_every": 5, "roi_size": 256, "min_conf": 0.4, "max_predict": 3}
+
+
+# --- 等速モデルのカルマンフィルタ (状態: x, y, vx, vy / 単位: px, px/フレーム) ---
+class KalmanFilter2D:
+    def __init__(self, x, y, process_noise=30.0, measurement_noise=4.0):
+        self.state = np.array([x, y, 0.0, 0.0])
+        self.cov = np.diag([measurement_noise ** 2] * 2 + [50.0 ** 2] * 2)
+        self.q = process_noise
+        self.r = measurement_noise
+
+    def predicted(self, dt):
+        return self.state[:2] + self.state[2:] * dt
+
+    def predict(self, dt):
+        f = np.eye(4)
+        f[0, 2] = f[1, 3] = dt
+        # 加速度をノイズとして扱う (ボールは打たれると急に向きが変わる)
+        g = np.array([[dt ** 2 / 2, 0], [0, dt ** 2 / 2], [dt, 0], [0, dt]])
+        self.state = f @ self.state
+        self.cov = f @ self.cov @ f.T + g @ g.T * self.q ** 2
+
+    def update(self, x, y):
+        h = np.zeros((2, 4))
+        h[0, 0] = h[1, 1] = 1.0
+        s = h @ self.cov @ h.T + np.eye(2) * self.r ** 2
+        k = self.cov @ h.T @ np.linalg.inv(s)
+        self.state = self.state + k @ (np.array([x, y]) - h @ self.state)
+        self.cov = (np.eye(4) - k @ h) @ self.cov
+
+    @property
+    def uncertainty(self):
+        return float(np.sqrt(self.cov[0, 0] + self.cov[1, 1]))
+
+
+def _candidates(ball_result, offset=(0, 0)):
+    # 検出されたボール候補すべての中心と信頼度 (切り出し画像の場合は元画像の座標に戻す)
+    if len(ball_result.boxes) == 0:
+        return np.zeros((0, 2)), np.zeros(0)
+    xyxy = ball_result.boxes.xyxy.cpu().numpy()
+    conf = ball_result.boxes.conf.cpu().numpy()
+    centers = np.stack([(xyxy[:, 0] + xyxy[:, 2]) / 2 + offset[0], (xyxy[:, 1] + xyxy[:, 3]) / 2 + offset[1]], axis=1)
+    return centers, conf
+
+
+# --- ボール追跡: 全画面検出は k フレームごと (または見失ったとき) だけにし、間は切り出し検出か予測で埋める ---
+class BallTracker:
+    def __init__(self, detect_every=5, roi_size=256, min_conf=0.4, max_predict=3, gate=None):
+        # detect_every: 全画面検出の間隔 (処理フレーム数) / roi_size: 切り出しの一辺 px (0 なら切り出し検出もせず予測のみ)
+        # min_conf: これ未満の信頼度が続いたら次は全画面検出 / max_predict: 検出なしで予測位置を出し続ける最大フレーム数
+        self.detect_every = max(1, int(detect_every))
+        self.roi_size = int(roi_size)
+        self.min_conf = min_conf
+        self.max_predict = max_predict
+        self.gate = gate or max(self.roi_size / 2, 80)
+        self.kf = None
+        self.last_frame = None
+        self.last_conf = 0.0
+        self.misses = 0
+        self.since_full = 0
+        # 検出方法ごとのフレーム数 (全画面 / 切り出し / 検出なし) と結果 (検出 / 予測で補完 / 見失い)
+        self.stats = {"full_frames": 0, "roi_frames": 0, "no_detect_frames": 0, "detected": 0, "predicted": 0,
+                      "lost": 0, "full_calls": 0, "roi_calls": 0}
+
+    def report(self, profiler):
+        # 追跡の統計をプロファイルのカウンタに足す (シャード解析ではワーカーごとの値が合算される)
+        for k, v in self.stats.items(): profiler.count(f"tracker_{k}", v)
+
+    @property
+    def locked(self):
+        return self.kf is not None and self.misses == 0 and self.last_conf >= self.min_conf
+
+    def _plan(self, n):
+        # バッチ内の各フレームを全画面検出するか (True) を、バッチ開始時点の状態で決める
+        plan = []
+        since = self.since_full
+        locked = self.locked
+        for _ in range(n):
+            full = not locked or since + 1 >= self.detect_every
+            plan.append(full)
+            since = 0 if full else since + 1
+        return plan
+
+    def _crop(self, frame, center):
+        h, w = frame.shape[:2]
+        size = min(self.roi_size, w, h)
+        x0 = int(np.clip(center[0] - size / 2, 0, w - size))
+        y0 = int(np.clip(center[1] - size / 2, 0, h - size))
+        return frame[y0:y0 + size, x0:x0 + size], (x0, y0)
+
+    def process(self, det_model, batch, det_kwargs):
+        # batch: [(frame_idx, frame), ...] → [(ball または None, (vx, vy, 取得方法)), ...]
+        plan = self._plan(len(batch))
+        measured = [None] * len(batch)   # (候補の中心, 信頼度, 取得方法)
+        full_idx = [i for i, full in enumerate(plan) if full]
+        if full_idx:
+            results = det_model([batch[i][1] for i in full_idx], **det_kwargs)
+            self.stats["full_calls"] += 1
+            for i, r in zip(full_idx, results):
+                measured[i] = (*_candidates(r), SOURCE_DETECT)
+        roi_idx = [i for i, full in enumerate(plan) if not full]
+        if roi_idx and self.roi_size > 0:
+            crops, offsets = [], []
+            for i in roi_idx:
+                crop, offset = self._crop(batch[i][1], self.kf.predicted(batch[i][0] - self.last_frame))
+                crops.append(crop)
+                offsets.append(offset)
+            results = det_model(crops, **{**det_kwargs, "imgsz": self.roi_size})
+            self.stats["roi_calls"] += 1
+            for i, r, offset in zip(roi_idx, results, offsets):
+                measured[i] = (*_candidates(r, offset), SOURCE_ROI)
+        return [self._step(frame_idx, m) for (frame_idx, _), m in zip(batch, measured)]
+
+    def _step(self, frame_idx, measurement):
+        if self.kf is not None:
+            self.kf.predict(frame_idx - self.last_frame)
+        self.last_frame = frame_idx
+        if measurement is None:
+            # 検出器を走らせないフレーム (roi_size=0): 予測位置をそのまま使う
+            self.stats["no_detect_frames"] += 1
+            self.since_full += 1
+            if self.kf is None:
+                self.stats["lost"] += 1
+                return None, None
+            self.stats["predicted"] += 1
+            return tuple(map(float, self.kf.state[:2])), (*self.kf.state[2:], SOURCE_PREDICT)
+
+        centers, conf, source = measurement
+        self.stats["full_frames" if source == SOURCE_DETECT else "roi_frames"] += 1
+        self.since_full = 0 if source == SOURCE_DETECT else self.since_full + 1
+        tracking = self.kf is not None and self.misses <= self.max_predict
+        pick = None
+        if len(centers):
+            if not tracking:
+                pick = int(np.argmax(conf))   # 追跡していないときは一番確かな候補
+            else:
+                # 予測位置に最も近い候補 (ゲート外なら誤検出として捨てる)
+                dist = np.linalg.norm(centers - self.kf.state[:2], axis=1)
+                if dist.min() <= self.gate + self.kf.uncertainty: pick = int(np.argmin(dist))
+        if pick is not None:
+            x, y = centers[pick]
+            if tracking: self.kf.update(x, y)
+            else: self.kf = KalmanFilter2D(x, y)
+            self.misses = 0
+            self.last_conf = float(conf[pick])
+            self.stats["detected"] += 1
+            return (float(x), float(y)), (*self.kf.state[2:], source)
+
+        self.misses += 1
+        self.last_conf = 0.0
+        if self.kf is None or self.misses > self.max_predict:
+            self.stats["lost"] += 1
+            return None, None
+        self.stats["predicted"] += 1
+        return tuple(map(float, self.kf.state[:2])), (*self.kf.state[2:], SOURCE_PREDICT)
+
+
+def make_tracker(options=None):
+    # options: BallTracker の引数 dict (プロセス間・キャッシュキーに渡せるよう dict で持つ)。None なら追跡しない
+    if options is None: return None
+    return BallTracker(**options)
+
+
+def trajectory_frame(record):
+    # 解析結果からボール軌跡の表を作る (追跡なしの解析では速度・取得方法は空)
+    import pandas as pd
+    frame_idx, ball, _, _ = record.arrays()
+    track = np.array([(np.nan,) * 3 if t is None else t for t in record.track], dtype=float).reshape(-1, 3) \
+        if len(record.track) == len(frame_idx) else np.full((len(frame_idx), 3), np.nan)
+    return pd.DataFrame({
+        "Frame": frame_idx, "X": ball[:, 0], "Y": ball[:, 1], "VX": track[:, 0], "VY": track[:, 1],
+        "Source": [SOURCE_NAMES.get(int(s), "") if not np.isnan(s) else "" for s in track[:, 2]],
+    })
@@ -0,0 +1,412 @@
+# --- オフライン・ベンチマーク (実際の Drive 動画・スプレッドシート不要) ---
+#   python benchmark.py                      # 全項目 (video / sheets / setter)
+#   python benchmark.py --quick              # 小さめの設定で短時間に
+#   python benchmark.py --only sheets,setter --latency 0.2
+#   python benchmark.py --skip-inference     # モデルを使わずデコードと間引きだけを測る
+# 結果は JSON (既定: .cache/benchmarks/<日時>.json) に書き出し、実行ごとに比較できるようにする
+import argparse
+import json
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from ball_tracker import DEFAULT_TRACKER
+from profiler import AnalysisProfiler, environment_info, peak_memory_mb
+
+REPORT_DIR = os.path.join(".cache", "benchmarks")
+VIDEO_CASES = [(640, 360, 10), (1280, 720, 10), (1920, 1080, 10), (1280, 720, 60)]   # (幅, 高さ, 秒)
+VIDEO_CASES_QUICK = [(640, 360, 3), (1280, 720, 3)]
+SHEET_ROWS = [1_000, 10_000, 50_000]
+SHEET_ROWS_QUICK = [1_000, 5_000]
+SETTER_ROWS = [1_000, 10_000, 100_000, 1_000_000]
+SETTER_ROWS_QUICK = [1_000, 10_000, 100_000]
+
+
+def _timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, round(time.perf_counter() - t0, 4)
+
+
+# --- 1. 合成動画での解析パイプライン ---
+def make_synthetic_video(path, width, height, seconds, fps=30, seed=0):
+    # コート風の背景の上をボールが放物線で往復し、人物大の矩形が動く「試合っぽい」動画
+    import cv2
+    rng = np.random.default_rng(seed)
+    base = np.full((height, width, 3), (60, 120, 180), np.uint8)
+    line_y = int(height * 0.8)
+    cv2.rectangle(base, (width // 10, height // 10), (width * 9 // 10, line_y), (230, 230, 230), max(2, width // 320))
+    cv2.line(base, (0, height // 2), (width, height // 2), (255, 255, 255), max(2, width // 320))
+    players = rng.uniform([0.15, 0.3], [0.85, 0.85], size=(6, 2)) * (width, height)
+    pw, ph = max(8, width // 40), max(20, height // 8)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    for i in range(int(seconds * fps)):
+        frame = base.copy()
+        players += rng.normal(0, width / 400, players.shape)
+        for x, y in players.astype(int):
+            cv2.rectangle(frame, (x - pw // 2, y - ph), (x + pw // 2, y), (40, 40, 160), -1)
+        # ラリー (2秒) と静止 (1秒) を繰り返す: モーション適応サンプリングの効果も見えるように
+        phase = i % (3 * fps)
+        if phase < 2 * fps:
+            t = phase / (2 * fps)
+            bx = int(width * (0.2 + 0.6 * t))
+            by = int(height * (0.75 - 0.6 * np.sin(np.pi * t)))
+            cv2.circle(frame, (bx, by), max(4, width // 120), (255, 255, 255), -1)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def _decode_only(cv2, path, sampler, profiler):
+    # 推論なし: デコードと間引き判定だけのコスト (推論以外の下限) を測る
+    cap = cv2.VideoCapture(path)
+    frame_idx = sampled = 0
+    while True:
+        with profiler.stage("decode"):
+            ret, frame = cap.read()
+        if not ret: break
+        frame_idx += 1
+        profiler.count("frames_decoded")
+        with profiler.stage("sample"):
+            take = sampler.decide(frame_idx, frame)
+        profiler.count("frames_inferred" if take else "frames_skipped")
+        sampled += take
+    cap.release()
+    return sampled
+
+
+def bench_video(cases, batch_size=4, motion=None, skip_inference=False, workdir=None, backend="pytorch", tracker=None,
+                imgsz=None):
+    import cv2
+    from ball_tracker import make_tracker
+    from video_pipeline import FramePipeline, make_sampler, load_yolo_models, classify_record
+    from inference_cache import InferenceRecord
+
+    if not skip_inference:
+        (pose_model, det_model, _), load_s = _timed(load_yolo_models, backend)
+
+    results = []
+    workdir = workdir or tempfile.mkdtemp(prefix="vb_bench_")
+    for width, height, seconds in cases:
+        path = os.path.join(workdir, f"synthetic_{width}x{height}_{seconds}s.mp4")
+        if not os.path.exists(path):
+            make_synthetic_video(path, width, height, seconds)
+        profiler = AnalysisProfiler({"batch_size": batch_size, "motion": motion, "backend": backend, "tracker": tracker,
+                                     "imgsz": imgsz})
+        if skip_inference:
+            frames = _decode_only(cv2, path, make_sampler(cv2, motion=motion), profiler)
+            events = None
+        else:
+            pipeline = FramePipeline(path, det_model, pose_model, cv2, batch_size=batch_size,
+                                     sampler=make_sampler(cv2, motion=motion), profiler=profiler,
+                                     tracker=make_tracker(tracker), imgsz=imgsz)
+            record = InferenceRecord({"height": pipeline.height})
+            for res in pipeline:
+                record.add(res.frame_idx, res.ball, res.keypoints, res.ball_track)
+            if pipeline.tracker is not None: pipeline.tracker.report(profiler)
+            frames = len(record)
+            events = len(classify_record(record, pipeline.height * 0.8))
+        profiler.finish()
+        snap = profiler.snapshot()
+        results.append({"width": width, "height": height, "seconds": seconds, "frames_processed": frames,
+                        "events": events, "elapsed_s": snap["elapsed_s"],
+                        "realtime_factor": round(seconds / snap["elapsed_s"], 3) if snap["elapsed_s"] else None,
+                        "stages": snap["stages"], "counters": snap["counters"], "throughput": snap["throughput"]})
+        print(f"  video {width}x{height} {seconds}s: {snap['elapsed_s']:.2f}s {snap['throughput']}")
+    report = {"cases": results, "skip_inference": skip_inference, "backend": backend}
+    if not skip_inference: report["model_load_s"] = load_s
+    return report
+
+
+# --- 2. 履歴シートの読み書き (gspread の代わりにメモリ上のシートを使い、API 呼び出しごとに遅延を入れる) ---
+class FakeWorksheet:
+    # HistorySheet / HistoryStore が使う gspread.Worksheet のメソッドだけを持つ
+    def __init__(self, latency=0.1, cols=20):
+        self.latency = latency
+        self.rows = []
+        self.col_count = cols
+        self.id = 0
+        self.calls = 0
+        self.spreadsheet = _FakeSpreadsheet(self)
+
+    def _call(self):
+        self.calls += 1
+        if self.latency: time.sleep(self.latency)
+
+    def row_values(self, i):
+        self._call()
+        return list(self.rows[i - 1]) if len(self.rows) >= i else []
+
+    def add_cols(self, n):
+        self._call()
+        self.col_count += n
+
+    def update(self, range_name=None, values=None):
+        self._call()
+        if values is None:  # update(values) の形: シート全体の書き込み
+            self.rows = [list(r) for r in range_name]
+            return
+        start = int(re.match(r"[A-Z]+(\d+)", range_name).group(1))
+        for offset, row in enumerate(values):
+            while len(self.rows) < start + offset: self.rows.append([])
+            self.rows[start + offset - 1] = list(row)
+
+    def append_rows(self, rows):
+        self._call()
+        self.rows.extend(list(r) for r in rows)
+
+    def clear(self):
+        self._call()
+        self.rows = []
+
+    def get_all_values(self):
+        self._call()
+        return [list(r) for r in self.rows]
+
+    def get(self, range_name):
+        self._call()
+        start = int(re.match(r"[A-Z]+(\d+)", range_name).group(1))
+        return [list(r) for r in self.rows[start - 1:]]
+
+    def col_values(self, col):
+        self._call()
+        return [r[col - 1] if len(r) >= col else "" for r in self.rows]
+
+    def batch_update(self, data):
+        self._call()
+        for d in data:
+            letters, row = re.match(r"([A-Z]+)(\d+)", d["range"]).groups()
+            start = sum((ord(c) - 64) * 26 ** i for i, c in enumerate(reversed(letters))) - 1
+            target = self.rows[int(row) - 1]
+            values = list(d["values"][0])
+            target.extend([""] * (start + len(values) - len(target)))
+            target[start:start + len(values)] = values
+
+    def batch_get(self, ranges):
+        self._call()
+        out = []
+        for r in ranges:
+            row = int(re.match(r"[A-Z]+(\d+)", r).group(1))
+            out.append([list(self.rows[row - 1])] if row <= len(self.rows) else [])
+        return out
+
+
+class _FakeSpreadsheet:
+    def __init__(self, ws):
+        self.ws = ws
+
+    def batch_update(self, body):
+        self.ws._call()
+        for req in sorted(body["requests"], key=lambda r: -r["deleteDimension"]["range"]["startIndex"]):
+            del self.ws.rows[req["deleteDimension"]["range"]["startIndex"]]
+
+
+def synthetic_history(n, seed=0, matches=None):
+    from setter_stats import PASS_ORDER, ZONE_ORDER, KILL_RESULT
+    rng = np.random.default_rng(seed)
+    matches = matches or max(1, n // 150)
+    return pd.DataFrame({
+        "Match": [f"2024-01-{d % 28 + 1:02d}_Game{d}" for d in rng.integers(0, matches, n)],
+        "Team": rng.choice(["自チーム", "相手A", "相手B", "相手C"], n),
+        "Pass": rng.choice(PASS_ORDER, n, p=[0.3, 0.25, 0.2, 0.1, 0.1, 0.05]),
+        "Setter": rng.choice(["#1", "#2", "#3", "なし"], n),
+        "Zone": rng.choice(ZONE_ORDER, n),
+        "Result": rng.choice([KILL_RESULT, "失点", "効果", "継続"], n),
+        "X": rng.integers(0, 500, n),
+        "Y": rng.integers(0, 500, n),
+    })
+
+
+def bench_sheets(sizes, latency=0.1, append_rows=80, workdir=None):
+    # app.py の関数はそれぞれ次の処理に相当する:
+    #   load_match_history       → HistoryStore.sync (初回/変更なし/追記後) + read
+    #   save_match_data_to_sheet → HistorySheet.append + 差分同期
+    #   (overwrite は全件書き直しの参考値。アプリからは呼ばない)
+    from sheet_history import HistorySheet
+    from history_store import HistoryStore
+
+    workdir = workdir or tempfile.mkdtemp(prefix="vb_bench_")
+    results = []
+    for n in sizes:
+        ws = FakeWorksheet(latency=0)
+        sheet = HistorySheet(ws)
+        sheet.overwrite(synthetic_history(n))
+        ws.latency = latency
+        store = HistoryStore(os.path.join(workdir, f"history_{n}.sqlite"))
+        case = {"rows": n, "latency_s": latency}
+        version = [0]
+
+        def modified():
+            return str(version[0])
+
+        def measure(name, fn):
+            calls = ws.calls
+            _, seconds = _timed(fn)
+            case[name] = {"seconds": seconds, "api_calls": ws.calls - calls}
+
+        measure("read_all_direct", sheet.read_all)
+        measure("load_cold", lambda: (store.sync(sheet, modified(), full=True), store.read()))
+        measure("load_unchanged", lambda: (store.sync(sheet, modified()), store.read()))
+        new_rows = synthetic_history(append_rows, seed=n)
+
+        def save():
+            sheet.append(new_rows)
+            version[0] += 1
+            store.sync(sheet, modified())
+            store.read()
+        measure("save_match", save)
+
+        def overwrite():
+            sheet.overwrite(store.read(typed=False))
+            version[0] += 1
+            store.sync(sheet, modified(), full=True)
+        measure("overwrite", overwrite)
+        results.append(case)
+        print(f"  sheets {n} rows: " + ", ".join(f"{k}={v['seconds']}s" for k, v in case.items() if isinstance(v, dict)))
+    legacy = check_legacy_edit(workdir)
+    print(f"  sheets legacy edit: {legacy}")
+    mixed = check_mixed_row_ids(workdir)
+    print(f"  sheets mixed RowID edit: {mixed}")
+    stale = check_stale_legacy_edit()
+    print(f"  sheets stale legacy edit: {stale}")
+    return {"cases": results, "append_rows": append_rows, "legacy_edit": legacy, "mixed_row_ids": mixed,
+            "stale_legacy_edit": stale}
+
+
+def check_legacy_edit(workdir):
+    # 回帰チェック: RowID 列が無かった頃の試合を複製 (HistoryStore) から読んで1セルだけ直すと、
+    # 追記 (試合の二重化) ではなくその行の更新になること
+    from sheet_history import HistorySheet
+    from history_store import HistoryStore
+    ws = FakeWorksheet(latency=0)
+    ws.rows = [["Match", "Team", "X", "Y"], ["m1", "A", "1", "1"], ["m1", "A", "2", "2"]]
+    sheet = HistorySheet(ws)
+    store = HistoryStore(os.path.join(workdir, "history_legacy.sqlite"))
+    store.sync(sheet, full=True)
+    before = store.read(typed=False)
+    after = before.copy()
+    after.loc[0, "X"] = "9"
+    result = sheet.save_diff(before, after)
+    rows = ws.get_all_values()
+    if result != {"updated": 1, "inserted": 0, "deleted": 0, "missing": 0} or len(rows) != 3 or rows[1][2] != "9":
+        raise AssertionError(f"legacy edit: {result} / {rows}")
+    return result
+
+
+def check_mixed_row_ids(workdir):
+    # 回帰チェック: RowID のある行と無い行が混ざっていても、古い行の仮ID (row:N) がシートの正しい行を指すこと
+    # (RowID の値の順に並べると、1つ目の編集で ID が付いた行と2つ目に直す行の行番号が入れ替わる)
+    from sheet_history import HistorySheet
+    from history_store import HistoryStore
+    ws = FakeWorksheet(latency=0)
+    ws.rows = [["Match", "Team", "X", "Y", "RowID"], ["m1", "A", "1", "1", ""], ["m1", "A", "2", "2", ""],
+               ["m2", "A", "3", "3", "fixedid00001"]]
+    sheet = HistorySheet(ws)
+    store = HistoryStore(os.path.join(workdir, "history_mixed.sqlite"))
+    results = []
+    for old, new in (("1", "9"), ("2", "20")):
+        # 1つ目の古い行を直して同期し直した後、2つ目の古い行 (まだ RowID が無い) を直す
+        store.sync(sheet, full=True)
+        before = store.read(typed=False)
+        after = before.copy()
+        after.loc[after.index[after["X"] == old][0], "X"] = new
+        results.append(sheet.save_diff(before, after))
+    xs = [row[2] for row in ws.get_all_values()[1:]]
+    expected = {"updated": 1, "inserted": 0, "deleted": 0, "missing": 0}
+    if any(r != expected for r in results) or xs != ["9", "20", "3"]:
+        raise AssertionError(f"mixed RowID edit: {results} / {ws.get_all_values()}")
+    return results[-1]
+
+
+def check_stale_legacy_edit():
+    # 回帰チェック: 仮ID (row:N) で読んだ後にシートの行がずれていたら、別の行を上書き・削除せず missing に数えること
+    from sheet_history import HistorySheet
+    ws = FakeWorksheet(latency=0)
+    ws.rows = [["Match", "Team", "X", "Y"], ["m1", "A", "1", "1"], ["m1", "A", "2", "2"]]
+    sheet = HistorySheet(ws)
+    before = sheet.read_all()
+    ws.rows.insert(1, ["m0", "B", "0", "0"])   # 読んだ後に別の画面で先頭へ行が足された
+    after = before.iloc[[0]].copy()
+    after.loc[after.index[0], "X"] = "9"      # 1行目を直し、2行目を消す
+    result = sheet.save_diff(before, after)
+    xs = [row[2] for row in ws.get_all_values()[1:]]
+    if result != {"updated": 0, "inserted": 0, "deleted": 0, "missing": 2} or xs != ["0", "1", "2"]:
+        raise AssertionError(f"stale legacy edit: {result} / {ws.get_all_values()}")
+    return result
+
+
+# --- 3. セッター配給率の集計 ---
+def bench_setter(sizes, repeats=3):
+    from setter_stats import compute_distribution_tables, distribution_tables, data_fingerprint
+
+    results = []
+    for n in sizes:
+        df = synthetic_history(n)
+        for col in ("Team", "Pass", "Zone", "Setter"):
+            df[col] = df[col].astype("category")
+        fingerprint, fp_s = _timed(data_fingerprint, df)
+        compute = min(_timed(compute_distribution_tables, df)[1] for _ in range(repeats))
+        distribution_tables(df, fingerprint)
+        _, memo_s = _timed(distribution_tables, df, fingerprint)
+        results.append({"rows": n, "fingerprint_s": fp_s, "compute_s": compute, "memo_hit_s": memo_s,
+                        "rows_per_s": round(n / compute) if compute else None})
+        print(f"  setter {n} rows: compute {compute}s, fingerprint {fp_s}s")
+    return {"cases": results, "repeats": repeats}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Volleyball Analyst のオフライン・ベンチマーク")
+    parser.add_argument("--only", default="video,sheets,setter", help="実行する項目 (カンマ区切り)")
+    parser.add_argument("--quick", action="store_true", help="小さい設定で短時間に実行する")
+    parser.add_argument("--latency", type=float, default=0.1, help="シート API 1回あたりの疑似遅延 (秒)")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--motion", action="store_true", help="モーション適応サンプリングを使う")
+    parser.add_argument("--backend", default="pytorch", help="推論バックエンド (pytorch / onnx / openvino / openvino-int8)")
+    parser.add_argument("--tracker", action="store_true", help="ボール追跡 (全画面検出の間引き) を使う")
+    parser.add_argument("--imgsz", type=int, help="推論サイズ px (既定: モデルの 640)")
+    parser.add_argument("--skip-inference", action="store_true", help="モデルを使わずデコード系だけを測る")
+    parser.add_argument("--output", help="レポートの出力先 (既定: .cache/benchmarks/<日時>.json)")
+    args = parser.parse_args(argv)
+
+    only = {s.strip() for s in args.only.split(",") if s.strip()}
+    workdir = tempfile.mkdtemp(prefix="vb_bench_")
+    report = {"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_commit": _git_commit(),
+              "environment": environment_info(), "args": vars(args), "results": {}}
+    if "video" in only:
+        print("video:")
+        motion = {"low_threshold": 0.01, "high_threshold": 1.0, "idle_every": 15} if args.motion else None
+        report["results"]["video"] = bench_video(VIDEO_CASES_QUICK if args.quick else VIDEO_CASES, args.batch_size,
+                                                 motion, args.skip_inference, workdir, args.backend,
+                                                 DEFAULT_TRACKER if args.tracker else None, args.imgsz)
+    if "sheets" in only:
+        print("sheets:")
+        report["results"]["sheets"] = bench_sheets(SHEET_ROWS_QUICK if args.quick else SHEET_ROWS, args.latency,
+                                                   workdir=workdir)
+    if "setter" in only:
+        print("setter:")
+        report["results"]["setter"] = bench_setter(SETTER_ROWS_QUICK if args.quick else SETTER_ROWS)
+    report["peak_memory_mb"] = peak_memory_mb()
+
+    path = args.output or os.path.join(REPORT_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    print(f"report: {path}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
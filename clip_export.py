@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+import subprocess
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from inference_cache import video_fingerprint
+
+INDEX_DIR = os.path.join(".cache", "keyframes")
+CLIP_DIR = os.path.join(".cache", "clips")
+CLIP_BEFORE = 2.0      # 秒: イベントの何秒前から切り出すか
+CLIP_AFTER = 3.0       # 秒: イベントの何秒後まで
+MAX_LEAD = 4.0         # 秒: 直前のキーフレームがこれより前なら、そのクリップだけ再エンコードして正確に切る
+EXPORT_WORKERS = 4     # 同時に動かす ffmpeg の数 (ストリームコピーはほぼ I/O だけ)
+
+_index_lock = threading.Lock()
+
+
+def ffmpeg_available():
+    return shutil.which("ffmpeg") is not None and shutil.which("ffprobe") is not None
+
+
+# --- キーフレームの索引 (動画ごとに一度だけ作り、内容ハッシュで保存する) ---
+class KeyframeIndex:
+    def __init__(self, times, duration=None):
+        self.times = np.asarray(times, dtype=np.float64)   # 先頭からの秒 (昇順)
+        self.duration = duration
+
+    def before(self, t):
+        # t 以前で最も近いキーフレームの時刻 (無ければ 0)
+        i = np.searchsorted(self.times, t + 1e-6, side="right") - 1
+        return float(self.times[i]) if i >= 0 else 0.0
+
+    @classmethod
+    def probe(cls, video_path):
+        # パケットのフラグを読むだけでデコードはしない (1時間の動画でも数秒)
+        out = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0",
+                              "-show_entries", "packet=pts_time,flags:stream=start_time,duration",
+                              "-of", "json", video_path], capture_output=True, text=True, check=True).stdout
+        data = json.loads(out)
+        stream = (data.get("streams") or [{}])[0]
+        start = float(stream.get("start_time") or 0.0)
+        times = sorted(float(p["pts_time"]) - start for p in data.get("packets", [])
+                       if "K" in p.get("flags", "") and p.get("pts_time") not in (None, "N/A"))
+        duration = stream.get("duration")
+        return cls(times, float(duration) if duration not in (None, "N/A") else None)
+
+    @classmethod
+    def load_or_build(cls, video_path, root=INDEX_DIR):
+        path = os.path.join(root, f"{video_fingerprint(video_path)}.json")
+        with _index_lock:
+            if os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f)
+                return cls(data["times"], data.get("duration"))
+            index = cls.probe(video_path)
+            os.makedirs(root, exist_ok=True)
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"times": index.times.tolist(), "duration": index.duration}, f)
+            os.replace(tmp, path)
+        return index
+
+
+# --- 切り出し計画: イベント表の行 → クリップの区間 ---
+def plan_clips(events, before=CLIP_BEFORE, after=CLIP_AFTER, duration=None):
+    # events: EVENT_COLUMNS の dict のリスト (DataFrame.to_dict("records"))
+    clips = []
+    for i, e in enumerate(events, 1):
+        t = float(e["Time(s)"])
+        end = t + after if duration is None else min(t + after, duration)
+        clips.append({"name": f"{i:03d}_{e['Action']}_{t:07.2f}s.mp4", "action": e["Action"], "time": t,
+                      "start": max(0.0, t - before), "end": end})
+    return clips
+
+
+def _ffmpeg_clip(video_path, clip, out_path, index):
+    # キーフレームから始めればストリームコピーで切れる (再エンコードなし)。
+    # キーフレーム間隔が長すぎる動画だけ、そのクリップを再エンコードして指定位置から切る
+    key = index.before(clip["start"]) if index is not None else None
+    if key is not None and clip["start"] - key <= MAX_LEAD:
+        cmd = ["ffmpeg", "-v", "error", "-y", "-ss", f"{key:.3f}", "-i", video_path, "-t", f"{clip['end'] - key:.3f}",
+               "-map", "0:v:0", "-map", "0:a?", "-c", "copy", "-avoid_negative_ts", "make_zero", out_path]
+        mode = "copy"
+    else:
+        cmd = ["ffmpeg", "-v", "error", "-y", "-ss", f"{clip['start']:.3f}", "-i", video_path,
+               "-t", f"{clip['end'] - clip['start']:.3f}", "-map", "0:v:0", "-map", "0:a?",
+               "-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-c:a", "aac", out_path]
+        mode = "encode"
+    subprocess.run(cmd, capture_output=True, check=True)
+    return mode
+
+
+def _opencv_clip(video_path, clip, out_path):
+    # ffmpeg が無い環境の代替: クリップの区間だけを読み直して書き出す (音声なし)
+    import cv2
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    cap.set(cv2.CAP_PROP_POS_MSEC, clip["start"] * 1000)
+    writer = None
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok or cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0 > clip["end"]: break
+            if writer is None:
+                h, w = frame.shape[:2]
+                writer = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (w, h))
+            writer.write(frame)
+    finally:
+        cap.release()
+        if writer is not None: writer.release()
+    return "opencv"
+
+
+def export_clips(video_path, events, out_dir, before=CLIP_BEFORE, after=CLIP_AFTER, workers=EXPORT_WORKERS,
+                 on_progress=None):
+    # 各イベントの前後を別ファイルに切り出す。戻り値: plan_clips の各 dict に path / mode を足したもの
+    os.makedirs(out_dir, exist_ok=True)
+    use_ffmpeg = ffmpeg_available()
+    index = KeyframeIndex.load_or_build(video_path) if use_ffmpeg else None
+    clips = plan_clips(events, before, after, index.duration if index is not None else None)
+
+    def run(clip):
+        clip["path"] = os.path.join(out_dir, clip["name"])
+        clip["mode"] = _ffmpeg_clip(video_path, clip, clip["path"], index) if use_ffmpeg \
+            else _opencv_clip(video_path, clip, clip["path"])
+        return clip
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for done, _ in enumerate(pool.map(run, clips), 1):
+            if on_progress: on_progress(done / len(clips))
+    return clips
+
+
+def zip_clips(clips, zip_path):
+    # 動画は圧縮済みなので ZIP_STORED (詰め直すだけ)
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as z:
+        for clip in clips:
+            z.write(clip["path"], clip["name"])
+    return zip_path
+
+
+def highlight_reel(clips, out_path):
+    # 同じ動画からストリームコピーしたクリップは符号化設定が揃うので、concat でそのままつなげる
+    if not clips: return None
+    if not ffmpeg_available() or any(c["mode"] != "copy" for c in clips): return None
+    list_path = f"{out_path}.txt"
+    with open(list_path, "w", encoding="utf-8") as f:
+        for clip in clips:
+            f.write("file '{}'\n".format(os.path.abspath(clip["path"]).replace("'", "'\\''")))
+    try:
+        subprocess.run(["ffmpeg", "-v", "error", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", out_path],
+                       capture_output=True, check=True)
+    finally:
+        os.remove(list_path)
+    return out_path
@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+from dataclasses import asdict, dataclass
+
+CALIBRATION_PATH = os.path.join(".cache", "court_regions.json")
+DEFAULT_SETUP = "標準 (全画面)"
+
+
+# --- コート領域 (画面に対する割合 0〜1)。カメラの設置ごとに一度決めておく ---
+@dataclass(frozen=True)
+class CourtRegion:
+    left: float = 0.0
+    top: float = 0.0
+    right: float = 1.0
+    bottom: float = 1.0
+
+    @property
+    def is_full(self):
+        return (self.left, self.top, self.right, self.bottom) == (0.0, 0.0, 1.0, 1.0)
+
+    def to_pixels(self, width, height):
+        # (x0, y0, x1, y1)。空の領域にならないよう最低1pxは残す
+        x0, x1 = int(width * self.left), max(int(width * self.left) + 1, int(round(width * self.right)))
+        y0, y1 = int(height * self.top), max(int(height * self.top) + 1, int(round(height * self.bottom)))
+        return x0, y0, min(x1, width), min(y1, height)
+
+    def as_tuple(self):
+        # パイプライン・キャッシュキーに渡す形 (全画面なら None)
+        return None if self.is_full else (self.left, self.top, self.right, self.bottom)
+
+
+# --- カメラ設定ごとのコート領域の保存 (JSON) ---
+class CalibrationStore:
+    def __init__(self, path=CALIBRATION_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if not os.path.exists(self.path): return {}
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def names(self):
+        return [DEFAULT_SETUP] + sorted(self._load())
+
+    def get(self, name):
+        data = self._load().get(name)
+        return CourtRegion(**data) if data else CourtRegion()
+
+    def save(self, name, region):
+        if name == DEFAULT_SETUP: raise ValueError("標準の設定は上書きできません")
+        with self._lock:
+            data = self._load()
+            data[name] = asdict(region)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.path)
+
+    def delete(self, name):
+        with self._lock:
+            data = self._load()
+            if data.pop(name, None) is None: return
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
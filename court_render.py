@@ -0,0 +1,49 @@
+import io
+
+import numpy as np
+
+COURT_EXTENT = [0, 500, 500, 0]   # 入力画面 (幅500px) の座標系
+HEATMAP_AUTO_POINTS = 1500        # これより点が多いと自動でヒートマップにする
+HEATMAP_BINS = 25
+
+
+def _zone_legend(ax, zone_colors, zones):
+    from matplotlib.lines import Line2D
+    handles = [Line2D([], [], marker="o", linestyle="", markersize=10, markerfacecolor=zone_colors.get(z, ("gray", z))[0],
+                      markeredgecolor="white", label=zone_colors.get(z, ("gray", z))[1]) for z in zones]
+    if handles: ax.legend(handles=handles, loc="upper right")
+
+
+# --- セットアップ位置の描画 (PNGのバイト列を返す) ---
+def render_setup_locations(df, background, zone_colors, mode="auto", dpi=80):
+    # background: コート画像 (numpy配列) / mode: "scatter" | "heatmap" | "auto"
+    # pyplot を使わず Figure を直接作るので、描画後に参照が残らずメモリリークしない
+    from matplotlib.figure import Figure
+
+    df = df[df["Zone"] != "なし"] if "Zone" in df.columns else df
+    x = df["X"].to_numpy(dtype=float)
+    y = df["Y"].to_numpy(dtype=float)
+    if mode == "auto":
+        mode = "heatmap" if len(df) > HEATMAP_AUTO_POINTS else "scatter"
+
+    fig = Figure(figsize=(10, 6), dpi=dpi)
+    ax = fig.add_subplot()
+    ax.imshow(background, extent=COURT_EXTENT)
+    if mode == "heatmap":
+        # 点を1つずつ描く代わりに2次元ヒストグラムで密度を描く (点数に関係なく一定コスト)
+        hist, _, _ = np.histogram2d(y, x, bins=HEATMAP_BINS, range=[[0, 500], [0, 500]])
+        masked = np.ma.masked_equal(hist, 0)
+        im = ax.imshow(masked, extent=COURT_EXTENT, cmap="hot", alpha=0.6, interpolation="gaussian")
+        fig.colorbar(im, ax=ax, label="Sets")
+    else:
+        zones = [z for z in df["Zone"].unique()] if "Zone" in df.columns else []
+        colors = df["Zone"].map(lambda z: zone_colors.get(z, ("gray", z))[0]).to_numpy() if zones else "gray"
+        ax.scatter(x, y, c=colors, s=120, alpha=0.8, edgecolors="white")
+        _zone_legend(ax, zone_colors, zones)
+    ax.set_xlim(0, 500)
+    ax.set_ylim(500, 0)
+    ax.axis("off")
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    return buf.getvalue()
@@ -0,0 +1,149 @@
+import os
+import re
+import threading
+import time
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024  # 16MB
+
+
+class DownloadError(Exception):
+    pass
+
+
+# --- Drive から一時ファイルへ直接ストリーミング保存 (途中から再開可能) ---
+def download_to_file(service, file_id, dest_path, chunk_size=DEFAULT_CHUNK_SIZE, on_progress=None,
+                     max_retries=5, stop_event=None):
+    # 受信中は dest_path + ".part" に追記し、完了したら dest_path にリネームする。
+    # 中断しても .part が残るので、次回は続きのバイトから Range 要求する。
+    part_path = dest_path + ".part"
+    if os.path.exists(dest_path):
+        return dest_path
+    request = service.files().get_media(fileId=file_id)
+    headers = dict(request.headers)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    total = None
+    retries = 0
+    with open(part_path, "ab") as f:
+        while total is None or offset < total:
+            if stop_event is not None and stop_event.is_set():
+                return None
+            headers["range"] = f"bytes={offset}-{offset + chunk_size - 1}"
+            try:
+                resp, content = request.http.request(request.uri, method="GET", headers=headers)
+            except Exception as e:
+                retries += 1
+                if retries > max_retries: raise DownloadError(f"ダウンロード失敗: {e}") from e
+                time.sleep(min(2 ** retries, 30))
+                continue
+
+            if resp.status == 416:  # 既に全バイト受信済み
+                if total is not None and offset < total:
+                    raise DownloadError(f"ダウンロード失敗: {offset} / {total} バイトで範囲外 (HTTP 416)")
+                break
+            if resp.status >= 500 or resp.status == 429:
+                retries += 1
+                if retries > max_retries: raise DownloadError(f"ダウンロード失敗: HTTP {resp.status}")
+                time.sleep(min(2 ** retries, 30))
+                continue
+            if resp.status not in (200, 206):
+                raise DownloadError(f"ダウンロード失敗: HTTP {resp.status}")
+            retries = 0
+
+            if resp.status == 200:
+                # Range が無視されて全体が返ってきた場合: 1チャンクに収まる小さなファイルだけ受け入れて先頭から書き直す
+                # (httplib2 は本文をすべてメモリに読むので、大きなファイルをこの形で受け取るとメモリが一定に保てない)
+                if len(content) > chunk_size:
+                    raise DownloadError("ダウンロード失敗: サーバーが範囲指定 (Range) に応じませんでした")
+                f.seek(0); f.truncate()
+                offset = 0
+                total = len(content)
+            else:
+                m = re.search(r"/(\d+)$", resp.get("content-range", ""))
+                if m: total = int(m.group(1))
+            f.write(content)
+            f.flush()
+            offset += len(content)
+            if on_progress: on_progress(offset, total)
+            if not content:
+                # 途中で本文が空になった: 切れた動画を完成扱いにしない (.part は残るので次回は続きから)
+                if total is not None and offset < total:
+                    raise DownloadError(f"ダウンロード失敗: {offset} / {total} バイトで応答が途切れました")
+                break
+    os.replace(part_path, dest_path)
+    return dest_path
+
+
+_downloads = {}   # 保存先パス → 受信中の DriveDownload (プロセス内の全セッション・全ジョブで共有)
+_downloads_lock = threading.Lock()
+
+
+def start_download(service_factory, file_id, dest_path, chunk_size=DEFAULT_CHUNK_SIZE):
+    # 同じ保存先へ受信中のダウンロードがあればそれを返す (2本のスレッドが同じ .part に追記して壊さないように)
+    with _downloads_lock:
+        dl = _downloads.get(dest_path)
+        if dl is None or dl.done:
+            dl = DriveDownload(service_factory, file_id, dest_path, chunk_size)
+            _downloads[dest_path] = dl
+        dl._users += 1
+        return dl
+
+
+# --- バックグラウンドでダウンロードしつつ、受信済み部分を参照できるようにする ---
+class DriveDownload:
+    def __init__(self, service_factory, file_id, dest_path, chunk_size=DEFAULT_CHUNK_SIZE):
+        # service_factory: ダウンロード用スレッドの中で Drive サービスを作る関数 (httplib2 をスレッド間で共有しない)
+        self.file_id = file_id
+        self.dest_path = dest_path
+        self.bytes_done = 0
+        self.total_bytes = None
+        self.error = None
+        self._users = 0   # start_download で共有している利用者の数
+        self._done = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(service_factory, chunk_size), name=f"drive-{file_id}", daemon=True)
+        self._thread.start()
+
+    def _run(self, service_factory, chunk_size):
+        try:
+            download_to_file(service_factory(), self.file_id, self.dest_path, chunk_size, on_progress=self._on_progress,
+                             stop_event=self._stop)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._done.set()
+            with _downloads_lock:
+                if _downloads.get(self.dest_path) is self: del _downloads[self.dest_path]
+
+    def _on_progress(self, done, total):
+        self.bytes_done, self.total_bytes = done, total
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    @property
+    def completed(self):
+        return self.done and self.error is None and os.path.exists(self.dest_path)
+
+    @property
+    def progress(self):
+        if self.completed: return 1.0
+        if not self.total_bytes: return 0.0
+        return min(self.bytes_done / self.total_bytes, 1.0)
+
+    def current_path(self):
+        # 完了前は受信途中の .part を返す (moov が先頭にある動画なら途中まで解析できる)
+        return self.dest_path if os.path.exists(self.dest_path) else self.dest_path + ".part"
+
+    def is_growing(self):
+        return not self.done
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def cancel(self):
+        # 共有中は最後の利用者が取り消したときだけ止める
+        with _downloads_lock:
+            self._users -= 1
+            if self._users > 0: return
+        self._stop.set()
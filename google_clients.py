@@ -0,0 +1,80 @@
+import threading
+
+
+def is_missing_sheet_error(e):
+    # 削除されたシートを古いハンドルで触ると 400 (範囲を解釈できない) か 404 になる
+    response = getattr(e, "response", None)
+    return (getattr(response, "status_code", None) or getattr(e, "code", None)) in (400, 404)
+
+
+# --- プロセス全体で共有する Google API クライアント ---
+# 認証・スプレッドシートのメタデータ取得・Drive の discovery を毎回やり直さないよう、
+# 一度作ったハンドルを使い回す。アクセストークンの期限切れは oauth2client が自動で更新する。
+class GoogleClients:
+    def __init__(self, creds, spreadsheet_id):
+        self.creds = creds
+        self.spreadsheet_id = spreadsheet_id
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}
+
+    def gspread_client(self):
+        with self._lock:
+            if self._client is None:
+                import gspread
+                self._client = gspread.authorize(self.creds)
+            return self._client
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None:
+                self._spreadsheet = self.gspread_client().open_by_key(self.spreadsheet_id)
+            return self._spreadsheet
+
+    def worksheet(self, title, create=None):
+        # create: シートが無いときに add_worksheet へ渡す引数 (None なら WorksheetNotFound をそのまま投げる)
+        import gspread
+        with self._lock:
+            ws = self._worksheets.get(title)
+            if ws is not None:
+                return ws
+            sheet = self.spreadsheet()
+            try:
+                ws = sheet.worksheet(title)
+            except gspread.exceptions.WorksheetNotFound:
+                if create is None: raise
+                ws = sheet.add_worksheet(title=title, **create)
+            self._worksheets[title] = ws
+            return ws
+
+    def forget_worksheet(self, title):
+        # シートが外部で削除・再作成されたときにハンドルを捨てる
+        with self._lock:
+            self._worksheets.pop(title, None)
+
+    def reopen_worksheet(self, title, create=None):
+        # ハンドルを捨てて開き直す (シートが削除・再作成されると古いハンドルの sheetId が使えなくなる)
+        self.forget_worksheet(title)
+        return self.worksheet(title, create=create)
+
+    def worksheet_call(self, title, fn, create=None):
+        # fn(ws) を呼ぶ。シートが見つからない系のエラー (400/404) ならハンドルを開き直して1回だけやり直す
+        import gspread
+        try:
+            return fn(self.worksheet(title, create=create))
+        except gspread.exceptions.APIError as e:
+            if not is_missing_sheet_error(e): raise
+            return fn(self.reopen_worksheet(title, create=create))
+
+    def drive(self):
+        # httplib2 はスレッドセーフではないので、Drive サービスはスレッドごとに1つ持つ
+        service = getattr(self._local, "drive", None)
+        if service is None:
+            import httplib2
+            from googleapiclient.discovery import build
+            http = self.creds.authorize(httplib2.Http())
+            service = build('drive', 'v3', http=http, cache_discovery=False)
+            self._local.drive = service
+        return service
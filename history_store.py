@@ -0,0 +1,212 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from google_clients import is_missing_sheet_error
+from sheet_history import with_retry, _col_letter, LEGACY_ROW_PREFIX, ROW_ID_COL
+
+STORE_PATH = os.path.join(".cache", "history.sqlite")
+SYNC_INTERVAL = 30          # 秒: シートの更新確認の間隔
+FULL_REFRESH_INTERVAL = 900  # 秒: 途中の行の直接編集を拾うための全件再取得の間隔
+CATEGORY_COLUMNS = ["Team", "Pass", "Zone", "Setter"]
+NUMERIC_COLUMNS = ["X", "Y"]
+SHEET_ROW_COL = "_sheet_row"   # 複製だけに持つシートの行番号 (SQLite の rowid は RowID 列と同じ名前になり使えない)
+STORE_SCHEMA = 2               # 複製の列構成の版。古い複製は全件取り直す
+
+
+def _column_names(header):
+    # 空欄・重複した見出しはそのままでは SQLite の列名にできないので補う
+    names, seen = [], set()
+    for i, name in enumerate(header):
+        name = name or f"_col{i + 1}"
+        while name in seen: name = f"{name}_{i + 1}"
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+# --- history シートのローカル複製 (SQLite)。読み込みはここから行い、シートとは裏で差分同期する ---
+class HistoryStore:
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self._lock = threading.RLock()
+        self._version = 0
+        self._cache = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _get_meta(self, con, key, default=None):
+        row = con.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def _set_meta(self, con, key, value):
+        con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    @property
+    def version(self):
+        # 同期で中身が変わるたびに増える (集計結果のメモ化キーに使う)
+        return self._version
+
+    @property
+    def is_empty(self):
+        with self._connect() as con:
+            return self._get_meta(con, "header") is None
+
+    # --- 書き込み (同期処理から呼ばれる) ---
+    def replace_all(self, header, rows):
+        df = pd.DataFrame(rows, columns=_column_names(header)) if header else pd.DataFrame()
+        with self._lock, self._connect() as con:
+            con.execute("DROP TABLE IF EXISTS history")
+            if header:
+                df[SHEET_ROW_COL] = range(2, len(df) + 2)
+                df.to_sql("history", con, index=False)
+            self._set_meta(con, "header", header)
+            self._set_meta(con, "schema", STORE_SCHEMA)
+            self._set_meta(con, "synced_rows", len(rows))
+            self._set_meta(con, "full_refresh_at", time.time())
+            self._version += 1
+
+    def append_rows(self, header, rows):
+        if not rows: return
+        df = pd.DataFrame(rows, columns=_column_names(header))
+        with self._lock, self._connect() as con:
+            synced_rows = self._get_meta(con, "synced_rows", 0)
+            df[SHEET_ROW_COL] = range(synced_rows + 2, synced_rows + 2 + len(df))
+            df.to_sql("history", con, index=False, if_exists="append")
+            self._set_meta(con, "synced_rows", synced_rows + len(rows))
+            self._version += 1
+
+    # --- 読み込み ---
+    def read(self, typed=True):
+        # typed=True: 数値列は数値、Team/Pass/Zone/Setter はカテゴリ型 (分析用)
+        # typed=False: シートと同じ文字列のまま (編集画面・差分保存用)
+        # 同期で中身が変わるまでは同じ DataFrame を返すので、呼び出し側で書き換えないこと
+        with self._lock:
+            key = (self._version, typed)
+            if key in self._cache: return self._cache[key]
+            with self._connect() as con:
+                header = self._get_meta(con, "header")
+                if not header or "Match" not in header:
+                    df = pd.DataFrame()
+                else:
+                    df = pd.read_sql(f'SELECT * FROM history ORDER BY "{SHEET_ROW_COL}"', con)
+                    sheet_rows = df.pop(SHEET_ROW_COL)
+            if not df.empty:
+                # RowID が空の古い行には HistorySheet.read_all と同じ仮ID (row:<シートの行番号>) を振る
+                legacy = [f"{LEGACY_ROW_PREFIX}{n}" for n in sheet_rows]
+                if ROW_ID_COL in df.columns:
+                    df[ROW_ID_COL] = [rid or leg for rid, leg in zip(df[ROW_ID_COL].fillna(""), legacy)]
+                else:
+                    df[ROW_ID_COL] = legacy
+            if typed and not df.empty:
+                for col in NUMERIC_COLUMNS:
+                    if col in df.columns: df[col] = pd.to_numeric(df[col], errors="coerce")
+                for col in CATEGORY_COLUMNS:
+                    if col in df.columns: df[col] = df[col].astype("category")
+            self._cache = {key: df}
+            return df
+
+    # --- シートとの同期 ---
+    def sync(self, history_sheet, modified_time=None, full=False):
+        # modified_time: スプレッドシートの最終更新時刻 (Drive API)。前回と同じならシートには一切アクセスしない
+        with self._connect() as con:
+            last_modified = self._get_meta(con, "sheet_modified")
+            header = self._get_meta(con, "header")
+            synced_rows = self._get_meta(con, "synced_rows", 0)
+            full_refresh_at = self._get_meta(con, "full_refresh_at", 0)
+            schema = self._get_meta(con, "schema")
+        if header is None or schema != STORE_SCHEMA or time.time() - full_refresh_at > FULL_REFRESH_INTERVAL:
+            full = True
+        if not full and modified_time is not None and modified_time == last_modified:
+            return "unchanged"
+
+        ws = history_sheet.ws
+        if not full:
+            current_header = with_retry(ws.row_values, 1)
+            if current_header != header:
+                full = True
+            else:
+                # 末尾に追記された行だけを取る
+                tail = with_retry(ws.get, f"A{synced_rows + 2}:{_col_letter(len(header))}")
+                tail = [row + [""] * (len(header) - len(row)) for row in tail]
+                if tail:
+                    self.append_rows(header, tail)
+                elif modified_time is not None and last_modified is not None:
+                    # 行数は変わらないのに更新されている → 途中の行が直接編集された
+                    full = True
+        if full:
+            data = with_retry(ws.get_all_values)
+            # RowID の無い古い行はここで一度だけ ID を埋める (以後は行番号の仮IDを使わない)。
+            # 書き込めなくても同期は続ける (仮IDの行は保存時に中身を確かめてから書き換える)
+            try:
+                history_sheet.backfill_row_ids(data)
+            except Exception:
+                pass
+            header = data[0] if data else []
+            self.replace_all(header, data[1:])
+            history_sheet.remember_header(header)
+        with self._lock, self._connect() as con:
+            self._set_meta(con, "sheet_modified", modified_time)
+            self._set_meta(con, "synced_at", time.time())
+        return "full" if full else "incremental"
+
+
+# --- バックグラウンド同期スレッド ---
+class HistorySyncer:
+    def __init__(self, store, history_sheet, modified_time_fn=None, interval=SYNC_INTERVAL):
+        self.store = store
+        self.history_sheet = history_sheet
+        self.modified_time_fn = modified_time_fn
+        self.interval = interval
+        self.last_error = None
+        self.last_sync = None
+        self._wake = threading.Event()
+        self._sync_lock = threading.Lock()
+        self._full = False
+        self._thread = None
+
+    def start(self):
+        # 初回同期が済んでから呼ぶ (初回同期に失敗して作り直されたときにスレッドが残らないように)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="history-sync", daemon=True)
+            self._thread.start()
+        return self
+
+    def request_sync(self, full=False):
+        # 自分で書き込んだ直後などに、次の周期を待たずに同期させる
+        self._full = self._full or full
+        self._wake.set()
+
+    def sync_now(self, full=False):
+        with self._sync_lock:
+            modified = self.modified_time_fn() if self.modified_time_fn else None
+            result = self.store.sync(self.history_sheet, modified, full=full)
+            self.last_sync = time.time()
+            return result
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            full, self._full = self._full, False
+            try:
+                self.sync_now(full=full)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+                if is_missing_sheet_error(e):
+                    # シートが削除・再作成された: ハンドルを開き直し、次の周期で全件取り直す
+                    try:
+                        self.history_sheet.reopen_worksheet()
+                    except Exception:
+                        pass
+                    self._full = True
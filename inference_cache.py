@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+CACHE_DIR = os.path.join(".cache", "inference")
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # 2GB
+
+_fingerprints = {}
+
+
+# --- 動画の内容ハッシュ (数GBの全体を読まないよう、均等に散らした区間だけを読む) ---
+def video_fingerprint(path, samples=16, chunk_size=1024 * 1024):
+    st_ = os.stat(path)
+    memo_key = (os.path.abspath(path), st_.st_size, st_.st_mtime)
+    if memo_key in _fingerprints:
+        return _fingerprints[memo_key]
+    h = hashlib.sha1(str(st_.st_size).encode())
+    with open(path, "rb") as f:
+        if st_.st_size <= samples * chunk_size:
+            h.update(f.read())
+        else:
+            step = (st_.st_size - chunk_size) // (samples - 1)
+            for i in range(samples):
+                f.seek(i * step)
+                h.update(f.read(chunk_size))
+    _fingerprints[memo_key] = h.hexdigest()
+    return _fingerprints[memo_key]
+
+
+def make_cache_key(video_path, settings):
+    # settings: モデル名・信頼度・サンプリング設定など、推論結果を変える値だけを入れる
+    payload = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha1(f"{video_fingerprint(video_path)}:{payload}".encode()).hexdigest()
+
+
+# --- フレームごとの生の推論結果 (ボール位置 + 骨格キーポイント + ボール追跡の状態) ---
+class InferenceRecord:
+    def __init__(self, meta=None):
+        self.meta = dict(meta or {})
+        self.frame_idx = []
+        self.ball = []
+        self.keypoints = []
+        self.track = []   # (vx, vy, 取得方法) または None。ボール追跡を使った解析のみ
+        self.times = []   # コンテナの表示時刻 (秒) または None。古いキャッシュには無い
+        self._arrays = None
+
+    def add(self, frame_idx, ball, keypoints, track=None, time_s=None):
+        self._arrays = None
+        self.frame_idx.append(int(frame_idx))
+        self.ball.append(None if ball is None else (float(ball[0]), float(ball[1])))
+        self.keypoints.append(np.asarray(keypoints, dtype=np.float32).reshape(-1, 17, 2))
+        self.track.append(None if track is None else tuple(float(v) for v in track))
+        self.times.append(None if time_s is None else float(time_s))
+
+    def extend(self, other, lo=None, hi=None):
+        # lo < frame_idx <= hi の範囲だけ取り込む (シャードの重なり部分の除外用)
+        self._arrays = None
+        for i, (idx, ball, kpts) in enumerate(other):
+            if lo is not None and idx <= lo: continue
+            if hi is not None and idx > hi: continue
+            self.frame_idx.append(idx); self.ball.append(ball); self.keypoints.append(kpts)
+            self.track.append(other.track[i] if i < len(other.track) else None)
+            self.times.append(other.times[i] if i < len(other.times) else None)
+
+    def sort(self):
+        self._arrays = None
+        order = sorted(range(len(self.frame_idx)), key=self.frame_idx.__getitem__)
+        self.frame_idx = [self.frame_idx[i] for i in order]
+        self.ball = [self.ball[i] for i in order]
+        self.keypoints = [self.keypoints[i] for i in order]
+        self.track = [self.track[i] for i in order]
+        self.times = [self.times[i] for i in order]
+
+    def __len__(self):
+        return len(self.frame_idx)
+
+    def __iter__(self):
+        return zip(self.frame_idx, self.ball, self.keypoints)
+
+    def arrays(self):
+        # ベクトル化判定用の配列表現 (結果はメモ化)
+        #   frame_idx: (F,)  ball: (F, 2) 未検出は NaN  keypoints: (全人数, 17, 2)  person_frame: (全人数,) 所属フレームの行番号
+        if self._arrays is None:
+            counts = np.array([len(k) for k in self.keypoints], dtype=np.int64)
+            kpts = np.concatenate(self.keypoints) if self.keypoints else np.zeros((0, 17, 2), dtype=np.float32)
+            ball = np.array([(np.nan, np.nan) if b is None else b for b in self.ball], dtype=np.float32).reshape(-1, 2)
+            person_frame = np.repeat(np.arange(len(self.frame_idx)), counts)
+            self._arrays = (np.array(self.frame_idx, dtype=np.int64), ball, kpts, person_frame)
+        return self._arrays
+
+    def times_array(self):
+        # (F,) 秒。時刻が記録されていないフレームは NaN (フレーム番号と FPS から求める)
+        if len(self.times) != len(self.frame_idx): return np.full(len(self.frame_idx), np.nan)
+        return np.array([np.nan if t is None else t for t in self.times], dtype=np.float64)
+
+    def save(self, path):
+        frame_idx, ball, kpts, _ = self.arrays()
+        counts = np.array([len(k) for k in self.keypoints], dtype=np.int32)
+        extra = {}
+        if any(t is not None for t in self.track):
+            extra["track"] = np.array([(np.nan,) * 3 if t is None else t for t in self.track], dtype=np.float32)
+        if any(t is not None for t in self.times):
+            extra["times"] = self.times_array()
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, frame_idx=frame_idx, ball=ball,
+                                person_counts=counts, keypoints=kpts, meta=np.array(json.dumps(self.meta)), **extra)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as z:
+            record = cls(json.loads(str(z["meta"])))
+            offsets = np.concatenate([[0], np.cumsum(z["person_counts"])])
+            kpts = z["keypoints"]
+            record.frame_idx = z["frame_idx"].tolist()
+            record.ball = [None if np.isnan(b[0]) else (float(b[0]), float(b[1])) for b in z["ball"]]
+            record.keypoints = [kpts[offsets[i]:offsets[i + 1]] for i in range(len(record.frame_idx))]
+            if "track" in z.files:
+                record.track = [None if np.isnan(t[2]) else tuple(float(v) for v in t) for t in z["track"]]
+            else:
+                record.track = [None] * len(record.frame_idx)
+            if "times" in z.files:
+                record.times = [None if np.isnan(t) else float(t) for t in z["times"]]
+            else:
+                record.times = [None] * len(record.frame_idx)
+        return record
+
+
+# --- ディスクキャッシュ (合計サイズ上限つき、古い順に削除) ---
+class InferenceCache:
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, f"{key}.npz")
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path): return None
+        try:
+            record = InferenceRecord.load(path)
+        except Exception:
+            # 壊れたエントリは消して再計算させる
+            os.remove(path)
+            return None
+        os.utime(path)  # 最終利用時刻を更新 (LRU)
+        return record
+
+    def put(self, key, record):
+        with self._lock:
+            record.save(self._path(key))
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".npz"): continue
+            path = os.path.join(self.root, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            os.remove(path)
+            total -= size
@@ -0,0 +1,165 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+MAX_BATCH = 16        # 1回のモデル呼び出しでまとめる最大フレーム数 (全ジョブ合計)
+MAX_WAIT = 0.01       # 秒: 他のジョブのフレームが揃うのを待つ最大時間
+MAX_PENDING = 32      # モデルごとの待ち行列の上限 (超えると呼び出し側がブロックする = バックプレッシャー)
+
+
+class _Request:
+    __slots__ = ("frames", "kwargs", "key", "future", "queued_at")
+
+    def __init__(self, frames, kwargs):
+        self.frames = frames
+        self.kwargs = kwargs
+        self.key = repr(sorted(kwargs.items()))
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+# --- PyTorch の演算スレッドを、同時に推論しているモデルの数で分ける ---
+class ThreadBudget:
+    # 1つの解析は det → pose を順に呼ぶので、1モデルだけ動いている間はコアを全部使わせる。
+    # 複数のジョブで det と pose が同時に動くときだけ、それぞれの呼び出しのスレッド数を減らす
+    # (ONNX Runtime / OpenVINO のセッションは自前のスレッドプールを使うのでここでは変えない)
+    def __init__(self, total=None):
+        self.total = max(1, total or os.cpu_count() or 1)
+        self.active = 0
+        self._lock = threading.Lock()
+        try:
+            import torch
+            self._torch = torch
+        except ImportError:
+            self._torch = None
+
+    @contextmanager
+    def share(self):
+        with self._lock:
+            self.active += 1
+            threads = max(1, self.total // self.active)
+        if self._torch is not None: self._torch.set_num_threads(threads)
+        try:
+            yield threads
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+# --- 1つのモデルを専用スレッドで動かし、複数ジョブからの要求をまとめて推論する ---
+class ModelWorker:
+    def __init__(self, name, model, max_batch=MAX_BATCH, max_wait=MAX_WAIT, max_pending=MAX_PENDING, budget=None):
+        self.name = name
+        self.model = model
+        self.budget = budget
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._carry = None   # 設定 (kwargs) が違うため前のバッチに入れられなかった要求
+        self.stats = {"requests": 0, "frames": 0, "batches": 0, "busy_s": 0.0, "wait_s": 0.0}
+        self._thread = threading.Thread(target=self._run, name=f"inference-{name}", daemon=True)
+        self._thread.start()
+
+    def __call__(self, frames, **kwargs):
+        # YOLO モデルと同じ呼び出し方で使える (FramePipeline / infer_batch はそのまま)
+        if not isinstance(frames, list): frames = [frames]
+        request = _Request(frames, kwargs)
+        self._queue.put(request)
+        return request.future.result()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def _collect(self):
+        first = self._carry or self._queue.get()
+        self._carry = None
+        batch, size = [first], len(first.frames)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch:
+            try:
+                request = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if request.key != first.key or size + len(request.frames) > self.max_batch:
+                self._carry = request
+                break
+            batch.append(request)
+            size += len(request.frames)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            frames = [f for r in batch for f in r.frames]
+            t0 = time.perf_counter()
+            try:
+                if self.budget is None:
+                    results = list(self.model(frames, **batch[0].kwargs))
+                else:
+                    with self.budget.share():
+                        results = list(self.model(frames, **batch[0].kwargs))
+            except Exception as e:
+                for r in batch: r.future.set_exception(e)
+                continue
+            self.stats["busy_s"] += time.perf_counter() - t0
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(batch)
+            self.stats["frames"] += len(frames)
+            offset = 0
+            for r in batch:
+                self.stats["wait_s"] += t0 - r.queued_at
+                r.future.set_result(results[offset:offset + len(r.frames)])
+                offset += len(r.frames)
+
+
+# --- プロセス共有の推論サーバー (全セッション・全ジョブがここを通して推論する) ---
+class InferenceServer:
+    def __init__(self, pose_model, det_model, torch_threads=None, max_batch=MAX_BATCH, max_wait=MAX_WAIT,
+                 max_pending=MAX_PENDING):
+        # 各モデルは専用スレッドからしか呼ばれないので、同じモデルへの同時呼び出しで CPU を奪い合わない。
+        # torch_threads: 2モデル合計の PyTorch 演算スレッド数 (既定はコア数)。同時に動いているモデルの数で分ける
+        self.budget = ThreadBudget(torch_threads)
+        self.pose = ModelWorker("pose", pose_model, max_batch, max_wait, max_pending, self.budget)
+        self.det = ModelWorker("det", det_model, max_batch, max_wait, max_pending, self.budget)
+
+    def stats(self):
+        out = {}
+        for worker in (self.det, self.pose):
+            s = dict(worker.stats)
+            s["pending"] = worker.pending
+            s["mean_batch"] = round(s["frames"] / s["batches"], 2) if s["batches"] else 0.0
+            s["mean_wait_ms"] = round(s["wait_s"] / s["requests"] * 1000, 2) if s["requests"] else 0.0
+            out[worker.name] = s
+        return out
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def get_inference_server(backend="pytorch"):
+    # バックエンド (PyTorch / ONNX / OpenVINO) ごとに1つ
+    with _servers_lock:
+        if backend not in _servers:
+            from video_pipeline import load_yolo_models
+            pose_model, det_model, _ = load_yolo_models(backend)
+            _servers[backend] = InferenceServer(pose_model, det_model)
+    return _servers[backend]
+
+
+def running_servers():
+    # 起動済みの推論サーバー (統計表示用。ここではモデルを読み込まない)
+    with _servers_lock:
+        return dict(_servers)
+
+
+def load_shared_models(backend="pytorch"):
+    # load_yolo_models と同じ形 (pose, det, cv2) で、推論サーバー経由のモデルを返す
+    from video_pipeline import load_yolo_models
+    _, _, cv2 = load_yolo_models(backend)
+    server = get_inference_server(backend)
+    return server.pose, server.det, cv2
@@ -0,0 +1,170 @@
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+from sheet_history import ROW_ID_COL, new_row_id
+
+JOURNAL_DIR = os.path.join(".cache", "match_journal")
+FLUSH_INTERVAL = 10.0   # 秒: この間隔で未送信の行をまとめて history シートへ送る
+FLUSH_ROWS = 10         # 未送信がこの行数に達したら間隔を待たずに送る
+
+_journals = {}          # path → MatchJournal (プロセス内で開いている記録。ブラウザが閉じても送信は続く)
+_journals_lock = threading.Lock()
+
+
+# --- 試合入力の先行書き込みログ ---
+# 記録した行はまずローカルの JSONL に追記して fsync し (ブラウザ・サーバーが落ちても残る)、
+# シートへは裏のスレッドがまとめて追記する。試合終了時は残りの数行を送るだけで済む。
+class MatchJournal:
+    def __init__(self, path, history_sheet_fn, on_flush=None, flush_interval=FLUSH_INTERVAL, flush_rows=FLUSH_ROWS):
+        # history_sheet_fn: HistorySheet を返す関数。送信スレッドで初めて呼ぶ (Sheets に届かなくても記録はできる)
+        # on_flush: シートへ送った後に呼ぶ関数 (HistorySyncer.request_sync など)
+        self.path = path
+        self.history_sheet_fn = history_sheet_fn
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.rows = []          # この試合で記録した全行 (ログ表示・配給分析用)
+        self.pending = []       # まだシートへ送っていない行
+        self.created_at = time.time()
+        self.last_error = None
+        self.last_flush = None
+        self.finished = False
+        self._check_sent = False   # 読み戻した記録: 最初の送信前にシートにある RowID を除く
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._table = pd.DataFrame()
+        self._file = None
+        self._thread = None
+
+    @classmethod
+    def create(cls, history_sheet_fn, on_flush=None, root=JOURNAL_DIR):
+        os.makedirs(root, exist_ok=True)
+        path = os.path.join(root, f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}.jsonl")
+        journal = cls(path, history_sheet_fn, on_flush)
+        journal._open()
+        journal._write({"op": "open", "created_at": journal.created_at})
+        return journal
+
+    @classmethod
+    def load(cls, path, history_sheet_fn, on_flush=None):
+        # 落ちたサーバーの記録を読み戻す。送信済みの印が書けずに落ちた行は、送信前にシートの RowID で除く
+        journal = cls(path, history_sheet_fn, on_flush)
+        flushed = set()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue   # 書き込み途中で落ちた最後の行
+                if entry["op"] == "open": journal.created_at = entry["created_at"]
+                elif entry["op"] == "add": journal.rows.append(entry["row"])
+                elif entry["op"] == "flushed": flushed.update(entry["ids"])
+        journal.pending = [r for r in journal.rows if r[ROW_ID_COL] not in flushed]
+        journal._check_sent = bool(journal.pending)
+        journal._open()
+        return journal
+
+    def _open(self):
+        with _journals_lock:
+            if self.path in _journals: raise RuntimeError("この記録は他の画面で入力中です")
+            _journals[self.path] = self
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._run, name="match-journal", daemon=True)
+        self._thread.start()
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, row):
+        # 1行追記するだけ (O(1))。送信は裏のスレッドが行う
+        row = {**row, ROW_ID_COL: row.get(ROW_ID_COL) or new_row_id()}
+        with self._lock:
+            if self.finished: raise RuntimeError("この試合の記録は終了しています")
+            self._write({"op": "add", "row": row})
+            self.rows.append(row)
+            self.pending.append(row)
+            if len(self.pending) >= self.flush_rows: self._wake.set()
+        return row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def table(self):
+        # ログ表示用の DataFrame。前回から増えた行だけを足す (再描画のたびに全体を作り直さない)
+        with self._lock:
+            new_rows = self.rows[len(self._table):]
+        if new_rows:
+            self._table = pd.concat([self._table, pd.DataFrame(new_rows)], ignore_index=True)
+        return self._table
+
+    def flush(self):
+        # 未送信の行をまとめて history シートへ追記する。戻り値: 送った行数
+        with self._flush_lock:
+            if self._check_sent:
+                sent = self.history_sheet_fn().row_ids()
+                with self._lock:
+                    self.pending = [r for r in self.pending if r[ROW_ID_COL] not in sent]
+                self._check_sent = False
+            with self._lock:
+                batch = list(self.pending)
+            if not batch: return 0
+            self.history_sheet_fn().append(pd.DataFrame(batch))
+            with self._lock:
+                # 送っている間に記録された行は残す
+                del self.pending[:len(batch)]
+                self._write({"op": "flushed", "ids": [r[ROW_ID_COL] for r in batch]})
+            self.last_flush = time.time()
+        if self.on_flush:
+            try:
+                self.on_flush()
+            except Exception:
+                pass   # 同期の依頼は次の周期でも行われるので、失敗しても送信済みの扱いは変えない
+        return len(batch)
+
+    def _run(self):
+        while not self.finished:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self.finished: break
+            try:
+                self.flush()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e   # 行はローカルに残っているので次の周期で送り直す
+
+    def finish(self):
+        # 試合終了: 残りを送ってログを閉じる (送信に失敗したらログは残したまま例外を投げる)
+        sent = self.flush()
+        with self._lock:
+            self.finished = True
+            self._file.close()
+        self._wake.set()
+        os.remove(self.path)
+        with _journals_lock:
+            _journals.pop(self.path, None)
+        return sent
+
+
+def unfinished_journals(root=JOURNAL_DIR):
+    # 試合終了していない記録の一覧 [(path, 更新時刻, 行数)] (新しい順)。
+    # このプロセスで開いている記録 (入力中の試合・閉じたタブの試合) は除く。閉じたタブの分も送信は続いている
+    out = []
+    for path in glob.glob(os.path.join(root, "*.jsonl")):
+        with _journals_lock:
+            if path in _journals: continue
+        try:
+            with open(path, encoding="utf-8") as f:
+                rows = sum(1 for line in f if line.startswith('{"op": "add"'))
+            out.append((path, os.path.getmtime(path), rows))
+        except OSError:
+            continue
+    return sorted(out, key=lambda x: -x[1])
@@ -0,0 +1,112 @@
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+MODEL_DIR = os.path.join(".cache", "models")
+DEFAULT_BACKEND = "pytorch"
+# ultralytics の export 引数。dynamic=True にしておくとバッチ数・入力サイズを変えても同じモデルで推論できる
+BACKENDS = {
+    "pytorch": None,
+    "onnx": {"format": "onnx", "dynamic": True, "simplify": True},
+    "openvino": {"format": "openvino", "dynamic": True},
+    "openvino-int8": {"format": "openvino", "dynamic": True, "int8": True},
+}
+BACKEND_LABELS = {
+    "pytorch": "PyTorch (標準)",
+    "onnx": "ONNX Runtime",
+    "openvino": "OpenVINO (FP32)",
+    "openvino-int8": "OpenVINO (INT8 量子化)",
+}
+TASKS = {"yolov8n-pose.pt": "pose", "yolov8n.pt": "detect"}
+# INT8 量子化のキャリブレーション用データ (初回の変換時に ultralytics がダウンロードする)
+INT8_CALIBRATION = {"pose": "coco8-pose.yaml", "detect": "coco8.yaml"}
+WARMUP_SIZE = 640
+
+_export_lock = threading.Lock()
+
+
+def exported_path(model_name, backend):
+    stem = os.path.splitext(os.path.basename(model_name))[0]
+    suffix = ".onnx" if BACKENDS[backend]["format"] == "onnx" else "_openvino_model"
+    return os.path.join(MODEL_DIR, backend, stem + suffix)
+
+
+def export_model(model_name, backend):
+    # 変換済みなら再利用する。ultralytics はカレントディレクトリに書き出すので、完成してからキャッシュへ移す
+    path = exported_path(model_name, backend)
+    with _export_lock:
+        if os.path.exists(path): return path
+        from ultralytics import YOLO
+        options = dict(BACKENDS[backend])
+        if options.get("int8"):
+            options["data"] = INT8_CALIBRATION[TASKS.get(model_name, "detect")]
+        out = YOLO(model_name).export(**options)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(str(out), path)
+    return path
+
+
+def load_model(model_name, backend=DEFAULT_BACKEND):
+    from ultralytics import YOLO
+    if backend not in BACKENDS: raise ValueError(f"unknown backend: {backend}")
+    if BACKENDS[backend] is None: return YOLO(model_name)
+    return YOLO(export_model(model_name, backend), task=TASKS.get(model_name))
+
+
+def warm_up(model, size=WARMUP_SIZE, runs=2):
+    # 初回呼び出しのグラフ構築・メモリ確保を読み込み時に済ませておく (解析開始直後が遅くならないように)
+    dummy = np.zeros((size, size, 3), dtype=np.uint8)
+    for _ in range(runs):
+        model([dummy], verbose=False)
+
+
+# --- 精度チェック: 最適化バックエンドのイベント判定が PyTorch と一致するか ---
+def _run_clip(video_path, backend, max_frames, batch_size):
+    import cv2
+    from inference_cache import InferenceRecord
+    from inference_server import load_shared_models
+    from video_pipeline import FramePipeline
+    pose_model, det_model, _ = load_shared_models(backend)
+    t0 = time.perf_counter()
+    pipeline = FramePipeline(video_path, det_model, pose_model, cv2, batch_size=batch_size, end_frame=max_frames)
+    record = InferenceRecord({"height": pipeline.height, "fps": pipeline.fps})
+    for res in pipeline:
+        record.add(res.frame_idx, res.ball, res.keypoints, time_s=res.time_s)
+    return record, time.perf_counter() - t0
+
+
+def compare_backends(video_path, backend, baseline=DEFAULT_BACKEND, max_frames=900, end_line_percent_y=80,
+                     hit_distance=100, tolerance=5, batch_size=4):
+    # 動画の先頭 max_frames フレームを両方のバックエンドで解析し、イベント (tolerance フレーム以内・同じ種類) の一致率を返す
+    from video_pipeline import classify_record
+    base, base_s = _run_clip(video_path, baseline, max_frames, batch_size)
+    test, test_s = _run_clip(video_path, backend, max_frames, batch_size)
+    line_y = base.meta["height"] * (end_line_percent_y / 100)
+    base_events = classify_record(base, line_y, hit_distance)
+    test_events = classify_record(test, line_y, hit_distance)
+
+    unmatched = list(test_events)
+    matched = 0
+    for e in base_events:
+        hit = next((t for t in unmatched if t["Action"] == e["Action"] and abs(t["Frame"] - e["Frame"]) <= tolerance), None)
+        if hit is not None:
+            unmatched.remove(hit)
+            matched += 1
+
+    _, base_ball, _, _ = base.arrays()
+    _, test_ball, _, _ = test.arrays()
+    both = ~np.isnan(base_ball[:, 0]) & ~np.isnan(test_ball[:, 0])
+    either = ~np.isnan(base_ball[:, 0]) | ~np.isnan(test_ball[:, 0])
+    return {
+        "backend": backend, "baseline": baseline, "frames": len(base),
+        "baseline_events": len(base_events), "backend_events": len(test_events), "matched_events": matched,
+        "recall": round(matched / len(base_events), 3) if base_events else 1.0,
+        "precision": round(matched / len(test_events), 3) if test_events else 1.0,
+        "ball_agreement": round(both.sum() / either.sum(), 3) if either.any() else 1.0,
+        "ball_mean_error_px": round(float(np.linalg.norm(base_ball[both] - test_ball[both], axis=1).mean()), 2) if both.any() else None,
+        "baseline_s": round(base_s, 2), "backend_s": round(test_s, 2),
+        "speedup": round(base_s / test_s, 2) if test_s else None,
+    }
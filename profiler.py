@@ -0,0 +1,157 @@
+import json
+import os
+import platform
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_DIR = os.path.join(".cache", "profiles")
+MEMORY_SAMPLE_INTERVAL = 0.2   # 秒: 解析中にメモリ使用量を測る間隔
+
+
+def peak_memory_mb(children=False):
+    # プロセス起動からの最大値 (ベンチマークのような使い捨てプロセス用。解析ごとの値は AnalysisProfiler で測る)
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+        # Linux は KB、macOS は byte 単位
+        return usage.ru_maxrss / (1024 * 1024 if platform.system() == "Darwin" else 1024)
+    except ImportError:
+        return None
+
+
+def current_memory_mb():
+    # 今の常駐メモリ (RSS)。/proc が無い環境では psutil があれば使う
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"): return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        return None
+
+
+def environment_info():
+    info = {"platform": platform.platform(), "python": platform.python_version(), "cpu_count": os.cpu_count()}
+    for name in ("torch", "ultralytics", "cv2", "numpy"):
+        try:
+            module = __import__(name)
+            info[name] = getattr(module, "__version__", "?")
+        except ImportError:
+            pass
+    try:
+        import torch
+        info["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+# --- 解析ループの段階別タイマーとスループット計測 ---
+class AnalysisProfiler:
+    def __init__(self, settings=None):
+        self.settings = dict(settings or {})
+        self.started = time.perf_counter()
+        self.finished = None
+        self._stages = {}    # 名前 → [合計秒, 回数]
+        self._counters = {}
+        self._lock = threading.Lock()
+        # メモリは解析の開始から finish() まで裏で測る (ru_maxrss はサーバー起動からの最大値で解析ごとに比べられない)
+        self._memory_start = current_memory_mb()
+        self._memory_peak = self._memory_start
+        self._memory_shards = None   # シャードのプロセスごとの最大値のうち最大のもの
+        self._stop = threading.Event()
+        if self._memory_start is not None:
+            threading.Thread(target=self._sample_memory, name="profiler-memory", daemon=True).start()
+
+    def _sample_memory(self):
+        while not self._stop.wait(MEMORY_SAMPLE_INTERVAL):
+            self._update_memory()
+
+    def _update_memory(self):
+        mb = current_memory_mb()
+        if mb is None: return
+        with self._lock:
+            self._memory_peak = max(self._memory_peak, mb)
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
+
+    def add_time(self, name, seconds, calls=1):
+        with self._lock:
+            entry = self._stages.setdefault(name, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set_count(self, name, n):
+        with self._lock:
+            self._counters[name] = n
+
+    def merge(self, snapshot):
+        # 別プロセス (シャード) の計測結果を足し込む
+        for name, s in snapshot.get("stages", {}).items():
+            self.add_time(name, s["total_s"], s["calls"])
+        for name, n in snapshot.get("counters", {}).items():
+            self.count(name, n)
+        mb = snapshot.get("peak_memory_mb")
+        if mb is not None:
+            with self._lock:
+                self._memory_shards = max(self._memory_shards or 0.0, mb)
+
+    def finish(self):
+        self.finished = time.perf_counter()
+        self._stop.set()
+        if self._memory_start is not None: self._update_memory()
+
+    def snapshot(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        if self.finished is None and self._memory_start is not None: self._update_memory()
+        with self._lock:
+            stages = {name: {"total_s": round(total, 4), "calls": calls,
+                             "mean_ms": round(total / calls * 1000, 3) if calls else 0.0}
+                      for name, (total, calls) in self._stages.items()}
+            counters = dict(self._counters)
+            memory = {"peak_memory_mb": self._memory_peak, "start_memory_mb": self._memory_start,
+                      "peak_memory_shards_mb": self._memory_shards}
+        memory = {k: round(v, 1) if v is not None else None for k, v in memory.items()}
+        throughput = {}
+        if elapsed > 0:
+            for name in ("frames_decoded", "frames_inferred"):
+                if name in counters: throughput[name.replace("frames_", "") + "_fps"] = round(counters[name] / elapsed, 2)
+        return {"elapsed_s": round(elapsed, 3), "stages": stages, "counters": counters, "throughput": throughput,
+                **memory, "settings": self.settings}
+
+    def save(self, name, extra=None, root=PROFILE_DIR):
+        os.makedirs(root, exist_ok=True)
+        data = {"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment_info(),
+                **self.snapshot(), **(extra or {})}
+        path = os.path.join(root, f"{time.strftime('%Y%m%d_%H%M%S')}_{name}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+        return path, data
+
+
+class NullProfiler:
+    # 計測しないときの置き換え (呼び出し側で if を書かなくて済むように)
+    @contextmanager
+    def stage(self, name):
+        yield
+
+    def add_time(self, name, seconds, calls=1):
+        pass
+
+    def count(self, name, n=1):
+        pass
@@ -0,0 +1,81 @@
+import copy
+import threading
+import time
+
+ROSTER_TTL = 300  # 秒: これより古い名簿は裏で読み直す (読み直している間は古い名簿を返す)
+
+# players シートが空のときの初期名簿
+DEFAULT_ROSTER = {
+    "My Team": {"#1 田中": "OH", "#2 佐藤": "MB", "#3 鈴木": "OP", "#4 高橋": "OH", "#5 渡辺": "MB", "#6 山本": "L"},
+    "Opponent A": {"#1 敵A": "OH", "#2 敵B": "MB", "#3 敵C": "OP", "#4 敵D": "OH", "#5 敵E": "MB", "#6 敵L": "L"},
+}
+
+
+def parse_roster(records):
+    # players シートの行 (Team / PlayerKey / Position) → {チーム: {選手: ポジション}}
+    if not records: return copy.deepcopy(DEFAULT_ROSTER)
+    db = {}
+    for row in records:
+        db.setdefault(str(row["Team"]), {})[str(row["PlayerKey"])] = str(row["Position"])
+    return db
+
+
+# --- プロセス全体で共有する名簿 (全セッションが同じものを使い、シートは TTL ごとに1回だけ読む) ---
+class RosterCache:
+    def __init__(self, loader, ttl=ROSTER_TTL):
+        # loader: 名簿 dict を返す関数 (裏のスレッドから呼ぶので Streamlit の API は使わないこと)
+        self.loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._roster = None
+        self._loaded_at = 0.0
+        self._thread = None
+        self.version = 0      # 名簿が変わるたびに増える (セッション側の差し替え判定用)
+        self.error = None
+
+    @property
+    def stale(self):
+        return self._roster is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def prefetch(self):
+        # 古ければ裏で読み直しを始める (すでに読んでいる最中なら何もしない)
+        with self._lock:
+            if not self.stale or (self._thread is not None and self._thread.is_alive()): return
+            if self._roster is None: self._ready.clear()
+            self._thread = threading.Thread(target=self._load, name="roster-load", daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        try:
+            roster = self.loader()
+        except Exception as e:
+            self.error = e
+        else:
+            self._set(roster)
+        finally:
+            self._ready.set()
+
+    def _set(self, roster):
+        with self._lock:
+            self._roster = copy.deepcopy(roster)
+            self._loaded_at = time.monotonic()
+            self.version += 1
+            self.error = None
+
+    def get(self, wait=True, timeout=None):
+        # (版, 名簿のコピー)。wait=False なら読み込み前は (版, None) をすぐ返す
+        self.prefetch()
+        if wait and self._roster is None:
+            self._ready.wait(timeout)
+        with self._lock:
+            return self.version, copy.deepcopy(self._roster) if self._roster is not None else None
+
+    def invalidate(self, roster=None):
+        # シートへ保存したときに呼ぶ。保存した内容が分かっていればそれを新しい名簿にする (読み直し不要)
+        if roster is not None:
+            self._set(roster)
+            return
+        with self._lock:
+            self._loaded_at = 0.0
+        self.prefetch()
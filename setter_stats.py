@@ -0,0 +1,87 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+PASS_ORDER = ["Aパス", "Bパス", "Cパス", "その他", "相手サーブミス", "失敗 (エース)"]
+ZONE_ORDER = ["レフト(L)", "センター(C)", "ライト(R)", "レフトバック(LB)", "センターバック(CB)", "ライトバック(RB)", "なし"]
+ALL_SETTERS = "全員"
+KILL_RESULT = "得点 (Kill)"
+KEY_COLUMNS = ["Team", "Setter", "Pass", "Zone", "Result"]
+
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+_MEMO_SIZE = 8
+
+
+def data_fingerprint(df):
+    # 集計に使う列だけをハッシュする (行の並びも含めて同じなら同じ値)
+    cols = [c for c in KEY_COLUMNS if c in df.columns]
+    if df.empty or not cols: return (0, tuple(cols))
+    hashed = pd.util.hash_pandas_object(df[cols], index=False).to_numpy()
+    return (len(df), tuple(cols), hashlib.sha1(hashed.tobytes()).hexdigest())
+
+
+def _matrix_columns():
+    cols = []
+    for z_label in ZONE_ORDER:
+        cols += [f"{z_label} (配)", f"{z_label} (決)"]
+    return cols
+
+
+def compute_distribution_tables(df):
+    # 全チーム × (全員 + 各セッター) の「レセプション × ゾーン」配給率・決定率を一度の groupby で作る
+    # 戻り値: {(チーム, セッター): 行=Pass, 列=「ゾーン (配)」「ゾーン (決)」の DataFrame}
+    if df.empty or not {"Team", "Pass", "Zone"}.issubset(df.columns): return {}
+    d = pd.DataFrame({
+        "Team": df["Team"].astype(str).to_numpy(),
+        "Setter": df["Setter"].astype(str).to_numpy() if "Setter" in df.columns else ALL_SETTERS,
+        "Pass": df["Pass"].to_numpy(),
+        "Zone": df["Zone"].to_numpy(),
+        "has_result": df["Result"].notna().to_numpy() if "Result" in df.columns else False,
+        "kill": (df["Result"] == KILL_RESULT).to_numpy() if "Result" in df.columns else False,
+    })
+    d = d[d["Pass"].isin(PASS_ORDER)]
+    # 「全員」はチーム単位の集計として、セッター別の行と同じ表に積んで一緒に集計する
+    stacked = pd.concat([d, d.assign(Setter=ALL_SETTERS)], ignore_index=True) if "Setter" in df.columns else d
+    by_pass = stacked.groupby(["Team", "Setter", "Pass"], sort=False).size()
+    cells = stacked.groupby(["Team", "Setter", "Pass", "Zone"], sort=False).agg(
+        attempts=("has_result", "sum"), kills=("kill", "sum"))
+
+    totals = by_pass.reindex(cells.index.droplevel("Zone")).to_numpy()
+    attempts = cells["attempts"].to_numpy()
+    cells["dist"] = np.where(totals > 0, attempts / np.maximum(totals, 1) * 100, 0.0)
+    cells["kill_rate"] = np.where(attempts > 0, cells["kills"].to_numpy() / np.maximum(attempts, 1) * 100, 0.0)
+
+    wide = cells[["dist", "kill_rate"]].unstack("Zone")
+    wide = wide.reindex(columns=pd.MultiIndex.from_product([["dist", "kill_rate"], ZONE_ORDER]))
+    wide = wide.reindex(by_pass.index).fillna(0.0)
+    # 列を「ゾーン (配)」「ゾーン (決)」の交互の並びにする
+    matrix = pd.DataFrame(
+        np.stack([wide["dist"].to_numpy(), wide["kill_rate"].to_numpy()], axis=2).reshape(len(wide), -1),
+        index=wide.index, columns=_matrix_columns())
+
+    tables = {}
+    pass_rank = {p: i for i, p in enumerate(PASS_ORDER)}
+    for (team, setter), block in matrix.groupby(level=["Team", "Setter"], sort=False):
+        block = block.droplevel(["Team", "Setter"])
+        block = block.iloc[np.argsort([pass_rank[p] for p in block.index], kind="stable")]
+        block.index.name = "Pass"
+        tables[(team, setter)] = block
+    return tables
+
+
+def distribution_tables(df, fingerprint=None):
+    # データの指紋が同じなら前回の結果を返す (チーム・セッターの切り替えは辞書引きだけになる)
+    key = fingerprint if fingerprint is not None else data_fingerprint(df)
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+    tables = compute_distribution_tables(df)
+    with _memo_lock:
+        _memo[key] = tables
+        while len(_memo) > _MEMO_SIZE: _memo.popitem(last=False)
+    return tables
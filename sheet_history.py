@@ -0,0 +1,228 @@
+import threading
+import time
+import uuid
+
+import pandas as pd
+
+HISTORY_SHEET = "history"
+ROW_ID_COL = "RowID"        # 行ごとの不変ID (差分保存で行を特定するのに使う)
+LEGACY_ROW_PREFIX = "row:"  # RowID の無い古い行に読み込み時だけ振る仮ID (row:<シートの行番号>)
+APPEND_CHUNK_ROWS = 500   # 1回の append で送る最大行数 (リクエストサイズとクォータ対策)
+MAX_RETRIES = 5
+
+
+def _status_code(e):
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None) or getattr(e, "code", None)
+
+
+def with_retry(fn, *args, **kwargs):
+    # 429 (クォータ超過) と 5xx は指数バックオフで再試行する
+    import gspread
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            code = _status_code(e)
+            if attempt == MAX_RETRIES or not (code == 429 or (code or 0) >= 500): raise
+            time.sleep(min(2 ** attempt, 32))
+
+
+def new_row_id():
+    return uuid.uuid4().hex[:12]
+
+
+def _normalize(df, header):
+    return df.reindex(columns=header).fillna("").astype(str)
+
+
+def _col_letter(n):
+    letters = ""
+    while n > 0:
+        n, r = divmod(n - 1, 26)
+        letters = chr(65 + r) + letters
+    return letters
+
+
+# --- history シートの読み書き (ヘッダーはプロセス内にキャッシュし、追記時にシート全体を読まない) ---
+class HistorySheet:
+    def __init__(self, worksheet, reopen=None):
+        # reopen: シートが削除・再作成されたときに新しいワークシートを返す関数 (GoogleClients.reopen_worksheet など)
+        self.ws = worksheet
+        self.reopen = reopen
+        self._header = None
+        self._lock = threading.RLock()
+
+    def reopen_worksheet(self):
+        with self._lock:
+            if self.reopen is None: return
+            self.ws = self.reopen()
+            self._header = None
+
+    def remember_header(self, header):
+        self._header = list(header)
+
+    def header(self):
+        if self._header is None:
+            self._header = with_retry(self.ws.row_values, 1)
+        return self._header
+
+    def _write_header(self, header):
+        if len(header) > self.ws.col_count:
+            with_retry(self.ws.add_cols, len(header) - self.ws.col_count)
+        with_retry(self.ws.update, range_name=f"A1:{_col_letter(len(header))}1", values=[header])
+        self._header = list(header)
+
+    def append(self, df):
+        # 新しい行だけを送る (O(追記行数))。列構成が違えばヘッダーに足りない列を追加してから並べ替える
+        if df.empty: return 0
+        df = df.copy()
+        if ROW_ID_COL not in df.columns: df[ROW_ID_COL] = ""
+        ids = df[ROW_ID_COL].fillna("").astype(str)
+        df[ROW_ID_COL] = [rid if rid and not rid.startswith(LEGACY_ROW_PREFIX) else new_row_id() for rid in ids]
+        with self._lock:
+            header = self.header()
+            if not header:
+                self._write_header(df.columns.tolist())
+            else:
+                missing = [c for c in df.columns if c not in header]
+                if missing:
+                    self._write_header(header + missing)
+            rows = df.reindex(columns=self._header, fill_value="").astype(str).values.tolist()
+            for i in range(0, len(rows), APPEND_CHUNK_ROWS):
+                with_retry(self.ws.append_rows, rows[i:i + APPEND_CHUNK_ROWS])
+            return len(rows)
+
+    def overwrite(self, df):
+        with self._lock:
+            with_retry(self.ws.clear)
+            self._header = []
+            if not df.empty:
+                data = [df.columns.tolist()] + df.astype(str).values.tolist()
+                with_retry(self.ws.update, data)
+                self._header = df.columns.tolist()
+
+    def read_all(self):
+        data = with_retry(self.ws.get_all_values)
+        self._header = data[0] if data else []
+        if not data: return pd.DataFrame()
+        headers = data[0]
+        if "Match" not in headers: return pd.DataFrame()
+        rows = data[1:]
+        if not rows: return pd.DataFrame(columns=headers)
+        df = pd.DataFrame(rows, columns=headers)
+        # RowID が空の古い行には、シートの行番号から仮IDを振っておく (保存時に本物のIDを書き込む)
+        legacy = [f"{LEGACY_ROW_PREFIX}{i + 2}" for i in range(len(df))]
+        if ROW_ID_COL in df.columns:
+            df[ROW_ID_COL] = [rid or leg for rid, leg in zip(df[ROW_ID_COL].fillna(""), legacy)]
+        else:
+            df[ROW_ID_COL] = legacy
+        return df
+
+    def backfill_row_ids(self, data):
+        # data: get_all_values() の結果。RowID が空の行に本物のIDを書き込み、書けたら data も同じ値にする。
+        # 一度埋めれば、以後は行番号の仮ID (row:N) で行を探さずに済む。戻り値: 書き込んだ行数
+        if not data or "Match" not in data[0]: return 0
+        with self._lock:
+            header = list(data[0])
+            col = header.index(ROW_ID_COL) if ROW_ID_COL in header else len(header)
+            fill = {i: new_row_id() for i, row in enumerate(data[1:], start=1) if len(row) <= col or not row[col]}
+            if not fill: return 0
+            if col == len(header):
+                self._write_header(header + [ROW_ID_COL])
+                data[0] = header + [ROW_ID_COL]
+            letter = _col_letter(col + 1)
+            with_retry(self.ws.batch_update, [{"range": f"{letter}{i + 1}", "values": [[rid]]} for i, rid in fill.items()])
+            for i, rid in fill.items():
+                data[i] = data[i] + [""] * (col + 1 - len(data[i]))
+                data[i][col] = rid
+            return len(fill)
+
+    def _legacy_rows_match(self, rows, orig, header):
+        # 仮ID (row:N) の行が、読み込んだときと同じ内容のままシートの N 行目にあるか確かめる
+        # (複製が古い・シートが直接編集された場合に、別の行を上書き・削除しないように)
+        if not rows: return {}
+        last_col = _col_letter(len(header))
+        ranges = with_retry(self.ws.batch_get, [f"A{row}:{last_col}{row}" for row in rows.values()])
+        ok = {}
+        for (rid, row), values in zip(rows.items(), ranges):
+            current = (list(values[0]) if values else []) + [""] * len(header)
+            expected = orig.loc[rid, header].tolist()
+            ok[rid] = all(current[i] == expected[i] for i, c in enumerate(header) if c != ROW_ID_COL) \
+                and current[header.index(ROW_ID_COL)] == ""
+        return ok
+
+    def row_ids(self):
+        # シートにある RowID の集合 (RowID 列だけを読む)
+        header = self.header()
+        if ROW_ID_COL not in header: return set()
+        return set(self._row_numbers(header))
+
+    def _row_numbers(self, header):
+        # 保存直前に RowID 列だけを読み、ID → 現在のシート行番号 を引けるようにする
+        ids = with_retry(self.ws.col_values, header.index(ROW_ID_COL) + 1)
+        return {rid: i + 1 for i, rid in enumerate(ids) if i > 0 and rid}
+
+    def save_diff(self, original, edited):
+        # original: 編集前の行 / edited: 編集後の行 (どちらも RowID 列を含む)。
+        # 追加・削除・変更された行だけを送るので、保存コストは履歴全体ではなく編集量に比例する
+        with self._lock:
+            header = self.header()
+            if ROW_ID_COL not in header:
+                self._write_header(header + [ROW_ID_COL])
+            header = [c for c in self._header]
+            extra = [c for c in edited.columns if c not in header]
+            if extra:
+                self._write_header(header + extra)
+                header = list(self._header)
+
+            orig = _normalize(original, header).set_index(ROW_ID_COL, drop=False)
+            orig = orig[~orig.index.duplicated()]
+            new = _normalize(edited, header)
+            is_new = new[ROW_ID_COL].eq("") | ~new[ROW_ID_COL].isin(orig.index)
+            inserted = new[is_new]
+            kept = new[~is_new].set_index(ROW_ID_COL, drop=False)
+            kept = kept[~kept.index.duplicated()]
+            deleted_ids = orig.index.difference(kept.index)
+            common = kept.index
+            changed = (kept.loc[common, header] != orig.loc[common, header]).any(axis=1)
+            modified = kept.loc[common[changed.values]]
+
+            if len(modified) == 0 and len(deleted_ids) == 0 and len(inserted) == 0:
+                return {"updated": 0, "inserted": 0, "deleted": 0, "missing": 0}
+
+            row_of = self._row_numbers(header) if (len(modified) or len(deleted_ids)) else {}
+
+            legacy = {rid: int(rid[len(LEGACY_ROW_PREFIX):]) for rid in list(modified.index) + list(deleted_ids)
+                      if rid.startswith(LEGACY_ROW_PREFIX)}
+            legacy_ok = self._legacy_rows_match(legacy, orig, header)
+
+            def locate(rid):
+                if rid in legacy: return legacy[rid] if legacy_ok[rid] else None
+                return row_of.get(rid)
+
+            missing = 0
+            updates = []
+            last_col = _col_letter(len(header))
+            for rid, values in zip(modified.index, modified[header].values.tolist()):
+                row = locate(rid)
+                if row is None:
+                    missing += 1
+                    continue
+                if rid.startswith(LEGACY_ROW_PREFIX):
+                    values[header.index(ROW_ID_COL)] = new_row_id()
+                updates.append({"range": f"A{row}:{last_col}{row}", "values": [values]})
+            if updates:
+                with_retry(self.ws.batch_update, updates)
+
+            # 行削除は下から順に1回のリクエストで行う (上の行番号がずれないように)
+            delete_rows = sorted({r for r in map(locate, deleted_ids) if r is not None}, reverse=True)
+            missing += len(deleted_ids) - len(delete_rows)
+            if delete_rows:
+                requests = [{"deleteDimension": {"range": {"sheetId": self.ws.id, "dimension": "ROWS",
+                                                           "startIndex": r - 1, "endIndex": r}}} for r in delete_rows]
+                with_retry(self.ws.spreadsheet.batch_update, {"requests": requests})
+
+            if len(inserted):
+                self.append(inserted.assign(**{ROW_ID_COL: ""}))
+            return {"updated": len(updates), "inserted": len(inserted), "deleted": len(delete_rows), "missing": missing}
@@ -0,0 +1,579 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from inference_cache import InferenceRecord
+from profiler import NullProfiler
+
+# キーポイントID (YOLOv8 Pose)
+KP_NOSE = 0
+KP_R_WRIST = 10
+KP_L_WRIST = 9
+KP_R_ANKLE = 16
+KP_L_ANKLE = 15
+
+BALL_CLASS_ID = 32  # COCO: sports ball
+BALL_CONF = 0.3
+POSE_CONF = 0.5
+POSE_MODEL_NAME = 'yolov8n-pose.pt'
+DET_MODEL_NAME = 'yolov8n.pt'
+EVENT_COLUMNS = ["Time(s)", "Action", "Frame"]
+DEFAULT_FPS = 30.0  # コンテナから FPS が取れないときだけ使う
+
+_END = object()
+
+
+# --- 1フレーム分の推論結果 ---
+@dataclass
+class FrameResult:
+    frame_idx: int
+    frame: np.ndarray
+    ball: tuple | None       # ボール中心 (cx, cy)。未検出なら None
+    keypoints: np.ndarray    # (人数, 17, 2)
+    pose_result: object = None  # 描画 (plot) 用に ultralytics の結果を保持
+    ball_track: tuple | None = None  # ボール追跡時のみ (vx, vy, 取得方法)
+    time_s: float | None = None      # コンテナの表示時刻 (PTS)
+    offset: tuple = (0, 0)           # コート領域で切り出したときの左上座標 (frame は切り出し後の画像)
+
+
+def _put(q, item, stop):
+    # 停止要求が来るまでブロックせずに待つ (キューが満杯ならバックプレッシャー)
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q, stop):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def _ball_center(ball_result):
+    if len(ball_result.boxes) == 0:
+        return None
+    box = ball_result.boxes[0]
+    bx1, by1, bx2, by2 = box.xyxy[0].cpu().numpy()
+    return ((bx1 + bx2) / 2, (by1 + by2) / 2)
+
+
+def _pose_keypoints(pose_result):
+    if pose_result.keypoints is None:
+        return np.zeros((0, 17, 2), dtype=np.float32)
+    return pose_result.keypoints.xy.cpu().numpy()
+
+
+def _to_full_frame(res, offset):
+    # 切り出し画像の座標を元のフレームの座標に戻す (未検出のキーポイント (0, 0) はそのまま)
+    ox, oy = offset
+    if res.ball is not None:
+        res.ball = (res.ball[0] + ox, res.ball[1] + oy)
+    if len(res.keypoints):
+        missing = (res.keypoints[..., 0] == 0) & (res.keypoints[..., 1] == 0)
+        res.keypoints = res.keypoints + np.array([ox, oy], dtype=res.keypoints.dtype)
+        res.keypoints[missing] = 0
+    res.offset = offset
+
+
+# --- 2つのYOLOモデルをNフレームまとめて実行 ---
+def infer_batch(det_model, pose_model, batch, profiler=None, tracker=None, imgsz=None):
+    # tracker: ball_tracker.BallTracker。指定時は全画面のボール検出を間引き、切り出し検出と予測で補う
+    # imgsz: モデルの入力サイズ (None ならモデルの既定 640)
+    profiler = profiler or NullProfiler()
+    frames = [frame for _, frame in batch]
+    size = {"imgsz": imgsz} if imgsz else {}
+    det_kwargs = {"classes": [BALL_CLASS_ID], "conf": BALL_CONF, "verbose": False, **size}
+    with profiler.stage("ball_detect"):
+        if tracker is None:
+            balls = [(_ball_center(br), None) for br in det_model(frames, **det_kwargs)]
+        else:
+            balls = tracker.process(det_model, batch, det_kwargs)
+    with profiler.stage("pose"):
+        pose_results = pose_model(frames, conf=POSE_CONF, verbose=False, **size)
+    profiler.count("frames_inferred", len(frames))
+    results = []
+    for (frame_idx, frame), (ball, track), pr in zip(batch, balls, pose_results):
+        results.append(FrameResult(frame_idx, frame, ball, _pose_keypoints(pr), pr, track))
+    return results
+
+
+# --- フレーム間引き (サンプラー) ---
+class FixedSampler:
+    # 従来どおり Nフレームに1回処理
+    def __init__(self, every=3):
+        self.every = max(1, int(every))
+        self.stats = {"frames_decoded": 0, "frames_sampled": 0, "frames_skipped": 0}
+
+    def decide(self, frame_idx, frame):
+        self.stats["frames_decoded"] += 1
+        take = frame_idx % self.every == 0
+        self.stats["frames_sampled" if take else "frames_skipped"] += 1
+        return take
+
+
+class MotionSampler:
+    # 縮小グレースケールのフレーム差分で動きを測り、静止区間は間引き、速いプレー中は密に処理する
+    # 処理するかどうかは直前フレームとの差分と絶対フレーム番号だけで決める (シャード解析でも逐次解析と同じフレームになる)
+    # 動きの量は「pixel_threshold より明るさが変わった画素の割合 (%)」。差分の平均だと静止した背景に薄められ、
+    # 引きのカメラで小さく写る選手やボールの動きが静止と区別できない (1920px の動画で直径10px のボールでも約0.015%)
+    def __init__(self, cv2, base_every=3, active_every=1, idle_every=15,
+                 low_threshold=0.01, high_threshold=1.0, probe_width=320, pixel_threshold=15):
+        self.cv2 = cv2
+        self.base_every = max(1, int(base_every))
+        self.active_every = max(1, int(active_every))
+        self.idle_every = max(1, int(idle_every))
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        self.probe_width = probe_width
+        self.pixel_threshold = pixel_threshold
+        self._prev = None
+        self.stats = {"frames_decoded": 0, "frames_sampled": 0, "frames_skipped": 0,
+                      "frames_idle": 0, "frames_active": 0}
+
+    def _motion(self, frame):
+        cv2 = self.cv2
+        h, w = frame.shape[:2]
+        small = cv2.resize(frame, (self.probe_width, max(1, h * self.probe_width // w)), interpolation=cv2.INTER_AREA)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        prev, self._prev = self._prev, gray
+        if prev is None: return None
+        return float((cv2.absdiff(gray, prev) > self.pixel_threshold).mean() * 100)
+
+    def decide(self, frame_idx, frame):
+        self.stats["frames_decoded"] += 1
+        motion = self._motion(frame)
+        if motion is None:
+            interval = self.base_every
+        elif motion >= self.high_threshold:
+            interval = self.active_every
+            self.stats["frames_active"] += 1
+        elif motion < self.low_threshold:
+            interval = self.idle_every
+            self.stats["frames_idle"] += 1
+        else:
+            interval = self.base_every
+        take = frame_idx % interval == 0
+        self.stats["frames_sampled" if take else "frames_skipped"] += 1
+        return take
+
+
+def make_sampler(cv2, sample_every=3, motion=None):
+    # motion: MotionSampler の引数 dict (プロセス間で渡せるよう dict で持つ)。None なら固定間引き
+    if motion is None:
+        return FixedSampler(sample_every)
+    return MotionSampler(cv2, base_every=sample_every, **motion)
+
+
+# --- フレームパイプライン: デコードスレッド → 推論スレッド → 呼び出し側 (イベント判定/描画) ---
+class FramePipeline:
+    def __init__(self, video_path, det_model, pose_model, cv2, batch_size=4, queue_size=None, sample_every=3,
+                 start_frame=0, end_frame=None, sampler=None, follow=None, profiler=None, tracker=None,
+                 crop=None, imgsz=None):
+        # follow: 受信途中のファイルを追いかける場合の DriveDownload (current_path / is_growing を持つもの)
+        # profiler: 段階別の時間を測る AnalysisProfiler (省略時は計測しない)
+        # crop: コート領域 (left, top, right, bottom) を画面に対する割合で。推論はこの範囲だけで行い、座標は元のフレームに戻す
+        self.cv2 = cv2
+        self.crop = crop
+        self.crop_box = None
+        self.imgsz = imgsz
+        self._pts = {}
+        self.profiler = profiler or NullProfiler()
+        self.tracker = tracker
+        self.follow = follow
+        self._tail_checked = False
+        self.det_model = det_model
+        self.pose_model = pose_model
+        self.batch_size = max(1, int(batch_size))
+        self.sampler = sampler or FixedSampler(sample_every)
+        self.cap = cv2.VideoCapture(video_path)
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.total_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.fps = fps if fps and fps > 0 and fps == fps else DEFAULT_FPS
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        if start_frame > 0:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+        # キューは有限長: デコードが推論より速くてもメモリを食い潰さない
+        queue_size = queue_size or self.batch_size * 4
+        self._frames = queue.Queue(maxsize=queue_size)
+        self._results = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._threads = []
+        self._error = None
+
+    def _decode(self):
+        try:
+            frame_idx = self.start_frame
+            while not self._stop.is_set():
+                if self.end_frame is not None and frame_idx >= self.end_frame: break
+                with self.profiler.stage("decode"):
+                    ret, frame = self.cap.read() if self.cap.isOpened() else (False, None)
+                if not ret:
+                    if self._wait_for_more(frame_idx): continue
+                    break
+                frame_idx += 1
+                self.profiler.count("frames_decoded")
+                if self.height <= 0:
+                    self.height, self.width = frame.shape[:2]
+                if self.crop is not None:
+                    if self.crop_box is None:
+                        from court_calibration import CourtRegion
+                        self.crop_box = CourtRegion(*self.crop).to_pixels(self.width, self.height)
+                    x0, y0, x1, y1 = self.crop_box
+                    frame = frame[y0:y1, x0:x1]
+                with self.profiler.stage("sample"):
+                    take = self.sampler.decide(frame_idx, frame)
+                if not take:
+                    self.profiler.count("frames_skipped")
+                    continue
+                self._pts[frame_idx] = self.cap.get(self.cv2.CAP_PROP_POS_MSEC) / 1000.0
+                if not _put(self._frames, (frame_idx, frame), self._stop): break
+        except Exception as e:
+            self._error = e
+        finally:
+            _put(self._frames, _END, self._stop)
+
+    def _wait_for_more(self, frame_idx):
+        # ダウンロード中のファイルは伸びるのを待って開き直し、続きのフレームから読む
+        if self.follow is None or self._tail_checked: return False
+        if self.follow.is_growing():
+            self._stop.wait(1.0)
+        else:
+            self._tail_checked = True  # 完了後に末尾を一度だけ読み直す
+        self.cap.release()
+        self.cap = self.cv2.VideoCapture(self.follow.current_path())
+        if frame_idx > 0 and self.cap.isOpened():
+            self.cap.set(self.cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        return True
+
+    def _infer(self):
+        try:
+            done = False
+            while not done and not self._stop.is_set():
+                batch = []
+                while len(batch) < self.batch_size:
+                    item = _get(self._frames, self._stop)
+                    if item is _END:
+                        done = True
+                        break
+                    batch.append(item)
+                if not batch: continue
+                for result in infer_batch(self.det_model, self.pose_model, batch, self.profiler, self.tracker, self.imgsz):
+                    if self.crop_box is not None: _to_full_frame(result, self.crop_box[:2])
+                    result.time_s = self._pts.pop(result.frame_idx, None)
+                    if not _put(self._results, result, self._stop): return
+        except Exception as e:
+            self._error = e
+        finally:
+            _put(self._results, _END, self._stop)
+
+    def __iter__(self):
+        self._threads = [
+            threading.Thread(target=self._decode, name="frame-decoder", daemon=True),
+            threading.Thread(target=self._infer, name="frame-inference", daemon=True),
+        ]
+        for t in self._threads: t.start()
+        try:
+            while True:
+                item = _get(self._results, self._stop)
+                if item is _END: break
+                yield item
+            if self._error is not None:
+                raise self._error
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+        for t in self._threads:
+            t.join(timeout=5)
+        self.cap.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# --- プレビュー描画ポリシー ---
+@dataclass
+class PreviewPolicy:
+    max_fps: float = 5.0     # プレビュー更新の上限 (0 = 制限なし)
+    max_width: int = 640     # プレビュー画像の最大幅 (0 = 元解像度)
+    headless: bool = False   # True なら描画を一切行わない (進捗とイベント数のみ)
+    _last_render: float = field(default=0.0, init=False, repr=False)
+
+    def should_render(self):
+        if self.headless: return False
+        now = time.monotonic()
+        if self.max_fps > 0 and now - self._last_render < 1.0 / self.max_fps: return False
+        self._last_render = now
+        return True
+
+
+def render_preview(cv2, res, action, line_y_int, max_width=0):
+    # 描画・色変換・縮小はプレビューを送るフレームだけで行う (コート領域で切り出した場合は切り出し後の画像に描く)
+    annotated_frame = res.pose_result.plot()
+    width = annotated_frame.shape[1]
+    ox, oy = res.offset
+    if res.ball is not None:
+        cv2.circle(annotated_frame, (int(res.ball[0] - ox), int(res.ball[1] - oy)), 10, (0, 255, 255), -1)
+    if action:
+        cv2.putText(annotated_frame, f"{action}!", (50, 150), cv2.FONT_HERSHEY_SIMPLEX, 3, (0, 0, 255), 5)
+    cv2.line(annotated_frame, (0, line_y_int - oy), (width, line_y_int - oy), (255, 0, 0), 3)
+    if max_width and width > max_width:
+        scale = max_width / width
+        annotated_frame = cv2.resize(annotated_frame, (max_width, int(annotated_frame.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(annotated_frame, cv2.COLOR_BGR2RGB)
+
+
+# --- イベント判定 (サーブ / スパイク) ---
+def detect_contacts(ball, keypoints, person_frame, line_y, hit_distance=100):
+    # フレームのバッチ全体・全員・両手をまとめて判定する (クールダウンは考慮しない)
+    #   ball: (F, 2) 未検出は NaN / keypoints: (P, 17, 2) / person_frame: (P,) 各人物が属するフレームの行番号
+    # 戻り値: (行番号, サーブか, 人物番号, 手 0=右 1=左) の配列。各フレームで最初に当たった人物を採用 (右手優先)
+    if len(keypoints) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, np.empty(0, dtype=bool), empty, empty
+    nose = keypoints[:, KP_NOSE]                              # (P, 2)
+    wrists = keypoints[:, [KP_R_WRIST, KP_L_WRIST]]           # (P, 2手, 2)
+    ankles = keypoints[:, [KP_R_ANKLE, KP_L_ANKLE]]           # (P, 2足, 2)
+    b = ball[person_frame]                                    # (P, 2)
+
+    dist = np.hypot(b[:, None, 0] - wrists[..., 0], b[:, None, 1] - wrists[..., 1])  # ボールなしは NaN → 不成立
+    hit = ((nose[:, None, 0] != 0) & (wrists[..., 0] != 0)
+           & (dist < hit_distance) & (wrists[..., 1] < nose[:, None, 1]))            # (P, 2手)
+
+    people = np.arange(len(keypoints))
+    hand = np.where(hit[:, 0], 0, 1)
+    # 打った手と同じ側の足首で位置を判定し、取れていなければ反対側を使う
+    ankle = ankles[people, hand]
+    other = ankles[people, 1 - hand]
+    ankle_y = np.where(ankle[:, 0] != 0, ankle[:, 1], other[:, 1])
+
+    hit_people = np.flatnonzero(hit.any(axis=1))
+    rows, first = np.unique(person_frame[hit_people], return_index=True)
+    sel = hit_people[first]
+    return rows, ankle_y[sel] > line_y, sel, hand[sel]
+
+
+def find_contact(ball, keypoints, line_y, hit_distance=100):
+    # 1フレーム分の判定 (ライブプレビュー用)
+    if ball is None or len(keypoints) == 0: return None
+    ball_arr = np.array([ball], dtype=np.float32)
+    rows, serve, _, _ = detect_contacts(ball_arr, np.asarray(keypoints), np.zeros(len(keypoints), dtype=np.int64),
+                                        line_y, hit_distance)
+    if len(rows) == 0: return None
+    return "SERVE" if serve[0] else "SPIKE"
+
+
+def make_event(frame_idx, action, fps=DEFAULT_FPS, time_s=None):
+    # time_s: コンテナの表示時刻。無ければフレーム番号と FPS から求める
+    # (frame_idx は 1 始まり、PTS は 0 始まりなので、1 フレーム目を 0 秒にそろえる)
+    if time_s is None or time_s != time_s: time_s = (frame_idx - 1) / fps
+    return {"Time(s)": round(time_s, 2), "Action": action, "Frame": frame_idx}
+
+
+def apply_cooldown(candidates, fps=DEFAULT_FPS, cooldown_frames=20):
+    # candidates: [(frame_idx, action, time_s), ...] → 直前の採用イベントから cooldown_frames 以内の候補を捨てる
+    events = []
+    last_frame = None
+    for frame_idx, action, time_s in sorted(candidates):
+        if last_frame is not None and frame_idx - last_frame < cooldown_frames: continue
+        events.append(make_event(frame_idx, action, fps, time_s))
+        last_frame = frame_idx
+    return events
+
+
+def classify_record(record, line_y, hit_distance=100, fps=None, cooldown_frames=20):
+    # キャッシュ済みの推論結果からイベントを再判定する (推論は走らない)
+    # fps: 省略時は解析時に記録した動画の FPS (古いキャッシュでは 30)
+    frame_idx, ball, keypoints, person_frame = record.arrays()
+    rows, serve, _, _ = detect_contacts(ball, keypoints, person_frame, line_y, hit_distance)
+    times = record.times_array()[rows].tolist()
+    candidates = zip(frame_idx[rows].tolist(), np.where(serve, "SERVE", "SPIKE").tolist(), times)
+    return apply_cooldown(candidates, fps or record.meta.get("fps") or DEFAULT_FPS, cooldown_frames)
+
+
+class EventDetector:
+    def __init__(self, height, end_line_percent_y, fps=DEFAULT_FPS, cooldown_frames=20, hit_distance=100):
+        self.line_y = height * (end_line_percent_y / 100)
+        self.fps = fps
+        self.cooldown_frames = cooldown_frames
+        self.hit_distance = hit_distance
+        self.events = []
+        self._last_event_frame = None
+
+    def in_cooldown(self, frame_idx):
+        return self._last_event_frame is not None and frame_idx - self._last_event_frame < self.cooldown_frames
+
+    def update(self, frame_idx, ball, keypoints, time_s=None):
+        if self.in_cooldown(frame_idx): return None
+        action = find_contact(ball, keypoints, self.line_y, self.hit_distance)
+        if action:
+            self.events.append(make_event(frame_idx, action, self.fps, time_s))
+            self._last_event_frame = frame_idx
+        return action
+
+
+# --- 推論結果キャッシュのキーに含める設定 ---
+def inference_settings(sample_every=3, motion=None, backend="pytorch", tracker=None, crop=None, imgsz=None,
+                       batch_size=None, shards=None):
+    # batch_size / shards (シャード解析のワーカー数、逐次なら None): ボール追跡を使うときだけ結果に影響する
+    settings = {"pose_model": POSE_MODEL_NAME, "det_model": DET_MODEL_NAME, "ball_conf": BALL_CONF,
+                "pose_conf": POSE_CONF, "sample_every": sample_every, "motion": motion}
+    # 標準の設定以外のときだけキーに入れる (既存のキャッシュをそのまま使えるように)
+    if motion is not None:
+        settings["motion_phase"] = "absolute"      # 間引く位置を絶対フレーム番号で決める版
+        settings["motion_metric"] = "changed_pct"  # 動きの量を変化した画素の割合で測る版
+    if backend != "pytorch": settings["backend"] = backend
+    if tracker is not None:
+        settings["tracker"] = tracker
+        # 追跡はバッチ単位で全画面検出の計画を立て、シャードの先頭で追跡をやり直すので、その区切り方も結果を変える
+        settings["tracker_layout"] = {"batch_size": batch_size, "shards": shards}
+    if crop is not None: settings["crop"] = list(crop)
+    if imgsz: settings["imgsz"] = imgsz
+    return settings
+
+
+# --- モデルのロード (Streamlit外のワーカープロセスからも使う) ---
+_models = {}
+_models_lock = threading.Lock()
+
+def load_yolo_models(backend="pytorch"):
+    # backend: model_backends.BACKENDS のキー。ONNX / OpenVINO は初回に変換して .cache/models に保存する
+    with _models_lock:
+        if backend not in _models:
+            # ★重要: ここで初めて重いライブラリをimportする
+            import cv2
+            from model_backends import load_model, warm_up
+            pose_model, det_model = load_model(POSE_MODEL_NAME, backend), load_model(DET_MODEL_NAME, backend)
+            warm_up(pose_model)
+            warm_up(det_model)
+            _models[backend] = (pose_model, det_model, cv2)
+    return _models[backend]
+
+
+# --- 長時間動画のシャード並列解析 ---
+def plan_shards(total_frames, num_shards, overlap=30):
+    # [(開始, 終了, 読み込み開始, 読み込み終了)] 終了は含まない。重なり部分は前後のシャードが両方読む
+    num_shards = max(1, min(num_shards, total_frames))
+    step = -(-total_frames // num_shards)
+    shards = []
+    for start in range(0, total_frames, step):
+        end = min(start + step, total_frames)
+        shards.append((start, end, max(0, start - overlap), min(total_frames, end + overlap)))
+    return shards
+
+
+def _init_shard_worker(torch_threads):
+    # 各ワーカーのCPUスレッド数を絞り、プロセス間でコアを奪い合わないようにする
+    try:
+        import torch
+        torch.set_num_threads(torch_threads)
+    except ImportError:
+        pass
+
+
+class _ShardSampler:
+    # 重なり部分のフレームも判定はする (差分の状態を温めるため) が、統計は担当区間のフレームだけ数える
+    def __init__(self, sampler, start, end):
+        self.sampler = sampler
+        self.start = start
+        self.end = end
+        self.stats = {k: 0 for k in sampler.stats}
+
+    def decide(self, frame_idx, frame):
+        before = dict(self.sampler.stats)
+        take = self.sampler.decide(frame_idx, frame)
+        if self.start < frame_idx <= self.end:
+            for k, v in self.sampler.stats.items(): self.stats[k] += v - before.get(k, 0)
+        return take
+
+
+def _analyze_shard(video_path, shard, options):
+    # options: batch_size / sample_every / motion / backend / tracker / crop / imgsz (プロセス間で渡すため dict)
+    from ball_tracker import make_tracker
+    from profiler import AnalysisProfiler
+    start, end, read_start, read_end = shard
+    pose_model, det_model, cv2 = load_yolo_models(options["backend"])
+    record = InferenceRecord()
+    profiler = AnalysisProfiler()
+    # 適応サンプリング時は重なり部分で差分の状態が温まってから担当区間に入る
+    sampler = _ShardSampler(make_sampler(cv2, options["sample_every"], options["motion"]), start, end)
+    tracker = make_tracker(options["tracker"])
+    pipeline = FramePipeline(video_path, det_model, pose_model, cv2, batch_size=options["batch_size"],
+                             start_frame=read_start, end_frame=read_end, sampler=sampler, profiler=profiler,
+                             tracker=tracker, crop=options["crop"], imgsz=options["imgsz"])
+    for res in pipeline:
+        # 重なり部分は担当シャード側の結果だけを使う
+        if not (start < res.frame_idx <= end): continue
+        record.add(res.frame_idx, res.ball, res.keypoints, res.ball_track, res.time_s)
+    if tracker is not None: tracker.report(profiler)
+    # フレーム数も担当区間の分だけにする (重なり部分を数えると合計が動画のフレーム数を超える)。時間は重なり分も含む
+    profiler.set_count("frames_decoded", sampler.stats["frames_decoded"])
+    profiler.set_count("frames_skipped", sampler.stats["frames_skipped"])
+    profiler.set_count("frames_inferred", sampler.stats["frames_sampled"])
+    profiler.finish()
+    return record, sampler.stats, profiler.snapshot()
+
+
+def analyze_video_sharded(video_path, num_workers=None, batch_size=4, sample_every=3,
+                          motion=None, overlap=30, on_progress=None, profiler=None, backend="pytorch",
+                          tracker=None, crop=None, imgsz=None):
+    # tracker: BallTracker の引数 dict (各シャードで別々に追跡する)
+    # crop / imgsz: FramePipeline と同じ (コート領域の切り出しと推論サイズ)
+    # profiler: 各シャードの段階別時間 (全ワーカーの合計) を足し込む先
+    # 各シャードは生の推論結果だけを返す。クールダウンはシャードをまたいで効くので、
+    # イベント判定は結合後に classify_record でまとめて行う (逐次解析と同じ結果になる)
+    import os
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    import cv2
+
+    cap = cv2.VideoCapture(video_path)
+    meta = {"width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            "total_frames": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), "fps": cap.get(cv2.CAP_PROP_FPS) or DEFAULT_FPS}
+    cap.release()
+    record = InferenceRecord(meta)
+    stats = {}
+    if meta["total_frames"] <= 0: return record, stats
+
+    if backend != "pytorch":
+        # 変換はプロセス間で排他できないので、ワーカーを起動する前に親プロセスで済ませておく
+        from model_backends import export_model
+        for model_name in (POSE_MODEL_NAME, DET_MODEL_NAME):
+            export_model(model_name, backend)
+
+    cpu_count = os.cpu_count() or 1
+    num_workers = max(1, num_workers or cpu_count)
+    shards = plan_shards(meta["total_frames"], num_workers * 2, overlap)
+
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx, initializer=_init_shard_worker,
+                             initargs=(max(1, cpu_count // num_workers),)) as pool:
+        options = {"batch_size": batch_size, "sample_every": sample_every, "motion": motion, "backend": backend,
+                   "tracker": tracker, "crop": crop, "imgsz": imgsz}
+        futures = [pool.submit(_analyze_shard, video_path, shard, options) for shard in shards]
+        for done, future in enumerate(as_completed(futures), 1):
+            shard_record, shard_stats, shard_profile = future.result()
+            record.extend(shard_record)
+            for k, v in shard_stats.items(): stats[k] = stats.get(k, 0) + v
+            if profiler is not None: profiler.merge(shard_profile)
+            if on_progress: on_progress(done / len(futures))
+    record.sort()
+    return record, stats
@@ -0,0 +1,107 @@
+import glob
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+STORE_DIR = os.path.join(".cache", "videos")
+STORE_MAX_BYTES = 20 * 1024 ** 3  # 20GB
+ORPHAN_MAX_AGE = 24 * 3600
+HOLD_TTL = 3600  # 秒: 画面でロード中の動画は、最後に使われてからこの間は容量整理で消さない
+
+
+# --- Drive 動画のローカル保存庫 (ファイルID + 版で管理、合計サイズ上限つきLRU) ---
+class VideoStore:
+    def __init__(self, root=STORE_DIR, max_bytes=STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._in_use = {}   # path → 解析中のジョブの数
+        self._held = {}     # path → 画面で最後に使われた時刻 (セッションの終わりは分からないので期限つき)
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def version_of(file_meta):
+        # 内容が変わると md5 / 更新日時が変わるので、同じファイルIDでも別の版として扱う
+        version = file_meta.get("md5Checksum") or file_meta.get("modifiedTime") or "0"
+        return re.sub(r"[^0-9A-Za-z]", "", version)
+
+    def path_for(self, file_meta):
+        return os.path.join(self.root, f"{file_meta['id']}_{self.version_of(file_meta)}.mp4")
+
+    def lookup(self, file_meta):
+        path = self.path_for(file_meta)
+        if not os.path.exists(path): return None
+        os.utime(path)  # 最終利用時刻を更新 (LRU)
+        return path
+
+    def is_cached(self, file_meta):
+        return os.path.exists(self.path_for(file_meta))
+
+    def hold(self, path):
+        # 画面でロード中の動画 (再描画のたびに呼ぶ)。他のセッションの commit で消されないようにする
+        with self._lock:
+            self._held[path] = time.time()
+
+    @contextmanager
+    def using(self, path):
+        # 解析中のジョブが使っている間は消さない
+        with self._lock:
+            self._in_use[path] = self._in_use.get(path, 0) + 1
+        try:
+            yield path
+        finally:
+            with self._lock:
+                self._in_use[path] -= 1
+                if not self._in_use[path]: del self._in_use[path]
+
+    def _protected(self):
+        now = time.time()
+        self._held = {p: t for p, t in self._held.items() if now - t < HOLD_TTL}
+        return set(self._held) | set(self._in_use)
+
+    def commit(self, path, keep=()):
+        # ダウンロード完了後に呼ぶ: 同じファイルの古い版を消し、容量上限を超えた分を古い順に消す
+        # (他のセッション・ジョブが使っている動画は残す)
+        file_id = os.path.basename(path).rsplit("_", 1)[0]
+        with self._lock:
+            keep = {*keep, *self._protected()}
+            for old in glob.glob(os.path.join(self.root, f"{glob.escape(file_id)}_*.mp4")):
+                if old != path and old not in keep and os.path.basename(old).rsplit("_", 1)[0] == file_id:
+                    os.remove(old)
+            self.evict(keep=(path, *keep))
+        return path
+
+    def evict(self, keep=()):
+        entries = []
+        for path in glob.glob(os.path.join(self.root, "*.mp4")):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            if path in keep: continue
+            os.remove(path)
+            total -= size
+
+    def cleanup_orphans(self, max_age=ORPHAN_MAX_AGE):
+        # 中断されたまま放置された .part と、旧バージョンが tempdir に残した動画 (volleyball_<ファイルID>) を消す
+        # (tmp*.mp4 のような名前は他のプロセスのファイルと区別できないので触らない)
+        now = time.time()
+        patterns = [os.path.join(self.root, "*.part"),
+                    os.path.join(tempfile.gettempdir(), "volleyball_*.mp4*")]
+        removed = 0
+        for pattern in patterns:
+            for path in glob.glob(pattern):
+                try:
+                    if now - os.path.getmtime(path) > max_age:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def usage_bytes(self):
+        return sum(os.path.getsize(p) for p in glob.glob(os.path.join(self.root, "*.mp4")))